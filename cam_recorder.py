@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 索引记录：帧时间（毫秒）、在分段文件里的偏移、帧长度
+INDEX_RECORD = struct.Struct("<qQI")
+
+# 队列结束标记
+_STOP = object()
+
+
+class _Segment:
+    """正在写入的分段文件"""
+
+    def __init__(self, directory: str, start_ms: int):
+        self.start_ms = start_ms
+        self.data = open(os.path.join(directory, f"{start_ms}.seg"), "ab")
+        self.index = open(os.path.join(directory, f"{start_ms}.idx"), "ab")
+        self.size = self.data.tell()
+
+    def append(self, ts_ms: int, frame: memoryview):
+        offset = self.size
+        self.data.write(frame)
+        self.size += len(frame)
+        # 先写数据再写索引，读取方看到的索引一定指向完整的帧
+        self.data.flush()
+        self.index.write(INDEX_RECORD.pack(ts_ms, offset, len(frame)))
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class _IndexView:
+    """只读映射一个索引文件，按时间二分查找"""
+
+    def __init__(self, path: str):
+        self.count = 0
+        self._map = None
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size // INDEX_RECORD.size * INDEX_RECORD.size
+            if size:
+                self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                self.count = size // INDEX_RECORD.size
+
+    def __getitem__(self, i: int) -> Tuple[int, int, int]:
+        return INDEX_RECORD.unpack_from(self._map, i * INDEX_RECORD.size)
+
+    def timestamp(self, i: int) -> int:
+        return self[i][0]
+
+    def bisect(self, ts_ms: int) -> int:
+        """第一个时间不早于 ts_ms 的记录位置"""
+        return bisect.bisect_left(range(self.count), ts_ms, key=self.timestamp)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+
+
+class FrameRecorder:
+    """摄像头录像
+
+    每个摄像头一个目录，帧数据追加写入分段文件（.seg），同名的 .idx 文件
+    按固定长度记录每一帧的时间、偏移和长度。分段按时间或大小切换，
+    总大小超过上限时删除最旧的分段。
+
+    写盘在后台线程里进行，直播路径只把帧放进有界队列，写盘跟不上时丢弃新帧。
+    """
+
+    def __init__(
+        self,
+        root_dir: str,
+        segment_seconds: int = 60,
+        segment_bytes: int = 64 * 1024 * 1024,
+        max_bytes: int = 2 * 1024 * 1024 * 1024,
+        queue_size: int = 256
+    ):
+        self.root_dir = root_dir
+        self.segment_ms = segment_seconds * 1000
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._segments: Dict[str, _Segment] = {}
+
+        # 统计信息
+        self.recorded_frames = 0
+        self.recorded_bytes = 0
+        self.dropped_frames = 0
+        self.deleted_segments = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="cam-recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """停止写盘线程，队列里剩余的帧会先写完"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def record(self, camera_id: str, timestamp: float, chunk: bytes, start: int, end: int):
+        """把一帧放进写盘队列，不阻塞
+
+        chunk[start:end] 为帧数据，直接传直播用的 multipart 块，写盘时再切片，不复制
+        """
+        try:
+            self._queue.put_nowait((camera_id, int(timestamp * 1000), chunk, start, end))
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(f"写入录像失败: {e}")
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
+
+    def _camera_dir(self, camera_id: str) -> str:
+        return os.path.join(self.root_dir, camera_id)
+
+    def _write(self, camera_id: str, ts_ms: int, chunk: bytes, start: int, end: int):
+        segment = self._segments.get(camera_id)
+        if segment is not None and (ts_ms - segment.start_ms >= self.segment_ms or segment.size >= self.segment_bytes):
+            segment.close()
+            segment = None
+        if segment is None:
+            directory = self._camera_dir(camera_id)
+            os.makedirs(directory, exist_ok=True)
+            segment = self._segments[camera_id] = _Segment(directory, ts_ms)
+            self._enforce_limit(camera_id)
+
+        segment.append(ts_ms, memoryview(chunk)[start:end])
+        self.recorded_frames += 1
+        self.recorded_bytes += end - start
+
+    def _enforce_limit(self, camera_id: str):
+        """摄像头录像总大小超过上限时删除最旧的分段（正在写入的分段除外）"""
+        segments = self.list_segments(camera_id)
+        total = sum(segment["bytes"] for segment in segments)
+        current = self._segments[camera_id].start_ms
+        for segment in segments:
+            if total <= self.max_bytes or segment["start_ms"] == current:
+                break
+            base = os.path.join(self._camera_dir(camera_id), str(segment["start_ms"]))
+            for suffix in (".seg", ".idx"):
+                try:
+                    os.remove(base + suffix)
+                except FileNotFoundError:
+                    pass
+            total -= segment["bytes"]
+            self.deleted_segments += 1
+
+    def list_segments(self, camera_id: str) -> List[Dict]:
+        """按时间顺序列出摄像头的分段，包括起止时间（毫秒）、帧数和大小"""
+        directory = self._camera_dir(camera_id)
+        if not os.path.isdir(directory):
+            return []
+        starts = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg") and name[:-4].isdigit())
+        segments = []
+        for start_ms in starts:
+            index_path = os.path.join(directory, f"{start_ms}.idx")
+            if not os.path.exists(index_path):
+                continue
+            frames = os.path.getsize(index_path) // INDEX_RECORD.size
+            end_ms = start_ms
+            if frames:
+                with open(index_path, "rb") as f:
+                    f.seek((frames - 1) * INDEX_RECORD.size)
+                    end_ms = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))[0]
+            segments.append({
+                "start_ms": start_ms,
+                "end_ms": end_ms,
+                "frames": frames,
+                "bytes": os.path.getsize(os.path.join(directory, f"{start_ms}.seg"))
+            })
+        return segments
+
+    def iter_frames(self, camera_id: str, start: float, end: float) -> Iterator[Tuple[float, bytes]]:
+        """按时间顺序返回 [start, end] 之间的帧 (时间戳秒, JPEG 数据)
+
+        索引和分段文件都用 mmap 读取，只读到需要的帧，不会把整个分段读进内存
+        """
+        start_ms, end_ms = int(start * 1000), int(end * 1000)
+        directory = self._camera_dir(camera_id)
+        for segment in self.list_segments(camera_id):
+            if segment["end_ms"] < start_ms or segment["start_ms"] > end_ms or not segment["frames"]:
+                continue
+            base = os.path.join(directory, str(segment["start_ms"]))
+            # 分段可能刚好被删除
+            try:
+                data_file = open(base + ".seg", "rb")
+            except FileNotFoundError:
+                continue
+            try:
+                index = _IndexView(base + ".idx")
+            except FileNotFoundError:
+                data_file.close()
+                continue
+            try:
+                data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for i in range(index.bisect(start_ms), index.count):
+                        ts_ms, offset, length = index[i]
+                        if ts_ms > end_ms:
+                            return
+                        if offset + length > len(data):
+                            break
+                        yield ts_ms / 1000.0, data[offset:offset + length]
+                finally:
+                    data.close()
+            finally:
+                index.close()
+                data_file.close()
+
+    def stats(self) -> Dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "recorded_frames": self.recorded_frames,
+            "recorded_bytes": self.recorded_bytes,
+            "dropped_frames": self.dropped_frames,
+            "deleted_segments": self.deleted_segments
+        }
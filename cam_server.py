@@ -1,76 +1,334 @@
 import asyncio
+import re
+import time
+from collections import deque
+from datetime import datetime
 from fastapi import FastAPI, Request, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-from typing import Set
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from typing import Dict, Optional
 import logging
+from config import CAM_MAX_VIEWER_FPS, CAM_STATS_WINDOW_SECONDS, CAM_MAX_CAMERAS
+from config import CAM_RECORD_ENABLED, CAM_RECORD_DIR, CAM_RECORD_SEGMENT_SECONDS, CAM_RECORD_SEGMENT_BYTES
+from config import CAM_RECORD_MAX_BYTES, CAM_RECORD_QUEUE_SIZE
+from cam_recorder import FrameRecorder
+from dao.metrics import registry, gauge, counter, MetricsMiddleware
+from scripts.metrics_server import metrics_router, profiler
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
+app.include_router(metrics_router)
+app.add_middleware(MetricsMiddleware, profiler=profiler)
 
-# 存储所有活跃的客户端队列
-active_clients: Set[asyncio.Queue] = set()
+# 不带摄像头ID的旧接口使用的摄像头
+DEFAULT_CAMERA = "default"
 
-async def generate_frames(request: Request):
+# 摄像头ID同时用作录像目录名，只允许这些字符
+CAMERA_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$")
+
+
+def multipart_header(size: int) -> bytes:
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n'
+            b'Content-Length: ' + str(size).encode() + b'\r\n\r\n')
+
+
+class FrameBroadcaster:
+    """单个摄像头的最新帧广播
+
+    只保存最新的一帧（已经编码好的 multipart 块）和一个递增的帧序号。
+    每个客户端记住自己发过的序号，有新帧就发最新的一帧，中间的帧直接跳过，
+    所以卡住的客户端最多只引用一帧，不会占用越来越多的内存。
+    """
+
+    def __init__(self, camera_id: str):
+        self.camera_id = camera_id
+        self.generation = 0
+        self.chunk: Optional[bytes] = None
+        self.frame_start = 0            # 帧数据在 chunk 里的起始位置
+        self.last_frame_at: Optional[float] = None
+        self.viewers = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0         # 因为客户端跟不上或限制了帧率而跳过的帧
+        self._recent = deque()          # 统计窗口内的 (时间, 帧大小)
+        self._new_frame = asyncio.Event()
+
+    def publish(self, parts: list, size: int):
+        """发布新帧，parts 为帧数据的分块，和 multipart 头一起只拼接一次"""
+        header = multipart_header(size)
+        self.chunk = b''.join([header, *parts, b'\r\n'])
+        self.frame_start = len(header)
+        self.generation += 1
+
+        now = time.monotonic()
+        self.last_frame_at = time.time()
+        self._recent.append((now, size))
+        while self._recent and self._recent[0][0] < now - CAM_STATS_WINDOW_SECONDS:
+            self._recent.popleft()
+
+        # 唤醒所有等待中的客户端，之后的客户端等待新的 Event
+        event, self._new_frame = self._new_frame, asyncio.Event()
+        event.set()
+
+    def snapshot(self) -> Optional[bytes]:
+        """最新一帧的 JPEG 数据"""
+        if self.chunk is None:
+            return None
+        return self.chunk[self.frame_start:-2]
+
+    async def frames(self, max_fps: float):
+        """逐个返回新帧，所有客户端共用同一个 bytes 对象；两帧之间至少间隔 1/max_fps 秒"""
+        interval = 1.0 / max_fps
+        seen = self.generation
+        next_send = 0.0
+        while True:
+            event = self._new_frame
+            if self.generation == seen:
+                await event.wait()
+                continue
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                # 等待期间到达的帧只发最新的一帧
+                await asyncio.sleep(delay)
+            self.frames_skipped += self.generation - seen - 1
+            seen = self.generation
+            next_send = time.monotonic() + interval
+            self.frames_sent += 1
+            yield self.chunk
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        recent = [size for at, size in self._recent if at >= now - CAM_STATS_WINDOW_SECONDS]
+        return {
+            "viewers": self.viewers,
+            "frames": self.generation,
+            "ingest_fps": round(len(recent) / CAM_STATS_WINDOW_SECONDS, 2),
+            "ingest_bytes_per_sec": round(sum(recent) / CAM_STATS_WINDOW_SECONDS),
+            "last_frame_at": self.last_frame_at,
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped
+        }
+
+
+# 每个摄像头一个广播器，第一次上传或观看时创建
+# 摄像头在第一次上传时创建；默认摄像头预先创建，旧的 /stream 接口可以在设备上线前打开等待
+cameras: Dict[str, FrameBroadcaster] = {DEFAULT_CAMERA: FrameBroadcaster(DEFAULT_CAMERA)}
+
+# 录像（可选），写盘在后台线程里进行
+recorder = FrameRecorder(
+    CAM_RECORD_DIR,
+    segment_seconds=CAM_RECORD_SEGMENT_SECONDS,
+    segment_bytes=CAM_RECORD_SEGMENT_BYTES,
+    max_bytes=CAM_RECORD_MAX_BYTES,
+    queue_size=CAM_RECORD_QUEUE_SIZE
+) if CAM_RECORD_ENABLED else None
+
+def collect_metrics():
+    """每个摄像头的上传帧率、码率、观看人数和发送/跳过的帧数（GET /metrics）"""
+    stats = [({"camera": camera_id}, camera.stats()) for camera_id, camera in list(cameras.items())]
+    families = [
+        gauge("iot_cam_frames_per_second", "Frames uploaded per second over CAM_STATS_WINDOW_SECONDS",
+              [(labels, item["ingest_fps"]) for labels, item in stats]),
+        gauge("iot_cam_ingest_bytes_per_second", "Bytes uploaded per second over CAM_STATS_WINDOW_SECONDS",
+              [(labels, item["ingest_bytes_per_sec"]) for labels, item in stats]),
+        gauge("iot_cam_viewers", "Connected stream viewers", [(labels, item["viewers"]) for labels, item in stats]),
+        counter("iot_cam_frames_total", "Frames uploaded", [(labels, item["frames"]) for labels, item in stats]),
+        counter("iot_cam_frames_sent_total", "Frames sent to viewers",
+                [(labels, item["frames_sent"]) for labels, item in stats]),
+        counter("iot_cam_frames_skipped_total", "Frames skipped for slow or rate-limited viewers",
+                [(labels, item["frames_skipped"]) for labels, item in stats])
+    ]
+    if recorder is not None:
+        recorded = recorder.stats()
+        families += [
+            counter("iot_cam_recorded_frames_total", "Frames written to recordings", [({}, recorded["recorded_frames"])]),
+            counter("iot_cam_recorder_dropped_frames_total", "Frames dropped because the recorder queue was full",
+                    [({}, recorded["dropped_frames"])]),
+            gauge("iot_cam_recorder_queue_depth", "Frames waiting to be written", [({}, recorded["queue_depth"])])
+        ]
+    return families
+
+registry.add_collector(collect_metrics)
+
+@app.on_event("startup")
+async def startup_event():
+    if recorder is not None:
+        recorder.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if recorder is not None:
+        recorder.stop()
+
+def check_camera_id(camera_id: str):
+    if not CAMERA_ID_PATTERN.match(camera_id):
+        raise HTTPException(status_code=400, detail="Invalid camera id")
+
+def get_camera(camera_id: str, create: bool = False) -> FrameBroadcaster:
+    """返回摄像头的广播器，create 为 True 时（只有上传会）创建新的摄像头，最多 CAM_MAX_CAMERAS 个"""
+    camera = cameras.get(camera_id)
+    if camera is None:
+        if not create:
+            raise HTTPException(status_code=404, detail="Camera not found")
+        if len(cameras) >= CAM_MAX_CAMERAS:
+            raise HTTPException(status_code=503, detail="Too many cameras")
+        camera = cameras[camera_id] = FrameBroadcaster(camera_id)
+    return camera
+
+async def generate_frames(request: Request, camera: FrameBroadcaster, max_fps: float):
     """生成视频帧响应给客户端"""
-    queue = asyncio.Queue()
-    active_clients.add(queue)
-    logger.info(f"New client connected: {request.client.host}")
+    camera.viewers += 1
+    logger.info(f"New client connected to {camera.camera_id}: {request.client.host}")
 
     try:
-        while True:
-            # 从队列获取视频帧
-            frame = await queue.get()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+        async for chunk in camera.frames(max_fps):
+            yield chunk
     except asyncio.CancelledError:
-        logger.info(f"Client disconnected: {request.client.host}")
+        logger.info(f"Client disconnected from {camera.camera_id}: {request.client.host}")
     finally:
-        active_clients.discard(queue)
+        camera.viewers -= 1
 
-@app.post("/upload_frame")
-async def upload_frame(request: Request):
+@app.post("/upload_frame/{camera_id}")
+async def upload_frame(request: Request, camera_id: str):
     """接收 ESP32-CAM 推送的视频帧（原始二进制数据）"""
+    check_camera_id(camera_id)
     try:
-        # 直接读取请求体中的二进制数据
-        frame_data = await request.body()
-        
-        if not frame_data:
+        # 按块读取请求体，和 multipart 头一起只拼接一次
+        parts = []
+        size = 0
+        async for part in request.stream():
+            if part:
+                parts.append(part)
+                size += len(part)
+
+        if not size:
             raise HTTPException(status_code=400, detail="Empty frame data")
-        
-        logger.info(f"Received frame with size: {len(frame_data)} bytes")
-        
-        # 分发给所有客户端
-        for queue in list(active_clients):
-            try:
-                queue.put_nowait(frame_data)
-            except asyncio.QueueFull:
-                logger.warning("Client queue full, skipping frame")
-            except Exception as e:
-                logger.error(f"Error sending to client: {e}")
-                active_clients.discard(queue)
-        
+
+        logger.debug(f"Received frame from {camera_id} with size: {size} bytes")
+
+        # 分发给这个摄像头的所有客户端
+        camera = get_camera(camera_id, create=True)
+        camera.publish(parts, size)
+
+        # 录像只是把同一个 bytes 对象放进队列，不影响直播
+        if recorder is not None:
+            recorder.record(camera_id, camera.last_frame_at, camera.chunk, camera.frame_start, len(camera.chunk) - 2)
+
         return {"status": "ok", "message": "Frame processed"}
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing frame: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/upload_frame")
+async def upload_default_frame(request: Request):
+    """旧接口，等同于 /upload_frame/default"""
+    return await upload_frame(request, DEFAULT_CAMERA)
+
+@app.get("/stream/{camera_id}")
+async def video_feed(request: Request, camera_id: str, fps: Optional[float] = None):
+    """客户端访问的视频流端点（MJPEG），fps 为客户端希望的帧率，不超过 CAM_MAX_VIEWER_FPS"""
+    check_camera_id(camera_id)
+    max_fps = CAM_MAX_VIEWER_FPS if fps is None or fps <= 0 else min(fps, CAM_MAX_VIEWER_FPS)
+    return StreamingResponse(
+        generate_frames(request, get_camera(camera_id), max_fps),
+        media_type="multipart/x-mixed-replace; boundary=frame"
+    )
+
 @app.get("/stream")
-async def video_feed(request: Request):
-    """客户端访问的视频流端点（MJPEG）"""
+async def default_video_feed(request: Request, fps: Optional[float] = None):
+    """旧接口，等同于 /stream/default"""
+    return await video_feed(request, DEFAULT_CAMERA, fps)
+
+@app.get("/snapshot/{camera_id}")
+async def snapshot(camera_id: str):
+    """摄像头最新的一帧（从内存返回）"""
+    camera = cameras.get(camera_id)
+    frame = camera.snapshot() if camera else None
+    if frame is None:
+        raise HTTPException(status_code=404, detail="No frame for this camera")
+    return Response(content=frame, media_type="image/jpeg", headers={"Cache-Control": "no-store"})
+
+def parse_time(value: str) -> float:
+    """解析回放的时间参数：Unix 时间戳（秒）或 ISO 8601 字符串（不带时区时按服务器本地时间）"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+async def generate_playback(camera_id: str, start: float, end: float, speed: float):
+    """按录像时的间隔回放，speed 为回放倍速，0 表示不等待"""
+    frames = recorder.iter_frames(camera_id, start, end)
+    first_ts = None
+    began = time.monotonic()
+    try:
+        while True:
+            # 读 mmap 可能触发磁盘 IO，放到线程里执行
+            item = await asyncio.to_thread(next, frames, None)
+            if item is None:
+                break
+            ts, frame = item
+            if speed > 0:
+                if first_ts is None:
+                    first_ts = ts
+                delay = (ts - first_ts) / speed - (time.monotonic() - began)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield multipart_header(len(frame)) + frame + b'\r\n'
+    finally:
+        frames.close()
+
+@app.get("/recordings/{camera_id}")
+async def recordings(camera_id: str):
+    """摄像头的录像分段列表（起止时间为毫秒级 Unix 时间戳）"""
+    check_camera_id(camera_id)
+    if recorder is None:
+        raise HTTPException(status_code=404, detail="Recording is disabled")
+    segments = await asyncio.to_thread(recorder.list_segments, camera_id)
+    return {"status": "ok", "segments": segments}
+
+@app.get("/playback/{camera_id}")
+async def playback(camera_id: str, start: str, end: Optional[str] = None, speed: float = 1.0):
+    """回放一段录像（MJPEG），start/end 为 Unix 时间戳（秒）或 ISO 8601 时间，end 默认为现在"""
+    check_camera_id(camera_id)
+    if recorder is None:
+        raise HTTPException(status_code=404, detail="Recording is disabled")
+    try:
+        start_ts = parse_time(start)
+        end_ts = parse_time(end) if end else time.time()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid start or end time")
+    if end_ts < start_ts or speed < 0:
+        raise HTTPException(status_code=400, detail="Invalid time range or speed")
     return StreamingResponse(
-        generate_frames(request),
+        generate_playback(camera_id, start_ts, end_ts, speed),
         media_type="multipart/x-mixed-replace; boundary=frame"
     )
 
+@app.get("/stats")
+async def stats():
+    """每个摄像头的上传帧率、码率和观看人数"""
+    return {
+        "status": "ok",
+        "max_viewer_fps": CAM_MAX_VIEWER_FPS,
+        "recorder": recorder.stats() if recorder is not None else None,
+        "cameras": {camera_id: camera.stats() for camera_id, camera in list(cameras.items())}
+    }
+
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
-    return {"status": "ok", "message": "Server is running"}
+    return {
+        "status": "ok",
+        "message": "Server is running",
+        "cameras": len(cameras),
+        "viewers": sum(camera.viewers for camera in list(cameras.values()))
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=12346)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=12346)
@@ -7,6 +7,140 @@ WORK_DIR = "./data"
 IOT_DATA_DB = os.path.join(WORK_DIR, "iot_data.db") 
 
 AGENT_DB = os.path.join(WORK_DIR, "agent.db") 
+
+# agent 表的内存缓存（AgentDAO），增删改后更新这个文件，其他 worker 进程每次读取前 stat 一下发现变化就重新加载
+AGENT_CACHE_STAMP_FILE = os.path.join(WORK_DIR, "agent.version")
+AGENT_CACHE_MAX_AGE_SECONDS = 300   # 最多多久重新加载一次，覆盖绕过 AgentDAO 直接改库的情况（如 sql_view.sh）
  
 
+# 数据写入队列配置（POST /data/iot_data）
+INGEST_QUEUE_MAXSIZE = 10000        # 内存队列最大长度，满了之后直接返回 503
+INGEST_BATCH_SIZE = 500             # 攒够多少条数据写一次库
+INGEST_FLUSH_INTERVAL_MS = 50       # 最多等待多少毫秒写一次库
+INGEST_ACK_MODE = "commit"          # commit: 写库成功后再返回；enqueue: 进入队列即返回
+
+# 多 worker 部署（start_server.sh）：HTTP_WORKERS > 1 时各 worker 只用只读连接查询，写入和删除经 Unix socket
+# 交给唯一的写库进程 writer_server.py；写库进程提交后把数据广播给各 worker，更新它们的缓存和实时推送
+HTTP_WORKERS = int(os.environ.get("IOT_HTTP_WORKERS", "1"))
+WRITER_SOCKET = os.path.join(WORK_DIR, "writer.sock")
+WRITER_BATCH_SIZE = 2000            # 写库进程合并各 worker 发来的数据，攒够多少条写一次库
+WRITER_FLUSH_INTERVAL_MS = 5        # 写库进程最多等待多少毫秒写一次库（worker 那边已经攒过一次）
+WRITER_TIMEOUT_SECONDS = 30         # worker 等待写库进程回复写入的最长时间
+WRITER_CONTROL_TIMEOUT_SECONDS = 600  # 删除设备、数据清理等操作的最长等待时间，这些操作用单独的连接，不阻塞写入
+WRITER_SUBSCRIBER_BUFFER_BYTES = 16 * 1024 * 1024  # 广播积压超过这个大小的 worker 被断开，重连后重新加载缓存
+
+# 批量上传接口（POST /data/iot_data_bulk）
+BULK_INSERT_CHUNK_SIZE = 1000       # 每个事务写入的条数
+BULK_MAX_ERRORS = 1000              # 返回的错误明细最多条数
+
+# 数据库线程池（把同步的 SQLAlchemy 操作移出事件循环）
+DB_READ_WORKERS = 4                 # 读线程数
+DB_READ_MAX_PENDING = 64            # 读任务最多排队数（含正在执行的）
+DB_WRITE_MAX_PENDING = 256          # 写任务最多排队数，写线程固定为 1 个
+
+# SQLite 存储配置
+SQLITE_PROFILE = "tuned"            # tuned: WAL + 单写连接 + 只读连接池；default: 原来的默认配置
+SQLITE_PROFILES = {
+    "default": {
+        "pragmas": {},
+        "single_writer": False,
+        "read_pool_size": 5
+    },
+    "tuned": {
+        "pragmas": {
+            "auto_vacuum": "INCREMENTAL",   # 删除后可分批回收空间，必须在建表前设置；已有的库执行一次 tools/compact_db.py
+            "journal_mode": "WAL",          # 读写互不阻塞
+            "synchronous": "NORMAL",        # WAL 模式下只在 checkpoint 时 fsync
+            "mmap_size": 268435456,         # 256MB 内存映射读
+            "cache_size": -65536,           # 负数表示 KB，即 64MB 页缓存
+            "temp_store": "MEMORY",         # 排序等临时数据放内存
+            "busy_timeout": 5000            # 等锁最多 5 秒
+        },
+        "single_writer": True,
+        "read_pool_size": 4
+    }
+}
+
+# 查询接口（POST /data/query_iot_data）
+STREAM_CHUNK_ROWS = 1000            # 流式返回时每批读取/输出的条数
+MAX_PAGE_SIZE = 10000               # 分页查询每页最多条数
+
+# 查询结果缓存（/data/query_iot_data、/data/get_device_id_key），按设备在写入/删除时失效，响应带 ETag
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 缓存的响应体总大小，0 表示不缓存
+RESULT_CACHE_LIVE_TTL_SECONDS = 5   # 结束时间未到的窗口最多缓存多久（其他进程的写入不会触发失效）
+
+# 聚合接口（POST /data/aggregate_iot_data）
+MAX_DOWNSAMPLE_POINTS = 20000       # 降采样模式下每个键最多返回的点数
+
+# 预聚合表（按分钟/小时/天汇总，写入时增量更新）
+ROLLUP_ENABLED = True
+
+# 原始数据按时间分区："month" 或 "day"，None 表示不分区。开启后新数据写入 sensor_data_p<周期> 表，
+# 查询只读与时间范围重叠的分区，保留策略整表删除过期的分区；已有数据用 tools/partition_db.py 迁移
+PARTITION_PERIOD = None
+
+# 存储引擎："sqlite" 直接查 sensor_data 表；"columnar" 额外维护按设备、按键分列压缩的副本，
+# 聚合（预聚合表覆盖不了的粒度）和降采样从副本读取，只读需要的键
+STORAGE_ENGINE = "sqlite"
+COLUMNAR_DIR = os.path.join(WORK_DIR, "columnar")
+COLUMNAR_PARTITION_SECONDS = 86400  # 每个分区的时长，按北京时间零点对齐
+COLUMNAR_BLOCK_ROWS = 4096          # 每个设备攒够多少行写一个压缩块
+COLUMNAR_FLUSH_SECONDS = 60         # 未满的块最多在内存里停留多久
+
+# 数据保留策略，"*" 为全局默认，设备ID为单独配置（覆盖全局中的同名项）
+# raw 为原始数据，1m/1h/1d 为预聚合表，值为保留时长（如 "30d"），None 表示永久保留
+RETENTION_POLICIES = {
+    # "*": {"raw": "30d", "1m": "30d", "1h": "730d", "1d": None},
+    # "ESP32S3-DHT11": {"raw": "90d"},
+}
+RETENTION_INTERVAL_SECONDS = 3600   # 多久执行一次清理
+RETENTION_BATCH_SIZE = 1000         # 每个删除事务的条数，越小持有写锁的时间越短
+RETENTION_BATCH_PAUSE_MS = 20       # 两个删除事务之间让出写锁的时间
+RETENTION_VACUUM_PAGES = 2000       # 每轮 incremental_vacuum 最多回收的页数
+
+# 实时推送（GET /data/subscribe、WebSocket /data/ws）
+LIVE_BUFFER_SIZE = 256              # 每个订阅者最多缓存的消息数
+LIVE_DEFAULT_POLICY = "drop_oldest" # 缓存满时的处理方式：drop_oldest 丢弃最旧的，coalesce 每个设备只保留最新一条
+LIVE_HEARTBEAT_SECONDS = 15         # 没有新数据时发送心跳的间隔
+
+# 摄像头服务（cam_server.py）
+CAM_MAX_VIEWER_FPS = 15             # 每个观看端最多每秒发送的帧数，多出来的中间帧直接跳过
+CAM_STATS_WINDOW_SECONDS = 5        # 统计上传帧率、码率的时间窗口
+CAM_MAX_CAMERAS = 64                # 最多同时接收多少个摄像头上传，摄像头在第一次上传时创建
+
+# 摄像头录像（cam_recorder.py），帧按摄像头写入分段文件，超过总大小后删除最旧的分段
+CAM_RECORD_ENABLED = False
+CAM_RECORD_DIR = os.path.join(WORK_DIR, "cam")
+CAM_RECORD_SEGMENT_SECONDS = 60     # 每个分段最长的时间
+CAM_RECORD_SEGMENT_BYTES = 64 * 1024 * 1024    # 每个分段最大的字节数
+CAM_RECORD_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 每个摄像头录像最多占用的空间
+CAM_RECORD_QUEUE_SIZE = 256         # 待写入的帧数，写盘跟不上时丢弃新帧，不影响直播
+
+# MQTT 写入（server_mqtt.py），收到的消息先放进队列，由后台线程批量写库
+MQTT_QOS = 1                        # 订阅数据主题使用的 QoS，QoS>0 的消息写库成功后才确认
+MQTT_QUEUE_MAXSIZE = 10000          # 队列最大长度
+MQTT_BATCH_SIZE = 500               # 攒够多少条写一次库
+MQTT_FLUSH_INTERVAL_MS = 200        # 最多等待多少毫秒写一次库
+# 队列满时：drop 直接丢弃（并确认）；block 阻塞 paho 的网络线程（最多 MQTT_BLOCK_TIMEOUT_SECONDS 秒），
+# 阻塞期间收不到 PINGRESP、发不出确认，可能被 broker 断开，不建议使用。
+# QoS>0 的消息写库后才确认，broker 的发送窗口（未确认消息数上限）满了就会停止推送，
+# 只要窗口小于 MQTT_QUEUE_MAXSIZE 队列就不会满，drop 实际只影响 QoS 0 的消息
+MQTT_OVERFLOW_POLICY = "drop"
+MQTT_BLOCK_TIMEOUT_SECONDS = 5
+
+# MQTT 共享订阅（server_mqtt.py --workers N），N 个消费进程通过 $share/<组名>/iot/data 分摊消息，主进程统一写库
+MQTT_WORKERS = 1                    # 消费进程数，1 表示不使用共享订阅
+MQTT_SHARE_GROUP = "iot_server"
+MQTT_WORKER_BATCH_SIZE = 100        # 消费进程攒够多少条发给主进程
+MQTT_WORKER_FLUSH_MS = 50           # 消费进程最多等待多少毫秒发一次
+
+# 监控指标（GET /metrics，Prometheus 文本格式），server.py、server_mqtt.py、cam_server.py 各自提供
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # 耗时分布的桶（秒）
+METRICS_RATE_WINDOW_SECONDS = 60    # 每秒写入条数、消息数等速率按最近多长时间计算
 
+# 慢请求采样分析，默认关闭；可以用环境变量 IOT_PROFILER=1 打开，或运行时 POST /metrics/profiler?enabled=true
+PROFILER_ENABLED = os.environ.get("IOT_PROFILER", "0") == "1"
+PROFILER_SLOW_MS = 500              # 耗时超过多少毫秒的请求把采样写到文件
+PROFILER_INTERVAL_MS = 5            # 采样间隔
+PROFILER_DIR = os.path.join(WORK_DIR, "profiles")
+PROFILER_MAX_FILES = 200            # 最多保留的采样文件数，超过后删除最旧的
@@ -3,31 +3,26 @@
 
 from fastapi import HTTPException
 from datetime import datetime
-from typing import Dict, Optional
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from typing import Dict, Optional, Tuple
+from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy.pool import QueuePool
 from contextlib import contextmanager
+import os
+import threading
+import time
 import pytz
 from pydantic import BaseModel
-from config import AGENT_DB
+from config import AGENT_DB, AGENT_CACHE_STAMP_FILE, AGENT_CACHE_MAX_AGE_SECONDS
+from dao.sqlite_engine import create_sqlite_engines
 
 
-DATABASE_URL = f"sqlite:///{AGENT_DB}"  
 beijing_tz = pytz.timezone('Asia/Shanghai')
 
-# SQLAlchemy 配置
+# SQLAlchemy 配置（写引擎 + 只读引擎，见 config.SQLITE_PROFILE）
 Base = declarative_base()
-engine = create_engine(
-    DATABASE_URL,
-    poolclass=QueuePool,
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
-    pool_pre_ping=True,
-    pool_recycle=3600
-)
+engine, read_engine = create_sqlite_engines(AGENT_DB)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 class Agent(Base):
     __tablename__ = 'agents'
@@ -62,7 +57,31 @@ class AgentOut(BaseModel):
         orm_mode = True
 
 
+def _agent_to_dict(agent: Agent) -> Dict:
+    return {
+        "id": agent.id,
+        "create_time": agent.create_time,
+        "name": agent.name,
+        "freq": agent.freq,
+        "describe": agent.describe
+    }
+
+
 class AgentDAO:
+    """agent 表的读写
+
+    读取走整张表的内存快照，agent 很少变化，健康检查等高频查询不访问数据库。
+    create/update/delete 提交后替换版本文件（stamp_file），同一进程和其他 worker 进程
+    读取前 stat 这个文件，发现变化就重新加载；快照超过 max_age_seconds 也会重新加载。
+    """
+
+    def __init__(self, stamp_file: str = AGENT_CACHE_STAMP_FILE, max_age_seconds: float = AGENT_CACHE_MAX_AGE_SECONDS):
+        self.stamp_file = stamp_file
+        self.max_age_seconds = max_age_seconds
+        # (名称 -> agent, 加载时的版本, 加载时间)，整体替换，读取时不需要加锁
+        self._cache: Optional[Tuple[Dict[str, Dict], Optional[tuple], float]] = None
+        self._lock = threading.Lock()
+
     @contextmanager
     def get_db(self):
         db = SessionLocal()
@@ -75,6 +94,58 @@ class AgentDAO:
         finally:
             db.close()
 
+    @contextmanager
+    def get_read_db(self):
+        db = ReadSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _read_stamp(self):
+        try:
+            st = os.stat(self.stamp_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _touch_stamp(self):
+        """写入提交后调用：用新文件整体替换版本文件，inode 和修改时间都会变"""
+        tmp = f"{self.stamp_file}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as f:
+            f.write(f"{time.time_ns()} {os.getpid()}\n")
+        os.replace(tmp, self.stamp_file)
+        self._cache = None
+
+    def _fresh_agents(self) -> Optional[Dict[str, Dict]]:
+        """快照仍然有效时返回快照，否则返回 None"""
+        cache = self._cache
+        if cache is None:
+            return None
+        agents, stamp, loaded_at = cache
+        if time.monotonic() - loaded_at >= self.max_age_seconds or self._read_stamp() != stamp:
+            return None
+        return agents
+
+    def cache_fresh(self) -> bool:
+        """快照可以直接使用，读取不会访问数据库"""
+        return self._fresh_agents() is not None
+
+    def _snapshot(self) -> Dict[str, Dict]:
+        agents = self._fresh_agents()
+        if agents is not None:
+            return agents
+        with self._lock:
+            agents = self._fresh_agents()
+            if agents is not None:
+                return agents
+            # 先记下版本再读表，读的过程中有写入的话下次读取时版本不同，会再加载一次
+            stamp = self._read_stamp()
+            with self.get_read_db() as db:
+                agents = {agent.name: _agent_to_dict(agent) for agent in db.query(Agent).all()}
+            self._cache = (agents, stamp, time.monotonic())
+            return agents
+
     def create_agent(self, name: str, freq: int, describe: Optional[str] = None) -> Agent:
         with self.get_db() as db:
             # 检查是否已存在同名 agent
@@ -84,7 +155,8 @@ class AgentDAO:
             agent = Agent(name=name, freq=freq, describe=describe)
             db.add(agent)
             db.flush()  # 为了能拿到 agent.id（可选）
-            return agent
+        self._touch_stamp()
+        return agent
 
     def delete_agent(self, name: int) -> bool:
         with self.get_db() as db:
@@ -92,35 +164,15 @@ class AgentDAO:
             if not agent:
                 raise HTTPException(status_code=404, detail=f"Agent with name {name} not found.")
             db.delete(agent)
-            return True
+        self._touch_stamp()
+        return True
 
     def get_agent(self, name: str):
-        with self.get_db() as db:
-            agent = db.query(Agent).filter(Agent.name == name).first()
-            if agent:
-                return {
-                        "id": agent.id,
-                        "create_time": agent.create_time,
-                        "name": agent.name,
-                        "freq": agent.freq,
-                        "describe": agent.describe
-                    }
-            else:
-                return None
+        agent = self._snapshot().get(name)
+        return dict(agent) if agent else None
 
     def get_all_agents(self) -> Dict[str, Dict]:
-        with self.get_db() as db:
-            agents = db.query(Agent).all()
-            result = {}
-            for agent in agents:
-                result[agent.name] = {
-                    "id": agent.id,
-                    "create_time": agent.create_time,
-                    "name": agent.name,
-                    "freq": agent.freq,
-                    "describe": agent.describe
-                }
-            return result
+        return {name: dict(agent) for name, agent in self._snapshot().items()}
 
     def update_agent(self, name: str, freq: Optional[int] = None, describe: Optional[str] = None) -> Agent:
         with self.get_db() as db:
@@ -131,5 +183,5 @@ class AgentDAO:
                 agent.freq = freq
             if describe is not None:
                 agent.describe = describe
-            return agent
-
+        self._touch_stamp()
+        return agent
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from dao.agent_info import AgentDAO
+from dao.iot_data_info import SensorDataDAO
+from dao.metrics import registry
+from config import DB_READ_WORKERS, DB_READ_MAX_PENDING, DB_WRITE_MAX_PENDING
+
+
+class DBExecutor:
+    """数据库线程池，读写分两条通道
+
+    读通道有多个线程，慢查询只占用其中一个；写通道只有一个线程，
+    SQLite 同一时间本来也只允许一个写事务。两条通道都限制了排队数量，
+    排满之后调用方在事件循环里等待，不会无限堆积。
+    """
+
+    def __init__(self, read_workers: int, read_max_pending: int, write_max_pending: int):
+        self.read_workers = read_workers
+        self.read_max_pending = read_max_pending
+        self.write_max_pending = write_max_pending
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._read_slots: Optional[asyncio.Semaphore] = None
+        self._write_slots: Optional[asyncio.Semaphore] = None
+
+    def _ensure_started(self):
+        if self._reader is None:
+            self._reader = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix="db-read")
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+            self._read_slots = asyncio.Semaphore(self.read_max_pending)
+            self._write_slots = asyncio.Semaphore(self.write_max_pending)
+
+    async def _run(self, pool, executor, slots, fn, *args, **kwargs):
+        queued = time.perf_counter()
+        async with slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(_timed, pool, queued, fn, *args, **kwargs))
+
+    async def run_read(self, fn, *args, **kwargs):
+        """在读通道执行同步函数"""
+        self._ensure_started()
+        return await self._run("read", self._reader, self._read_slots, fn, *args, **kwargs)
+
+    async def run_write(self, fn, *args, **kwargs):
+        """在写通道执行同步函数"""
+        self._ensure_started()
+        return await self._run("write", self._writer, self._write_slots, fn, *args, **kwargs)
+
+    def shutdown(self):
+        """关闭线程池，等待正在执行的任务结束"""
+        if self._reader is not None:
+            self._reader.shutdown(wait=True)
+            self._writer.shutdown(wait=True)
+            self._reader = None
+            self._writer = None
+
+
+db_task_wait_seconds = registry.histogram(
+    "iot_db_task_wait_seconds", "Time a DB task waited for a thread pool slot and thread", ("pool",)
+)
+db_task_run_seconds = registry.histogram(
+    "iot_db_task_run_seconds", "Time a DB task ran in the thread pool", ("pool",)
+)
+
+
+def _timed(pool: str, queued: float, fn, *args, **kwargs):
+    """在线程里执行，分别记录排队和执行的耗时"""
+    started = time.perf_counter()
+    db_task_wait_seconds.observe(started - queued, (pool,))
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        db_task_run_seconds.observe(time.perf_counter() - started, (pool,))
+
+
+db_executor = DBExecutor(DB_READ_WORKERS, DB_READ_MAX_PENDING, DB_WRITE_MAX_PENDING)
+
+
+class AsyncSensorDataDAO:
+    """SensorDataDAO 的异步版本，所有操作都在数据库线程池里执行
+
+    writer 不为空时（多 worker 部署的 WriterClient），写入和删除交给它转发给写库进程
+    """
+
+    def __init__(self, dao: SensorDataDAO, executor: DBExecutor = db_executor, writer=None):
+        self.dao = dao
+        self.executor = executor
+        self.writer = writer or dao
+
+    async def save_sensor_data_batch(self, rows: List[Dict]) -> bool:
+        return await self.executor.run_write(self.writer.save_sensor_data_batch, rows)
+
+    async def query_sensor_data(
+        self,
+        device_id: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict]:
+        return await self.executor.run_read(
+            self.dao.query_sensor_data,
+            device_id=device_id,
+            start_time=start_time,
+            end_time=end_time,
+            limit=limit
+        )
+
+    async def query_sensor_data_page(
+        self,
+        device_id: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        page_size: int = 1000,
+        cursor: Optional[Tuple[datetime, int]] = None
+    ) -> Tuple[List[Dict], Optional[Tuple[datetime, int]]]:
+        return await self.executor.run_read(
+            self.dao.query_sensor_data_page,
+            device_id=device_id,
+            start_time=start_time,
+            end_time=end_time,
+            page_size=page_size,
+            cursor=cursor
+        )
+
+    async def aggregate_sensor_data(
+        self,
+        device_id: str,
+        keys: List[str],
+        bucket_seconds: int,
+        funcs: List[str],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+    ) -> Dict:
+        return await self.executor.run_read(
+            self.dao.aggregate_sensor_data,
+            device_id, keys, bucket_seconds, funcs,
+            start_time=start_time,
+            end_time=end_time
+        )
+
+    async def downsample_sensor_data(
+        self,
+        device_id: str,
+        keys: List[str],
+        max_points: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+    ) -> Dict:
+        return await self.executor.run_read(
+            self.dao.downsample_sensor_data,
+            device_id, keys, max_points,
+            start_time=start_time,
+            end_time=end_time
+        )
+
+    async def get_last_seen(self, device_ids: Optional[List[str]] = None) -> Dict[str, datetime]:
+        return await self.executor.run_read(self.dao.get_last_seen, device_ids)
+
+    async def get_device_list(self) -> List[str]:
+        return await self.executor.run_read(self.dao.get_device_list)
+
+    async def get_device_catalog(self, device_id: Optional[str] = None) -> List[Dict]:
+        return await self.executor.run_read(self.dao.get_device_catalog, device_id)
+
+    async def delete_device_data(self, device_id: str) -> bool:
+        return await self.executor.run_write(self.writer.delete_device_data, device_id)
+
+    async def get_device_json_keys(self, device_id: str) -> List[str]:
+        return await self.executor.run_read(self.dao.get_device_json_keys, device_id)
+
+
+class AsyncAgentDAO:
+    """AgentDAO 的异步版本，所有操作都在数据库线程池里执行"""
+
+    def __init__(self, dao: AgentDAO, executor: DBExecutor = db_executor):
+        self.dao = dao
+        self.executor = executor
+
+    async def create_agent(self, name: str, freq: int, describe: Optional[str] = None):
+        return await self.executor.run_write(self.dao.create_agent, name, freq, describe)
+
+    async def delete_agent(self, name: str) -> bool:
+        return await self.executor.run_write(self.dao.delete_agent, name)
+
+    async def get_agent(self, name: str):
+        # 内存快照有效时直接读取，不经过线程池
+        if self.dao.cache_fresh():
+            return self.dao.get_agent(name)
+        return await self.executor.run_read(self.dao.get_agent, name)
+
+    async def get_all_agents(self) -> Dict[str, Dict]:
+        if self.dao.cache_fresh():
+            return self.dao.get_all_agents()
+        return await self.executor.run_read(self.dao.get_all_agents)
+
+    async def update_agent(self, name: str, freq: Optional[int] = None, describe: Optional[str] = None):
+        return await self.executor.run_write(self.dao.update_agent, name, freq, describe)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from dao.sensor_model import beijing_tz
+
+if TYPE_CHECKING:
+    from dao.iot_data_info import SensorDataDAO
+
+
+# 队列结束标记
+_STOP = object()
+
+
+class IngestWriter:
+    """后台批量写库
+
+    请求只把数据放进有界队列，由一个后台线程攒批后在一个事务里写入，
+    每 batch_size 条或每 flush_interval_ms 毫秒写一次。
+    dao 只需要提供 save_sensor_data_batch，多 worker 部署时是转发给写库进程的 WriterClient。
+    """
+
+    def __init__(
+        self,
+        dao: "SensorDataDAO",
+        batch_size: int = 500,
+        flush_interval_ms: int = 50,
+        max_queue_size: int = 10000
+    ):
+        self.dao = dao
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self._total_rows = 0
+        self._failed_rows = 0
+        self._total_flushes = 0
+        self._last_flush_size = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._sum_flush_ms = 0.0
+
+    def start(self):
+        """启动后台写库线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """停止写库线程，队列里剩余的数据会先写完"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(
+        self,
+        device_id: str,
+        data: Dict,
+        timestamp: Optional[datetime] = None,
+        block: bool = False,
+        timeout: Optional[float] = None
+    ) -> Future:
+        """把一条数据放进写库队列
+
+        Args:
+            block: 队列满时是否等待，默认直接抛出 queue.Full
+            timeout: block 为 True 时最多等待的秒数
+
+        Returns:
+            Future: 写库完成后结果为 True/False
+
+        Raises:
+            queue.Full: 队列已满（或等待超时）
+        """
+        row = {
+            "timestamp": timestamp or datetime.now(beijing_tz),
+            "device_id": device_id,
+            "data_json": data
+        }
+        return self.submit_rows([row], block=block, timeout=timeout)
+
+    def submit_rows(self, rows: List[Dict], block: bool = False, timeout: Optional[float] = None) -> Future:
+        """把一批数据作为队列里的一项放进写库队列，整批和其他数据一起写入，参数和返回值同 submit"""
+        future = Future()
+        self._queue.put((rows, future), block=block, timeout=timeout)
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            count = len(item[0])
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while count < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                count += len(item[0])
+
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        rows = [row for item_rows, _ in batch for row in item_rows]
+        start = time.perf_counter()
+        try:
+            ok = self.dao.save_sensor_data_batch(rows)
+        except Exception as e:
+            print(f"批量写库出错: {e}")
+            ok = False
+        cost_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self._total_flushes += 1
+            self._last_flush_size = len(rows)
+            self._last_flush_ms = cost_ms
+            self._max_flush_ms = max(self._max_flush_ms, cost_ms)
+            self._sum_flush_ms += cost_ms
+            if ok:
+                self._total_rows += len(rows)
+            else:
+                self._failed_rows += len(rows)
+
+        for _, future in batch:
+            future.set_result(ok)
+
+    def stats(self) -> Dict:
+        """队列深度、每批大小、写库耗时等统计"""
+        with self._lock:
+            flushes = self._total_flushes
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "batch_size": self.batch_size,
+                "flush_interval_ms": self.flush_interval * 1000,
+                "total_rows": self._total_rows,
+                "failed_rows": self._failed_rows,
+                "total_flushes": flushes,
+                "last_flush_size": self._last_flush_size,
+                "avg_flush_size": (self._total_rows + self._failed_rows) / flushes if flushes else 0,
+                "last_flush_ms": round(self._last_flush_ms, 3),
+                "avg_flush_ms": round(self._sum_flush_ms / flushes, 3) if flushes else 0,
+                "max_flush_ms": round(self._max_flush_ms, 3)
+            }
@@ -4,39 +4,118 @@ from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from datetime import datetime
-from typing import Dict, Optional, List
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, JSON, Index
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, List, Iterator, Tuple
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Index, Float, insert, delete, func, tuple_, select, case, literal_column, or_, inspect
+from sqlalchemy import MetaData, Table, union_all
+from sqlalchemy.schema import CreateTable, CreateIndex, DropTable
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.sql import text
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.pool import QueuePool
 from contextlib import contextmanager
-import pytz
-from pydantic import BaseModel
 import os
-from config import IOT_DATA_DB
+import calendar
+import math
+import threading
+import time
+from config import IOT_DATA_DB, ROLLUP_ENABLED, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE_MS, PARTITION_PERIOD
+from dao.sqlite_engine import create_sqlite_engines
+from dao.sensor_model import SensorDataModel, beijing_tz
 
-# 数据库配置
-DATABASE_URL = f"sqlite:///{IOT_DATA_DB}"
-beijing_tz = pytz.timezone('Asia/Shanghai')
-
-# SQLAlchemy 基础配置
+# SQLAlchemy 基础配置（写引擎 + 只读引擎，见 config.SQLITE_PROFILE）
 Base = declarative_base()
-engine = create_engine(
-    DATABASE_URL,
-    poolclass=QueuePool,
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
-    pool_pre_ping=True,
-    pool_recycle=3600
-)
+engine, read_engine = create_sqlite_engines(IOT_DATA_DB)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+def parse_timestamp(value) -> datetime:
+    """解析设备上报的时间戳，统一转换为北京时间
+
+    支持 ISO 8601 字符串（不带时区时按北京时间处理）以及秒/毫秒级的 Unix 时间戳
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"invalid timestamp: {value!r}")
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError(f"invalid timestamp: {value!r}")
+        try:
+            # 大于 1e11 的按毫秒处理
+            seconds = value / 1000 if value > 1e11 else value
+            return datetime.fromtimestamp(seconds, beijing_tz)
+        except (OverflowError, OSError) as e:
+            # 超出 datetime / 平台 time_t 范围，如 1e20
+            raise ValueError(f"invalid timestamp: {value!r}") from e
+    if isinstance(value, str):
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            return beijing_tz.localize(dt)
+        return dt.astimezone(beijing_tz)
+    raise ValueError(f"invalid timestamp: {value!r}")
+
+# 聚合时间粒度的单位
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# 支持的聚合函数
+AGGREGATE_FUNCS = ("min", "max", "avg", "sum", "count", "first", "last")
+
+
+def parse_bucket(bucket: str) -> int:
+    """把 "30s"、"1m"、"1h"、"1d" 这样的时间粒度转换为秒数"""
+    bucket = str(bucket).strip().lower()
+    unit = bucket[-1:]
+    if unit not in BUCKET_UNITS or not bucket[:-1].isdigit() or int(bucket[:-1]) <= 0:
+        raise ValueError(f"invalid bucket: {bucket!r}")
+    return int(bucket[:-1]) * BUCKET_UNITS[unit]
+
+
+# 保留策略中的数据层级，raw 为原始数据，其余为预聚合表
+TIERS = {"raw": None, "1m": 60, "1h": 3600, "1d": 86400}
+
+
+def resolve_policy(policies: Dict, device_id: str) -> Dict[str, Optional[int]]:
+    """合并全局和设备的保留策略，返回 {层级: 保留秒数}，None 表示永久保留"""
+    merged = dict(policies.get("*", {}))
+    merged.update(policies.get(device_id, {}))
+    result = {}
+    for tier, keep in merged.items():
+        if tier not in TIERS:
+            raise ValueError(f"unknown retention tier: {tier}")
+        result[tier] = None if keep is None else parse_bucket(keep)
+    return result
+
+
+def to_wall_epoch(dt: datetime) -> int:
+    """把时间转换为"北京时间按 UTC 计算"的秒数
+
+    数据库里存的是不带时区的北京时间，SQLite 的 strftime('%s') 会把它当成 UTC，
+    按这个秒数分桶时，按天聚合正好以北京时间零点为边界
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(beijing_tz).replace(tzinfo=None)
+    return calendar.timegm(dt.timetuple())
+
+
+def from_wall_epoch(seconds: int) -> datetime:
+    """to_wall_epoch 的逆运算，返回不带时区的北京时间"""
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+def to_beijing_naive(dt: datetime) -> datetime:
+    """转换为不带时区的北京时间，与数据库中保存的格式一致"""
+    if dt.tzinfo is not None:
+        return dt.astimezone(beijing_tz).replace(tzinfo=None)
+    return dt
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _json_path(key: str) -> str:
+    """生成 json_extract 使用的路径，键名里的特殊字符用双引号转义"""
+    return '$."' + key.replace('"', '\\"') + '"'
 
-# 数据模型
-class SensorDataModel(BaseModel):
-    device_id: str
-    data: Dict
 
 # 数据库模型
 class SensorData(Base):
@@ -48,13 +127,294 @@ class SensorData(Base):
     data_json = Column(JSON, nullable=False)
 
     __table_args__ = (
-        Index('idx_sensor_data_device_id', 'device_id'),
+        # 按设备查时间范围、取最新 N 条都走这个复合索引，不需要再排序
+        Index('idx_sensor_data_device_ts', 'device_id', 'timestamp'),
         Index('idx_sensor_data_timestamp', 'timestamp'),
     )
 
+# 预聚合表：每个设备、每个数值型键按分钟/小时/天汇总，写入时增量更新
+class SensorDataRollupMixin:
+    device_id = Column(String(64), primary_key=True)
+    key = Column(String(128), primary_key=True)
+    bucket = Column(Integer, primary_key=True)          # 桶起始时间，见 to_wall_epoch
+    count = Column(Integer, nullable=False)
+    sum_value = Column(Float, nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    first_ts = Column(DateTime, nullable=False)
+    first_value = Column(Float, nullable=False)
+    last_ts = Column(DateTime, nullable=False)
+    last_value = Column(Float, nullable=False)
+
+class SensorDataRollupMinute(SensorDataRollupMixin, Base):
+    __tablename__ = 'sensor_data_rollup_1m'
+
+class SensorDataRollupHour(SensorDataRollupMixin, Base):
+    __tablename__ = 'sensor_data_rollup_1h'
+
+class SensorDataRollupDay(SensorDataRollupMixin, Base):
+    __tablename__ = 'sensor_data_rollup_1d'
+
+# (桶大小秒数, 表)，从粗到细
+ROLLUP_TABLES = [
+    (86400, SensorDataRollupDay),
+    (3600, SensorDataRollupHour),
+    (60, SensorDataRollupMinute),
+]
+
+# 设备目录：每个设备的首次/最近上报时间和数据条数，写入时在同一个事务里更新
+class DeviceCatalog(Base):
+    __tablename__ = 'device_catalog'
+
+    device_id = Column(String(64), primary_key=True)
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+    row_count = Column(Integer, nullable=False)
+
+# 每个设备上报过的键，value_type 为最近一次上报的值类型
+class DeviceKey(Base):
+    __tablename__ = 'device_keys'
+
+    device_id = Column(String(64), primary_key=True)
+    key = Column(String(128), primary_key=True)
+    value_type = Column(String(16), nullable=False)
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+
+# 数据库的一些状态标记
+class StorageMeta(Base):
+    __tablename__ = 'storage_meta'
+
+    name = Column(String(64), primary_key=True)
+    value = Column(String(256), nullable=False)
+
 # 创建表
+_is_new_database = not inspect(engine).has_table(SensorData.__tablename__)
 Base.metadata.create_all(bind=engine)
 
+# 新库不需要回填预聚合表和设备目录
+if _is_new_database:
+    with engine.begin() as conn:
+        conn.execute(insert(StorageMeta.__table__).prefix_with("OR IGNORE"), [
+            {"name": "rollups_backfilled", "value": "1"},
+            {"name": "device_catalog_built", "value": "1"},
+        ])
+
+
+def migrate_sensor_data_indexes(bind=engine):
+    """给旧的 iot_data.db 补上 (device_id, timestamp) 复合索引
+
+    create_all 不会给已存在的表加索引，这里手动创建；
+    原来的 device_id 单列索引是复合索引的前缀，创建后删除
+    """
+    with bind.begin() as conn:
+        indexes = {row[1] for row in conn.exec_driver_sql("PRAGMA index_list('sensor_data')")}
+        if "idx_sensor_data_device_ts" not in indexes:
+            print("正在为 sensor_data 创建 (device_id, timestamp) 复合索引...")
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS idx_sensor_data_device_ts ON sensor_data (device_id, timestamp)"
+            )
+            conn.exec_driver_sql("ANALYZE sensor_data")
+        if "idx_sensor_data_device_id" in indexes:
+            conn.exec_driver_sql("DROP INDEX IF EXISTS idx_sensor_data_device_id")
+
+
+migrate_sensor_data_indexes()
+
+
+# 按时间分区（见 config.PARTITION_PERIOD）：每个周期一张与 sensor_data 结构相同的表，
+# 表名为 sensor_data_p<YYYYMM> 或 sensor_data_p<YYYYMMDD>（北京时间）。
+# sensor_data 只保存开启分区之前的数据，用 tools/partition_db.py 迁移到分区表后为空。
+# 每个分区的 id 单独自增，(timestamp, id) 在所有分区里仍然唯一
+PARTITION_PREFIX = "sensor_data_p"
+_partition_metadata = MetaData()
+_partition_tables: Dict[str, Table] = {}
+_partition_lock = threading.Lock()
+_partition_names: Tuple[Optional[int], List[str]] = (None, [])     # (schema_version, 分区表名)
+
+
+def partition_name(ts: datetime, period: str = None) -> str:
+    """数据所在分区的表名"""
+    period = period or PARTITION_PERIOD
+    return PARTITION_PREFIX + to_beijing_naive(ts).strftime("%Y%m%d" if period == "day" else "%Y%m")
+
+
+def partition_range(name: str) -> Tuple[datetime, datetime]:
+    """分区覆盖的时间范围 [start, end)，不带时区的北京时间"""
+    suffix = name[len(PARTITION_PREFIX):]
+    if len(suffix) == 8:
+        start = datetime.strptime(suffix, "%Y%m%d")
+        return start, start + timedelta(days=1)
+    start = datetime.strptime(suffix, "%Y%m")
+    return start, start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def partition_table(name: str) -> Table:
+    """分区表的定义，列和索引与 sensor_data 相同"""
+    table = _partition_tables.get(name)
+    if table is None:
+        with _partition_lock:
+            table = _partition_tables.get(name)
+            if table is None:
+                table = _partition_tables[name] = Table(
+                    name, _partition_metadata,
+                    Column("id", Integer, primary_key=True, autoincrement=True),
+                    Column("timestamp", DateTime, nullable=False),
+                    Column("device_id", String(64), nullable=False),
+                    Column("data_json", JSON, nullable=False),
+                    Index(f"idx_{name}_device_ts", "device_id", "timestamp"),
+                    Index(f"idx_{name}_timestamp", "timestamp"),
+                )
+    return table
+
+
+def create_partition(conn, name: str) -> Table:
+    """创建分区表（已存在时不做任何事），其他进程可能同时创建同一个分区"""
+    table = partition_table(name)
+    conn.execute(CreateTable(table, if_not_exists=True))
+    for index in table.indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+    return table
+
+
+def list_partitions(conn) -> List[str]:
+    """库里已有的分区表名（按时间升序），schema_version 变化时重新读取，能发现其他进程新建的分区"""
+    global _partition_names
+    version = conn.exec_driver_sql("PRAGMA schema_version").scalar()
+    cached_version, names = _partition_names
+    if version != cached_version:
+        names = sorted(
+            (row[0] for row in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'sensor_data_p%'"
+            ) if row[0][len(PARTITION_PREFIX):].isdigit()),
+            key=partition_range
+        )
+        _partition_names = (version, names)
+    return names
+
+
+def json_value_type(value) -> str:
+    """设备目录里记录的值类型"""
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, list):
+        return "array"
+    return "null"
+
+
+def rebuild_device_catalog(bind=engine):
+    """根据原始数据重建设备目录，旧库第一次启动时执行一次（需要扫描全表）"""
+    with bind.begin() as conn:
+        print("正在根据已有数据生成设备目录...")
+        conn.execute(delete(DeviceKey.__table__))
+        conn.execute(delete(DeviceCatalog.__table__))
+        conn.execute(text("""
+            INSERT INTO device_catalog (device_id, first_seen, last_seen, row_count)
+            SELECT device_id, min(timestamp), max(timestamp), count(*)
+            FROM sensor_data
+            GROUP BY device_id
+        """))
+        # 同一个键出现过多种类型时，按最近出现时间升序写入，最后写入的（最近的）类型生效
+        conn.execute(text("""
+            INSERT INTO device_keys (device_id, key, value_type, first_seen, last_seen)
+            SELECT s.device_id, j.key,
+                   CASE j.type WHEN 'integer' THEN 'number' WHEN 'real' THEN 'number'
+                               WHEN 'true' THEN 'boolean' WHEN 'false' THEN 'boolean'
+                               WHEN 'text' THEN 'string' ELSE j.type END AS value_type,
+                   min(s.timestamp), max(s.timestamp)
+            FROM sensor_data s, json_each(s.data_json) j
+            WHERE json_type(s.data_json) = 'object'
+            GROUP BY s.device_id, j.key, value_type
+            ORDER BY max(s.timestamp)
+            ON CONFLICT (device_id, key) DO UPDATE SET
+                value_type = excluded.value_type,
+                first_seen = min(first_seen, excluded.first_seen),
+                last_seen = max(last_seen, excluded.last_seen)
+        """))
+        conn.execute(
+            sqlite_insert(StorageMeta.__table__)
+            .values(name="device_catalog_built", value="1")
+            .on_conflict_do_update(index_elements=["name"], set_={"value": "1"})
+        )
+
+
+with engine.connect() as _conn:
+    _catalog_built = _conn.execute(
+        select(StorageMeta.value).where(StorageMeta.name == "device_catalog_built")
+    ).scalar() == "1"
+if not _catalog_built:
+    rebuild_device_catalog()
+
+# 预聚合表是否可用，回填完成后就不会再变
+_rollups_ready = False
+
+# 写入/删除提交后的回调，所有 SensorDataDAO 实例共用，HTTP 和 MQTT 写入都会触发
+_ingest_listeners: List[Callable[[List[Dict]], None]] = []
+_delete_listeners: List[Callable[[str, bool], None]] = []
+
+
+def add_ingest_listener(listener: Callable[[List[Dict]], None]):
+    """注册写入回调，参数为刚提交的数据行（timestamp、device_id、data_json）
+
+    回调在写库线程里同步执行，不能阻塞
+    """
+    _ingest_listeners.append(listener)
+
+
+def add_delete_listener(listener: Callable[[str, bool], None]):
+    """注册删除回调，参数为设备ID和该设备的数据是否已全部删除"""
+    _delete_listeners.append(listener)
+
+
+def remove_listener(listener):
+    for listeners in (_ingest_listeners, _delete_listeners):
+        if listener in listeners:
+            listeners.remove(listener)
+
+
+# 按键读取的存储（见 dao/storage.py），为 None 时直接查 sensor_data 表；只用于聚合、降采样和按键扫描，
+# 按行查询、分页和流式导出始终读 sensor_data 表
+_read_store = None
+
+
+def set_read_store(store):
+    """设置聚合、降采样和按键扫描使用的存储，如列式副本 ColumnarStore"""
+    global _read_store
+    _read_store = store
+
+
+# 数据保留策略（config.RETENTION_POLICIES），聚合时不使用已经过期的预聚合数据
+_retention_policies: Dict = {}
+
+
+def set_retention_policies(policies: Dict):
+    global _retention_policies
+    _retention_policies = policies or {}
+
+
+def _notify(listeners, *args):
+    for listener in list(listeners):
+        try:
+            listener(*args)
+        except Exception as e:
+            print(f"执行数据回调出错: {e}")
+
+
+def notify_ingest(rows: List[Dict]):
+    """数据由其他进程写入时（见 writer_server.py），在本进程触发写入回调"""
+    _notify(_ingest_listeners, rows)
+
+
+def notify_delete(device_id: str, device_removed: bool):
+    """数据由其他进程删除时，在本进程触发删除回调"""
+    _notify(_delete_listeners, device_id, device_removed)
+
 # DAO 类
 class SensorDataDAO:
     
@@ -71,20 +431,284 @@ class SensorDataDAO:
         finally:
             db.close()
 
+    @contextmanager
+    def get_read_db(self):
+        """提供只读数据库会话上下文"""
+        db = ReadSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
     def save_sensor_data(self, sensor_data: SensorDataModel) -> bool:
         """保存传感器数据到数据库"""
         try:
             with self.get_db() as db:
-                db_data = SensorData(
-                    device_id=sensor_data.device_id,
-                    data_json=sensor_data.data
-                )
-                db.add(db_data)
+                rows = [{
+                    "timestamp": datetime.now(beijing_tz),
+                    "device_id": sensor_data.device_id,
+                    "data_json": sensor_data.data
+                }]
+                self._insert_rows(db, rows)
+                self._update_rollups(db, rows)
+                self._update_catalog(db, rows)
+            _notify(_ingest_listeners, rows)
             return True
         except SQLAlchemyError as e:
             print(f"保存数据到数据库失败: {str(e)}")
             return False
 
+    def save_sensor_data_batch(self, rows: List[Dict]) -> bool:
+        """在一个事务里批量保存传感器数据（executemany）
+
+        Args:
+            rows: 每条包含 device_id、data_json，可选 timestamp
+
+        Returns:
+            bool: 整批是否写入成功
+        """
+        if not rows:
+            return True
+        try:
+            with self.get_db() as db:
+                now = datetime.now(beijing_tz)
+                rows = [
+                    {
+                        "timestamp": row.get("timestamp") or now,
+                        "device_id": row["device_id"],
+                        "data_json": row["data_json"]
+                    }
+                    for row in rows
+                ]
+                self._insert_rows(db, rows)
+                self._update_rollups(db, rows)
+                self._update_catalog(db, rows)
+            _notify(_ingest_listeners, rows)
+            return True
+        except SQLAlchemyError as e:
+            print(f"批量保存数据到数据库失败: {str(e)}")
+            return False
+
+    def _insert_rows(self, db, rows: List[Dict]):
+        """写入原始数据，开启分区时按时间写入各自的分区表，分区不存在时先创建"""
+        if not PARTITION_PERIOD:
+            db.execute(insert(SensorData.__table__), rows)
+            return
+        groups: Dict[str, List[Dict]] = {}
+        for row in rows:
+            groups.setdefault(partition_name(row["timestamp"]), []).append(row)
+        existing = set(list_partitions(db.connection()))
+        for name, part_rows in groups.items():
+            table = partition_table(name) if name in existing else create_partition(db.connection(), name)
+            db.execute(insert(table), part_rows)
+
+    def raw_tables(self, db, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None) -> List[Table]:
+        """与 [start_time, end_time] 有重叠的原始数据表：sensor_data 和对应的分区表"""
+        start = None if start_time is None else to_beijing_naive(start_time)
+        end = None if end_time is None else to_beijing_naive(end_time)
+        tables = [SensorData.__table__]
+        for name in list_partitions(db.connection()):
+            low, high = partition_range(name)
+            if (end is None or low <= end) and (start is None or high > start):
+                tables.append(partition_table(name))
+        return tables
+
+    def sensor_data_source(self, db, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None):
+        """查询原始数据用的表，列与 sensor_data 相同，在 SQL 里的名字也是 sensor_data
+
+        没有分区时就是 sensor_data；有分区时只包含与 [start_time, end_time] 有重叠的分区（分区裁剪），
+        sensor_data 里还有未迁移的数据时也包含进来，多张表用 UNION ALL 合并
+        """
+        tables = self.raw_tables(db, start_time, end_time)
+        if len(tables) == 1:
+            return tables[0]
+        if db.execute(select(SensorData.id).limit(1)).first() is None:
+            tables = tables[1:]
+        if len(tables) == 1:
+            return tables[0].alias("sensor_data")
+        return union_all(*(
+            select(t.c.id, t.c.timestamp, t.c.device_id, t.c.data_json) for t in tables
+        )).subquery("sensor_data")
+
+    def _update_rollups(self, db, rows: List[Dict]):
+        """在写入原始数据的同一个事务里增量更新预聚合表
+
+        先在内存里按 (表, 设备, 键, 桶) 合并，每张表只执行一次 executemany 的 UPSERT
+        """
+        if not ROLLUP_ENABLED:
+            return
+        for bucket_seconds, table in ROLLUP_TABLES:
+            merged = {}
+            for row in rows:
+                data = row["data_json"]
+                if not isinstance(data, dict):
+                    continue
+                ts = to_beijing_naive(row["timestamp"])
+                bucket = to_wall_epoch(ts) // bucket_seconds * bucket_seconds
+                for key, value in data.items():
+                    if not is_number(value):
+                        continue
+                    item = merged.get((row["device_id"], key, bucket))
+                    if item is None:
+                        merged[(row["device_id"], key, bucket)] = {
+                            "device_id": row["device_id"], "key": key, "bucket": bucket,
+                            "count": 1, "sum_value": value, "min_value": value, "max_value": value,
+                            "first_ts": ts, "first_value": value, "last_ts": ts, "last_value": value
+                        }
+                        continue
+                    item["count"] += 1
+                    item["sum_value"] += value
+                    item["min_value"] = min(item["min_value"], value)
+                    item["max_value"] = max(item["max_value"], value)
+                    if ts < item["first_ts"]:
+                        item["first_ts"], item["first_value"] = ts, value
+                    if ts >= item["last_ts"]:
+                        item["last_ts"], item["last_value"] = ts, value
+            if not merged:
+                continue
+
+            t = table.__table__
+            stmt = sqlite_insert(t)
+            excluded = stmt.excluded
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[t.c.device_id, t.c.key, t.c.bucket],
+                set_={
+                    "count": t.c.count + excluded.count,
+                    "sum_value": t.c.sum_value + excluded.sum_value,
+                    "min_value": func.min(t.c.min_value, excluded.min_value),
+                    "max_value": func.max(t.c.max_value, excluded.max_value),
+                    "first_ts": case((excluded.first_ts < t.c.first_ts, excluded.first_ts), else_=t.c.first_ts),
+                    "first_value": case((excluded.first_ts < t.c.first_ts, excluded.first_value), else_=t.c.first_value),
+                    "last_ts": case((excluded.last_ts >= t.c.last_ts, excluded.last_ts), else_=t.c.last_ts),
+                    "last_value": case((excluded.last_ts >= t.c.last_ts, excluded.last_value), else_=t.c.last_value),
+                }
+            )
+            db.execute(stmt, list(merged.values()))
+
+    def _update_catalog(self, db, rows: List[Dict]):
+        """在写入原始数据的同一个事务里更新设备目录和键目录"""
+        devices = {}
+        keys = {}
+        for row in rows:
+            ts = to_beijing_naive(row["timestamp"])
+            device_id = row["device_id"]
+            item = devices.get(device_id)
+            if item is None:
+                devices[device_id] = {"device_id": device_id, "first_seen": ts, "last_seen": ts, "row_count": 1}
+            else:
+                item["row_count"] += 1
+                item["first_seen"] = min(item["first_seen"], ts)
+                item["last_seen"] = max(item["last_seen"], ts)
+
+            data = row["data_json"]
+            if not isinstance(data, dict):
+                continue
+            for key, value in data.items():
+                item = keys.get((device_id, key))
+                if item is None:
+                    keys[(device_id, key)] = {
+                        "device_id": device_id, "key": key, "value_type": json_value_type(value),
+                        "first_seen": ts, "last_seen": ts
+                    }
+                    continue
+                item["first_seen"] = min(item["first_seen"], ts)
+                if ts >= item["last_seen"]:
+                    item["last_seen"], item["value_type"] = ts, json_value_type(value)
+
+        t = DeviceCatalog.__table__
+        stmt = sqlite_insert(t)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[t.c.device_id],
+            set_={
+                "row_count": t.c.row_count + stmt.excluded.row_count,
+                "first_seen": func.min(t.c.first_seen, stmt.excluded.first_seen),
+                "last_seen": func.max(t.c.last_seen, stmt.excluded.last_seen),
+            }
+        )
+        db.execute(stmt, list(devices.values()))
+
+        if keys:
+            t = DeviceKey.__table__
+            stmt = sqlite_insert(t)
+            excluded = stmt.excluded
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[t.c.device_id, t.c.key],
+                set_={
+                    "value_type": case((excluded.last_seen >= t.c.last_seen, excluded.value_type), else_=t.c.value_type),
+                    "first_seen": func.min(t.c.first_seen, excluded.first_seen),
+                    "last_seen": func.max(t.c.last_seen, excluded.last_seen),
+                }
+            )
+            db.execute(stmt, list(keys.values()))
+
+    def rollups_ready(self) -> bool:
+        """预聚合表是否已经覆盖全部历史数据（新库或回填过）"""
+        global _rollups_ready
+        if not _rollups_ready:
+            with self.get_read_db() as db:
+                _rollups_ready = db.query(StorageMeta.value)\
+                                   .filter(StorageMeta.name == "rollups_backfilled")\
+                                   .scalar() == "1"
+        return _rollups_ready
+
+    def rebuild_rollups(self, device_id: Optional[str] = None) -> int:
+        """根据原始数据重建预聚合表，用于已有数据的旧库
+
+        每个设备、每个粒度一个事务，先删除再用 SQL 重新汇总。
+
+        Args:
+            device_id: 只重建指定设备，默认全部设备
+
+        Returns:
+            int: 重建的设备数
+        """
+        devices = [device_id] if device_id else self.get_device_list()
+        for device in devices:
+            for bucket_seconds, table in ROLLUP_TABLES:
+                with self.get_db() as db:
+                    source = " UNION ALL ".join(
+                        f"SELECT id, timestamp, device_id, data_json FROM {t.name}" for t in self.raw_tables(db)
+                    )
+                    db.execute(delete(table.__table__).where(table.__table__.c.device_id == device))
+                    db.execute(
+                        text(f"""
+                            INSERT INTO {table.__tablename__}
+                                (device_id, key, bucket, count, sum_value, min_value, max_value,
+                                 first_ts, first_value, last_ts, last_value)
+                            SELECT device_id, key, bucket, count(*), sum(value), min(value), max(value),
+                                   min(timestamp),
+                                   max(CASE WHEN rn_first = 1 THEN value END),
+                                   max(timestamp),
+                                   max(CASE WHEN rn_last = 1 THEN value END)
+                            FROM (
+                                SELECT s.device_id, j.key, j.value, s.timestamp,
+                                       CAST(strftime('%s', s.timestamp) AS INTEGER) / :size * :size AS bucket,
+                                       ROW_NUMBER() OVER w_first AS rn_first,
+                                       ROW_NUMBER() OVER w_last AS rn_last
+                                FROM ({source}) s, json_each(s.data_json) j
+                                WHERE s.device_id = :device_id AND j.type IN ('integer', 'real')
+                                WINDOW w_first AS (
+                                           PARTITION BY j.key, CAST(strftime('%s', s.timestamp) AS INTEGER) / :size
+                                           ORDER BY s.timestamp, s.id),
+                                       w_last AS (
+                                           PARTITION BY j.key, CAST(strftime('%s', s.timestamp) AS INTEGER) / :size
+                                           ORDER BY s.timestamp DESC, s.id DESC)
+                            )
+                            GROUP BY device_id, key, bucket
+                        """),
+                        {"device_id": device, "size": bucket_seconds}
+                    )
+            print(f"已重建设备 {device} 的预聚合数据")
+
+        if device_id is None:
+            with self.get_db() as db:
+                db.execute(
+                    sqlite_insert(StorageMeta.__table__)
+                    .values(name="rollups_backfilled", value="1")
+                    .on_conflict_do_update(index_elements=["name"], set_={"value": "1"})
+                )
+        return len(devices)
+
     def query_sensor_data(
         self,
         device_id: Optional[str] = None,
@@ -93,21 +717,74 @@ class SensorDataDAO:
         limit: Optional[int] = None
     ) -> List[Dict]:
         """查询传感器数据"""
-        with self.get_db() as db:
-            query = db.query(SensorData)
-            
+        with self.get_read_db() as db:
+            query = self._sensor_data_query(db, device_id, start_time, end_time, limit)
+            return [
+                {
+                    "id": record.id,
+                    "timestamp": record.timestamp.isoformat(),
+                    "device_id": record.device_id,
+                    "data": record.data_json
+                }
+                for record in db.execute(query)
+            ]
+
+    def iter_sensor_data(
+        self,
+        device_id: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        batch_size: int = 1000
+    ) -> Iterator[Dict]:
+        """逐条返回传感器数据，底层按 batch_size 分批从游标读取，内存占用与结果总量无关"""
+        with self.get_read_db() as db:
+            query = self._sensor_data_query(db, device_id, start_time, end_time, None)
+            for record in db.execute(query.execution_options(yield_per=batch_size)):
+                yield {
+                    "id": record.id,
+                    "timestamp": record.timestamp.isoformat(),
+                    "device_id": record.device_id,
+                    "data": record.data_json
+                }
+
+    def query_sensor_data_page(
+        self,
+        device_id: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        page_size: int = 1000,
+        cursor: Optional[Tuple[datetime, int]] = None
+    ) -> Tuple[List[Dict], Optional[Tuple[datetime, int]]]:
+        """按 (timestamp, id) 倒序分页查询，不使用 OFFSET
+
+        Args:
+            cursor: 上一页最后一条的 (timestamp, id)，第一页传 None
+
+        Returns:
+            (当前页数据, 下一页的 cursor)，没有下一页时 cursor 为 None
+        """
+        with self.get_read_db() as db:
+            # 翻页时只需要 cursor 之前的分区
+            upper = end_time
+            if cursor and (end_time is None or to_beijing_naive(cursor[0]) < to_beijing_naive(end_time)):
+                upper = cursor[0]
+            t = self.sensor_data_source(db, start_time, upper).c
+            query = select(t.id, t.timestamp, t.device_id, t.data_json)
             if device_id:
-                query = query.filter(SensorData.device_id == device_id)
+                query = query.where(t.device_id == device_id)
             if start_time:
-                query = query.filter(SensorData.timestamp >= start_time)
+                query = query.where(t.timestamp >= start_time)
             if end_time:
-                query = query.filter(SensorData.timestamp <= end_time)
-                
-            query = query.order_by(SensorData.timestamp.desc())
-            
-            if limit:
-                query = query.limit(limit)
-                
+                query = query.where(t.timestamp <= end_time)
+            if cursor:
+                query = query.where(tuple_(t.timestamp, t.id) < tuple_(*cursor))
+            # 多取一条用来判断是否还有下一页
+            records = db.execute(query.order_by(t.timestamp.desc(), t.id.desc()).limit(page_size + 1)).all()
+
+            next_cursor = None
+            if len(records) > page_size:
+                records = records[:page_size]
+                next_cursor = (records[-1].timestamp, records[-1].id)
             return [
                 {
                     "id": record.id,
@@ -115,17 +792,403 @@ class SensorDataDAO:
                     "device_id": record.device_id,
                     "data": record.data_json
                 }
-                for record in query
-            ]
+                for record in records
+            ], next_cursor
+
+    def _sensor_data_query(self, db, device_id, start_time, end_time, limit):
+        """构建 query_sensor_data 使用的查询，explain_sensor_data_query 也用它"""
+        t = self.sensor_data_source(db, start_time, end_time).c
+        query = select(t.id, t.timestamp, t.device_id, t.data_json)
+        
+        if device_id:
+            query = query.where(t.device_id == device_id)
+        if start_time:
+            query = query.where(t.timestamp >= start_time)
+        if end_time:
+            query = query.where(t.timestamp <= end_time)
+            
+        query = query.order_by(t.timestamp.desc())
+        
+        if limit:
+            query = query.limit(limit)
+        return query
+
+    def get_latest_timestamp(self, device_id: str, start_time: Optional[datetime] = None) -> Optional[datetime]:
+        """获取设备最近一条数据的时间，只读复合索引，不回表
+
+        服务端的健康检查已经改为读 device_catalog.last_seen，不再调用这个方法；
+        只留给工具使用：tools/check_query_plan.py 检查它的执行计划（explain_latest_timestamp），
+        tools/bench_health_check.py 用它还原原来逐个 agent 查询的实现做对比。
+
+        Args:
+            device_id: 设备ID
+            start_time: 只看这个时间之后的数据
+
+        Returns:
+            最近一条数据的时间，没有数据时返回 None
+        """
+        with self.get_read_db() as db:
+            t = self.sensor_data_source(db, start_time).c
+            query = select(func.max(t.timestamp)).where(t.device_id == device_id)
+            if start_time:
+                query = query.where(t.timestamp >= start_time)
+            return db.execute(query).scalar()
+
+    def explain_sensor_data_query(
+        self,
+        device_id: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        limit: Optional[int] = None
+    ) -> List[str]:
+        """返回 query_sensor_data 对应 SQL 的 EXPLAIN QUERY PLAN 结果"""
+        with self.get_read_db() as db:
+            query = self._sensor_data_query(db, device_id, start_time, end_time, limit)
+            return self._explain(db, query)
+
+    def explain_latest_timestamp(self, device_id: str) -> List[str]:
+        """返回 get_latest_timestamp 对应 SQL 的 EXPLAIN QUERY PLAN 结果，只用于 tools/check_query_plan.py"""
+        with self.get_read_db() as db:
+            t = self.sensor_data_source(db).c
+            return self._explain(db, select(func.max(t.timestamp)).where(t.device_id == device_id))
+
+    def _explain(self, db, statement) -> List[str]:
+        compiled = statement.compile(dialect=db.get_bind().dialect)
+        params = []
+        for name in compiled.positiontup:
+            value = compiled.params[name]
+            # 执行计划与参数值无关，时间直接转成字符串
+            params.append(value.isoformat(" ") if isinstance(value, datetime) else value)
+        rows = db.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", tuple(params))
+        return [row[-1] for row in rows]
     
+    def _bucketed_subquery(self, db, device_id, keys, bucket_seconds, start_time, end_time,
+                           rank_bounds=True, rank_extremes=False):
+        """按时间桶编号、每个键取出数值，供聚合和降采样使用
+
+        输出列：bucket、timestamp、v{i}（第 i 个键的数值，非数值为 NULL）；
+        rank_bounds 时有 rn_first / rn_last（桶内正序/倒序编号），rank_extremes 时
+        还有每个键的 rn_min{i} / rn_max{i}（桶内按数值排序的编号）
+        """
+        t = self.sensor_data_source(db, start_time, end_time).c
+        bucket = literal_column(
+            f"CAST(strftime('%s', sensor_data.timestamp) AS INTEGER) / {int(bucket_seconds)}"
+        )
+        values = []
+        for key in keys:
+            path = _json_path(key)
+            values.append(case(
+                (func.json_type(t.data_json, path).in_(("integer", "real")),
+                 func.json_extract(t.data_json, path))
+            ))
+
+        columns = [bucket.label("bucket"), t.timestamp.label("timestamp")]
+        columns += [value.label(f"v{i}") for i, value in enumerate(values)]
+        if rank_bounds:
+            columns.append(func.row_number().over(
+                partition_by=bucket, order_by=(t.timestamp, t.id)
+            ).label("rn_first"))
+            columns.append(func.row_number().over(
+                partition_by=bucket, order_by=(t.timestamp.desc(), t.id.desc())
+            ).label("rn_last"))
+        if rank_extremes:
+            for i, value in enumerate(values):
+                # NULL 排在最后，保证编号为 1 的是真实数值
+                columns.append(func.row_number().over(
+                    partition_by=bucket, order_by=(value.is_(None), value)
+                ).label(f"rn_min{i}"))
+                columns.append(func.row_number().over(
+                    partition_by=bucket, order_by=(value.is_(None), value.desc())
+                ).label(f"rn_max{i}"))
+
+        query = select(*columns).where(t.device_id == device_id)
+        if start_time is not None:
+            query = query.where(t.timestamp >= start_time)
+        if end_time is not None:
+            query = query.where(t.timestamp < end_time)
+        return query.subquery()
+
+    def aggregate_sensor_data(
+        self,
+        device_id: str,
+        keys: List[str],
+        bucket_seconds: int,
+        funcs: List[str],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+    ) -> Dict:
+        """按时间桶在 SQL 里聚合数值型的键
+
+        起止时间会对齐到桶的边界，返回的每个桶都是完整的。
+
+        Returns:
+            {"bucket_seconds", "timestamps": [桶起始时间], "series": {键: {函数: [值]}}}
+        """
+        for name in funcs:
+            if name not in AGGREGATE_FUNCS:
+                raise ValueError(f"unsupported aggregate function: {name}")
+
+        start_wall = None if start_time is None else to_wall_epoch(start_time) // bucket_seconds * bucket_seconds
+        end_wall = None if end_time is None else -(-to_wall_epoch(end_time) // bucket_seconds) * bucket_seconds
+        if end_wall is not None and end_wall == start_wall:
+            end_wall += bucket_seconds
+
+        # 桶大小是某个预聚合粒度的整数倍时，直接从最粗的那张预聚合表汇总；
+        # 起始时间早于这一层保留期的跳过，改用更粗的层或原始数据
+        if ROLLUP_ENABLED and keys and self.rollups_ready():
+            for rollup_seconds, table in ROLLUP_TABLES:
+                if bucket_seconds % rollup_seconds == 0 and self._rollup_retained(device_id, rollup_seconds, start_wall):
+                    return self._aggregate_from_rollup(
+                        table, device_id, keys, bucket_seconds, funcs, start_wall, end_wall
+                    )
+
+        if _read_store is not None:
+            return _read_store.aggregate(device_id, keys, bucket_seconds, funcs, start_wall, end_wall)
+
+        with self.get_read_db() as db:
+            sub = self._bucketed_subquery(
+                db, device_id, keys, bucket_seconds,
+                None if start_wall is None else from_wall_epoch(start_wall),
+                None if end_wall is None else from_wall_epoch(end_wall),
+                rank_bounds="first" in funcs or "last" in funcs
+            )
+
+            columns = [sub.c.bucket]
+            for i in range(len(keys)):
+                value = sub.c[f"v{i}"]
+                for name in funcs:
+                    if name == "first":
+                        expr = func.max(case((sub.c.rn_first == 1, value)))
+                    elif name == "last":
+                        expr = func.max(case((sub.c.rn_last == 1, value)))
+                    else:
+                        expr = getattr(func, name)(value)
+                    columns.append(expr.label(f"{name}_{i}"))
+
+            rows = db.execute(select(*columns).group_by(sub.c.bucket).order_by(sub.c.bucket)).all()
+
+        series = {key: {name: [] for name in funcs} for key in keys}
+        timestamps = []
+        for row in rows:
+            timestamps.append(from_wall_epoch(row.bucket * bucket_seconds).isoformat())
+            for i, key in enumerate(keys):
+                for name in funcs:
+                    series[key][name].append(row._mapping[f"{name}_{i}"])
+        return {"bucket_seconds": bucket_seconds, "timestamps": timestamps, "series": series, "source": "raw"}
+
+    @staticmethod
+    def _rollup_retained(device_id: str, rollup_seconds: int, start_wall: Optional[int]) -> bool:
+        """预聚合表在保留策略下是否还有从 start_wall 开始的完整数据"""
+        tier = next(name for name, seconds in TIERS.items() if seconds == rollup_seconds)
+        keep = resolve_policy(_retention_policies, device_id).get(tier)
+        if keep is None:
+            return True
+        return start_wall is not None and start_wall >= to_wall_epoch(datetime.now(beijing_tz)) - keep
+
+    def _aggregate_from_rollup(self, table, device_id, keys, bucket_seconds, funcs, start_wall, end_wall) -> Dict:
+        """从预聚合表二次汇总，返回格式与 aggregate_sensor_data 相同"""
+        t = table.__table__
+        group = literal_column(f"{t.name}.bucket / {int(bucket_seconds)}")
+        query = select(
+            t.c.key,
+            group.label("grp"),
+            t.c["count"], t.c.sum_value, t.c.min_value, t.c.max_value, t.c.first_value, t.c.last_value,
+            func.row_number().over(partition_by=(t.c.key, group), order_by=t.c.first_ts).label("rn_first"),
+            func.row_number().over(partition_by=(t.c.key, group), order_by=t.c.last_ts.desc()).label("rn_last")
+        ).where(t.c.device_id == device_id).where(t.c.key.in_(keys))
+        if start_wall is not None:
+            query = query.where(t.c.bucket >= start_wall)
+        if end_wall is not None:
+            query = query.where(t.c.bucket < end_wall)
+        sub = query.subquery()
+
+        total = func.sum(sub.c["count"])
+        exprs = {
+            "min": func.min(sub.c.min_value),
+            "max": func.max(sub.c.max_value),
+            "avg": func.sum(sub.c.sum_value) / total,
+            "sum": func.sum(sub.c.sum_value),
+            "count": total,
+            "first": func.max(case((sub.c.rn_first == 1, sub.c.first_value))),
+            "last": func.max(case((sub.c.rn_last == 1, sub.c.last_value))),
+        }
+        columns = [sub.c.key, sub.c.grp] + [exprs[name].label(name) for name in funcs]
+
+        with self.get_read_db() as db:
+            rows = db.execute(select(*columns).group_by(sub.c.key, sub.c.grp)).all()
+
+        groups = sorted({row.grp for row in rows})
+        position = {grp: i for i, grp in enumerate(groups)}
+        series = {
+            key: {name: [0 if name == "count" else None] * len(groups) for name in funcs}
+            for key in keys
+        }
+        for row in rows:
+            for name in funcs:
+                series[row.key][name][position[row.grp]] = row._mapping[name]
+        return {
+            "bucket_seconds": bucket_seconds,
+            "timestamps": [from_wall_epoch(grp * bucket_seconds).isoformat() for grp in groups],
+            "series": series,
+            "source": t.name
+        }
+
+    def downsample_sensor_data(
+        self,
+        device_id: str,
+        keys: List[str],
+        max_points: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+    ) -> Dict:
+        """M4 降采样：每个桶保留首、尾、最小、最大四个点，折线形状与原始数据一致
+
+        桶的数量为 max_points / 4，每个键最多返回 max_points 个点。
+
+        Returns:
+            {"bucket_seconds", "series": {键: {"timestamps": [...], "values": [...]}}}
+        """
+        if _read_store is not None:
+            return _read_store.downsample(device_id, keys, max_points, start_time, end_time)
+        with self.get_read_db() as db:
+            if start_time is None or end_time is None:
+                t = self.sensor_data_source(db, start_time, end_time).c
+                first, last = db.execute(
+                    select(func.min(t.timestamp), func.max(t.timestamp)).where(t.device_id == device_id)
+                ).one()
+                start_time = start_time or first
+                end_time = end_time or last
+            if start_time is None or end_time is None:
+                return {"bucket_seconds": None, "series": {key: {"timestamps": [], "values": []} for key in keys}}
+
+            # 桶按整秒对齐，区间两端可能各多出半个桶，这里预留一个桶
+            span = max(1, to_wall_epoch(end_time) - to_wall_epoch(start_time))
+            bucket_seconds = max(1, math.ceil(span / max(1, max_points // 4 - 1)))
+            sub = self._bucketed_subquery(
+                db, device_id, keys, bucket_seconds, start_time, end_time + timedelta(microseconds=1), rank_extremes=True
+            )
+
+            # 只取每个桶里首、尾、最小、最大的行，其余的行在 SQL 里就过滤掉
+            picked = [sub.c.rn_first == 1, sub.c.rn_last == 1]
+            for i in range(len(keys)):
+                picked += [sub.c[f"rn_min{i}"] == 1, sub.c[f"rn_max{i}"] == 1]
+            rows = db.execute(select(sub).where(or_(*picked)).order_by(sub.c.timestamp)).all()
+
+        series = {}
+        for i, key in enumerate(keys):
+            timestamps, values = [], []
+            for row in rows:
+                m = row._mapping
+                value = m[f"v{i}"]
+                if value is None:
+                    continue
+                if m["rn_first"] == 1 or m["rn_last"] == 1 or m[f"rn_min{i}"] == 1 or m[f"rn_max{i}"] == 1:
+                    timestamps.append(m["timestamp"].isoformat())
+                    values.append(value)
+            series[key] = {"timestamps": timestamps, "values": values}
+        return {"bucket_seconds": bucket_seconds, "series": series}
+
     def get_device_list(self) -> List[str]:
-        """获取所有设备的唯一ID列表"""
-        with self.get_db() as db:
-            devices = db.query(SensorData.device_id).distinct().all()
+        """获取所有设备的唯一ID列表（读设备目录，不扫描原始数据）"""
+        with self.get_read_db() as db:
+            devices = db.query(DeviceCatalog.device_id).order_by(DeviceCatalog.device_id).all()
             return [device[0] for device in devices]
+
+    def get_device_catalog(self, device_id: Optional[str] = None) -> List[Dict]:
+        """获取设备目录，包括每个设备的首次/最近上报时间、数据条数和上报过的键
+
+        Args:
+            device_id: 只查询指定设备，默认全部设备
+        """
+        with self.get_read_db() as db:
+            devices = db.query(DeviceCatalog).order_by(DeviceCatalog.device_id)
+            keys = db.query(DeviceKey).order_by(DeviceKey.device_id, DeviceKey.key)
+            if device_id:
+                devices = devices.filter(DeviceCatalog.device_id == device_id)
+                keys = keys.filter(DeviceKey.device_id == device_id)
+
+            catalog = {
+                device.device_id: {
+                    "device_id": device.device_id,
+                    "first_seen": device.first_seen.isoformat(),
+                    "last_seen": device.last_seen.isoformat(),
+                    "row_count": device.row_count,
+                    "keys": []
+                }
+                for device in devices
+            }
+            for key in keys:
+                if key.device_id in catalog:
+                    catalog[key.device_id]["keys"].append({
+                        "key": key.key,
+                        "value_type": key.value_type,
+                        "first_seen": key.first_seen.isoformat(),
+                        "last_seen": key.last_seen.isoformat()
+                    })
+            return list(catalog.values())
+
+    def get_last_seen(self, device_ids: Optional[List[str]] = None) -> Dict[str, datetime]:
+        """从设备目录读取每个设备最近一次上报的时间
+
+        Args:
+            device_ids: 只查询这些设备，默认全部设备
+
+        Returns:
+            {设备ID: 最近上报时间（不带时区的北京时间）}，没有数据的设备不在结果里
+        """
+        with self.get_read_db() as db:
+            query = db.query(DeviceCatalog.device_id, DeviceCatalog.last_seen)
+            if device_ids is not None:
+                query = query.filter(DeviceCatalog.device_id.in_(device_ids))
+            return {device_id: last_seen for device_id, last_seen in query}
+
+    def get_latest_rows(self) -> List[Dict]:
+        """每个设备最近一条数据，按设备目录的 last_seen 逐个走复合索引查找
+
+        Returns:
+            与写入回调相同格式的数据行，同一时间有多条时都会返回（按 id 升序）
+        """
+        with self.get_read_db() as db:
+            low, high = db.query(func.min(DeviceCatalog.last_seen), func.max(DeviceCatalog.last_seen)).one()
+            if low is None:
+                return []
+            # 分区时逐个分区连接，避免在 UNION ALL 上做连接
+            records = []
+            for table in self.raw_tables(db, low, high):
+                t = table.c
+                records += db.execute(
+                    select(t.id, t.timestamp, t.device_id, t.data_json)
+                    .join(DeviceCatalog, (DeviceCatalog.device_id == t.device_id) & (DeviceCatalog.last_seen == t.timestamp))
+                    .order_by(t.id)
+                ).all()
+            return [
+                {"timestamp": record.timestamp, "device_id": record.device_id, "data_json": record.data_json}
+                for record in records
+            ]
+
+    def _refresh_catalog_after_delete(self, device_id: str, deleted: int):
+        """删除部分原始数据后更新设备目录，设备没有数据了就从目录里移除"""
+        if deleted <= 0:
+            return
+        with self.get_db() as db:
+            t = self.sensor_data_source(db).c
+            first_seen = db.execute(select(func.min(t.timestamp)).where(t.device_id == device_id)).scalar()
+            if first_seen is None:
+                db.execute(delete(DeviceKey.__table__).where(DeviceKey.device_id == device_id))
+                db.execute(delete(DeviceCatalog.__table__).where(DeviceCatalog.device_id == device_id))
+            else:
+                db.query(DeviceCatalog)\
+                  .filter(DeviceCatalog.device_id == device_id)\
+                  .update({
+                      DeviceCatalog.row_count: func.max(DeviceCatalog.row_count - deleted, 0),
+                      DeviceCatalog.first_seen: first_seen
+                  }, synchronize_session=False)
+        _notify(_delete_listeners, device_id, first_seen is None)
     
     def delete_device_data(self, device_id: str) -> bool:
         """删除指定设备的所有数据
+
+        分批删除，每个事务只删除 RETENTION_BATCH_SIZE 条，不会长时间占用写锁
         
         Args:
             device_id: 要删除数据的设备ID
@@ -134,16 +1197,132 @@ class SensorDataDAO:
             bool: 删除操作是否成功
         """
         try:
+            # 删除指定设备的所有记录
+            with self.get_read_db() as db:
+                tables = self.raw_tables(db)
+            deleted_count = 0
+            for table in tables:
+                deleted_count += self.delete_in_batches(table, table.c.device_id == device_id)[0]
+            for _, table in ROLLUP_TABLES:
+                self.delete_in_batches(table.__table__, table.__table__.c.device_id == device_id)
             with self.get_db() as db:
-                # 删除指定设备的所有记录
-                deleted_count = db.query(SensorData)\
-                                 .filter(SensorData.device_id == device_id)\
-                                 .delete()
-                print(f"已删除 {deleted_count} 条设备 {device_id} 的数据")
-                return True
+                db.execute(delete(DeviceKey.__table__).where(DeviceKey.device_id == device_id))
+                db.execute(delete(DeviceCatalog.__table__).where(DeviceCatalog.device_id == device_id))
+            _notify(_delete_listeners, device_id, True)
+            print(f"已删除 {deleted_count} 条设备 {device_id} 的数据")
+            return True
         except SQLAlchemyError as e:
             print(f"删除设备数据失败: {str(e)}")
             return False
+
+    def delete_in_batches(self, table, condition, batch_size: int = None, pause_ms: int = None) -> Tuple[int, List[float]]:
+        """按条件分批删除，每批一个短事务，批之间让出写锁
+
+        Args:
+            table: 要删除数据的表
+            condition: 删除条件
+            batch_size: 每批条数，默认 RETENTION_BATCH_SIZE
+            pause_ms: 两批之间的间隔，默认 RETENTION_BATCH_PAUSE_MS
+
+        Returns:
+            (删除的总条数, 每个删除事务持有写锁的毫秒数)
+        """
+        batch_size = batch_size or RETENTION_BATCH_SIZE
+        pause = (RETENTION_BATCH_PAUSE_MS if pause_ms is None else pause_ms) / 1000.0
+        rowid = literal_column("rowid")
+        total = 0
+        lock_ms = []
+        while True:
+            start = time.perf_counter()
+            with self.get_db() as db:
+                batch = select(rowid).select_from(table).where(condition).limit(batch_size).scalar_subquery()
+                deleted = db.execute(delete(table).where(rowid.in_(batch))).rowcount
+            lock_ms.append((time.perf_counter() - start) * 1000)
+            total += deleted
+            if deleted < batch_size:
+                return total, lock_ms
+            time.sleep(pause)
+
+    def delete_sensor_data_before(self, device_id: str, cutoff: datetime) -> Tuple[int, List[float]]:
+        """分批删除设备在 cutoff 之前的原始数据，只扫描 cutoff 之前的分区"""
+        with self.get_read_db() as db:
+            tables = self.raw_tables(db, end_time=cutoff)
+        total, lock_ms = 0, []
+        for table in tables:
+            count, batches = self.delete_in_batches(
+                table,
+                (table.c.device_id == device_id) & (table.c.timestamp < cutoff)
+            )
+            total += count
+            lock_ms += batches
+        self._refresh_catalog_after_delete(device_id, total)
+        return total, lock_ms
+
+    def drop_partitions_before(self, cutoff: datetime) -> Dict:
+        """整表删除完全早于 cutoff 的分区，代替逐条删除，然后更新设备目录
+
+        Returns:
+            {"partitions": 删除的分区, "rows": 删除的条数, "lock_ms": 每个分区持有写锁的毫秒数}
+        """
+        cutoff = to_beijing_naive(cutoff)
+        with self.get_read_db() as db:
+            names = [name for name in list_partitions(db.connection()) if partition_range(name)[1] <= cutoff]
+
+        counts: Dict[str, int] = {}
+        lock_ms = []
+        for name in names:
+            table = partition_table(name)
+            start = time.perf_counter()
+            with self.get_db() as db:
+                for device_id, count in db.execute(
+                    select(table.c.device_id, func.count()).group_by(table.c.device_id)
+                ):
+                    counts[device_id] = counts.get(device_id, 0) + count
+                db.execute(DropTable(table, if_exists=True))
+            lock_ms.append((time.perf_counter() - start) * 1000)
+            print(f"已删除分区 {name}")
+
+        for device_id, count in counts.items():
+            self._refresh_catalog_after_delete(device_id, count)
+        return {"partitions": names, "rows": sum(counts.values()), "lock_ms": lock_ms}
+
+    def delete_rollups_before(self, bucket_seconds: int, device_id: str, cutoff: datetime) -> Tuple[int, List[float]]:
+        """分批删除设备在 cutoff 之前的某个粒度的预聚合数据"""
+        table = dict(ROLLUP_TABLES)[bucket_seconds].__table__
+        return self.delete_in_batches(
+            table,
+            (table.c.device_id == device_id) & (table.c.bucket < to_wall_epoch(cutoff))
+        )
+
+    def incremental_vacuum(self, max_pages: int) -> Dict:
+        """回收空闲页，返回回收前后的页数和回收的字节数
+
+        只有 auto_vacuum=INCREMENTAL 的库才能回收，否则需要先执行一次 VACUUM
+        """
+        start = time.perf_counter()
+        with self.get_db() as db:
+            conn = db.connection()
+            mode = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+            page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+            before = conn.exec_driver_sql("PRAGMA page_count").scalar()
+            freelist = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if mode == 2:
+                # sqlite3 模块只执行一步这个 PRAGMA，每次只释放一页，所以按页循环执行
+                cursor = conn.connection.cursor()
+                try:
+                    for _ in range(min(int(max_pages), freelist)):
+                        cursor.execute("PRAGMA incremental_vacuum(1)")
+                finally:
+                    cursor.close()
+            after = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        return {
+            "auto_vacuum": {0: "NONE", 1: "FULL", 2: "INCREMENTAL"}.get(mode, mode),
+            "freelist_pages": freelist,
+            "pages_before": before,
+            "pages_after": after,
+            "bytes_reclaimed": (before - after) * page_size,
+            "lock_ms": round((time.perf_counter() - start) * 1000, 3)
+        }
         
     def get_device_json_keys(self, device_id: str):
         """获取指定设备的所有JSON键的种类（去重）
@@ -154,17 +1333,11 @@ class SensorDataDAO:
         Returns:
             List[str]: 去重后的JSON键列表
         """
-        with self.get_db() as db:
-            # 查询该设备的所有记录
-            records = db.query(SensorData.data_json)\
-                      .filter(SensorData.device_id == device_id)\
-                      .all()
-            
-            # 收集所有JSON键
-            keys = set()
-            for record in records:
-                if isinstance(record.data_json, dict):
-                    keys.update(record.data_json.keys())
-            
-            return sorted(list(keys))
+        with self.get_read_db() as db:
+            # 读键目录，不需要解析该设备的全部数据
+            keys = db.query(DeviceKey.key)\
+                     .filter(DeviceKey.device_id == device_id)\
+                     .order_by(DeviceKey.key)\
+                     .all()
+            return [key[0] for key in keys]
 
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from dao.iot_data_info import SensorDataDAO, to_beijing_naive
+
+
+class LatestValueCache:
+    """每个设备最近一条数据的内存缓存
+
+    注册为 SensorDataDAO 的写入回调后，HTTP 和 MQTT 写入的数据提交后都会更新缓存；
+    启动时用 warm() 从数据库加载一次。只在当前进程内有效。
+    """
+
+    def __init__(self):
+        # 设备ID -> (时间, 返回给客户端的数据)，数据对象创建后不再修改，读取时不需要加锁
+        self._latest: Dict[str, Tuple[datetime, Dict]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, rows: List[Dict]):
+        """写入回调：只保留每个设备时间最新的一条，乱序到达的旧数据不会覆盖新数据"""
+        with self._lock:
+            for row in rows:
+                ts = to_beijing_naive(row["timestamp"])
+                current = self._latest.get(row["device_id"])
+                if current is None or ts >= current[0]:
+                    self._latest[row["device_id"]] = (ts, {
+                        "device_id": row["device_id"],
+                        "timestamp": ts.isoformat(),
+                        "data": row["data_json"]
+                    })
+
+    def on_delete(self, device_id: str, device_removed: bool):
+        """删除回调：设备的数据全部删除后从缓存中移除"""
+        if device_removed:
+            with self._lock:
+                self._latest.pop(device_id, None)
+
+    def warm(self, dao: SensorDataDAO) -> int:
+        """从数据库加载每个设备最近一条数据，返回缓存的设备数"""
+        self.update(dao.get_latest_rows())
+        return len(self._latest)
+
+    def get(self, device_id: str) -> Optional[Dict]:
+        item = self._latest.get(device_id)
+        return None if item is None else item[1]
+
+    def get_many(self, device_ids: Optional[Iterable[str]] = None) -> Dict[str, Dict]:
+        """获取多个设备的最新数据，默认全部设备；没有数据的设备不在结果里"""
+        if device_ids is None:
+            return {device_id: item[1] for device_id, item in list(self._latest.items())}
+        result = {}
+        for device_id in device_ids:
+            item = self._latest.get(device_id)
+            if item is not None:
+                result[device_id] = item[1]
+        return result
+
+    def __len__(self):
+        return len(self._latest)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from dao.iot_data_info import to_beijing_naive
+
+
+# 订阅者缓存满时的处理方式
+LIVE_POLICIES = ("drop_oldest", "coalesce")
+
+
+class Subscriber:
+    """一个实时推送的订阅者，缓存有上限，消费慢时按 policy 丢弃或合并"""
+
+    def __init__(self, device_ids: Optional[Set[str]], buffer_size: int, policy: str):
+        if policy not in LIVE_POLICIES:
+            raise ValueError(f"unsupported policy: {policy}")
+        self.device_ids = device_ids
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.delivered = 0
+        self.dropped = 0
+        self._buffer = deque()          # (设备ID, 编码好的 JSON)
+        self._ready = asyncio.Event()
+
+    def wants(self, device_id: str) -> bool:
+        return self.device_ids is None or device_id in self.device_ids
+
+    def offer(self, device_id: str, message: str):
+        """放入一条消息，只在事件循环线程里调用"""
+        if len(self._buffer) >= self.buffer_size and self.policy == "coalesce":
+            # 每个设备只保留最新的一条
+            latest = {}
+            for item in self._buffer:
+                latest.pop(item[0], None)
+                latest[item[0]] = item
+            self.dropped += len(self._buffer) - len(latest)
+            self._buffer = deque(latest.values())
+        while len(self._buffer) >= self.buffer_size:
+            self._buffer.popleft()
+            self.dropped += 1
+        self._buffer.append((device_id, message))
+        self._ready.set()
+
+    async def get_batch(self, timeout: Optional[float] = None) -> List[str]:
+        """等待并取出当前缓存的全部消息，超时返回空列表"""
+        if not self._buffer:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = [message for _, message in self._buffer]
+        self._buffer.clear()
+        self.delivered += len(batch)
+        return batch
+
+    def stats(self) -> Dict:
+        return {
+            "device_ids": None if self.device_ids is None else sorted(self.device_ids),
+            "policy": self.policy,
+            "buffered": len(self._buffer),
+            "delivered": self.delivered,
+            "dropped": self.dropped
+        }
+
+
+class LiveHub:
+    """把新写入的数据推送给订阅者
+
+    注册为 SensorDataDAO 的写入回调，在写库线程里通过 call_soon_threadsafe
+    把数据交给事件循环；每条数据只编码一次 JSON，再分发给所有订阅者。
+    """
+
+    def __init__(self, buffer_size: int = 256, default_policy: str = "drop_oldest"):
+        self.buffer_size = buffer_size
+        self.default_policy = default_policy
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Set[Subscriber] = set()
+        self._lock = threading.Lock()
+        self._published = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """绑定事件循环，服务启动时调用"""
+        self._loop = loop
+
+    def subscribe(self, device_ids: Optional[Set[str]] = None, policy: Optional[str] = None) -> Subscriber:
+        subscriber = Subscriber(device_ids or None, self.buffer_size, policy or self.default_policy)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, rows: List[Dict]):
+        """写入回调，没有订阅者时直接返回"""
+        loop = self._loop
+        if not self._subscribers or loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._dispatch, rows)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def _dispatch(self, rows: List[Dict]):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for row in rows:
+            device_id = row["device_id"]
+            targets = [subscriber for subscriber in subscribers if subscriber.wants(device_id)]
+            if not targets:
+                continue
+            message = json.dumps({
+                "device_id": device_id,
+                "timestamp": to_beijing_naive(row["timestamp"]).isoformat(),
+                "data": row["data_json"]
+            }, ensure_ascii=False)
+            for subscriber in targets:
+                subscriber.offer(device_id, message)
+            self._published += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        return {
+            "subscribers": len(subscribers),
+            "published": self._published,
+            "buffer_size": self.buffer_size,
+            "default_policy": self.default_policy,
+            "clients": [subscriber.stats() for subscriber in subscribers]
+        }
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import bisect
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import METRICS_LATENCY_BUCKETS, METRICS_RATE_WINDOW_SECONDS
+
+# Prometheus 文本格式（0.0.4）
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 一个指标族：(名称, 类型, 说明, [(标签, 值), ...])，抓取时由回调生成
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+class Counter:
+    """只增不减的计数，标签值按 labelnames 的顺序以元组传入"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple = ()) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def collect(self) -> List[Family]:
+        with self._lock:
+            samples = [(dict(zip(self.labelnames, labels)), value) for labels, value in self._values.items()]
+        return [(self.name, "counter", self.help, samples)]
+
+
+class Gauge:
+    """可增可减的当前值，如正在处理的请求数"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()):
+        self.inc(-amount, labels)
+
+    def collect(self) -> List[Family]:
+        with self._lock:
+            samples = [(dict(zip(self.labelnames, labels)), value) for labels, value in self._values.items()]
+        return [(self.name, "gauge", self.help, samples)]
+
+
+class Histogram:
+    """耗时分布，buckets 为各个桶的上界（秒），输出时按 Prometheus 的要求累加"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶（不累加）的次数..., 超过最大桶的次数, 总和]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self) -> List[Family]:
+        with self._lock:
+            items = [(labels, list(counts)) for labels, counts in self._values.items()]
+        samples = []
+        for labels, counts in items:
+            base = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(("_bucket", {**base, "le": _format_value(float(bound))}, cumulative))
+            samples.append(("_sum", base, counts[-1]))
+            samples.append(("_count", base, cumulative))
+        return [(self.name, "histogram", self.help, samples)]
+
+
+class WindowRate:
+    """由累计值算出最近 window_seconds 秒内的每秒速率，每次抓取时调用 update
+
+    只在抓取时记录一个采样点，不占用写入路径；第一次抓取得到的是从创建起的平均速率。
+    """
+
+    def __init__(self, window_seconds: float = METRICS_RATE_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._samples = deque([(time.monotonic(), 0)])
+        self._lock = threading.Lock()
+
+    def update(self, total: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, total))
+            # 保留窗口开始前的最后一个点，作为速率的起点
+            while len(self._samples) > 2 and self._samples[1][0] <= now - self.window_seconds:
+                self._samples.popleft()
+            start, start_total = self._samples[0]
+        if now <= start or total < start_total:
+            return 0.0
+        return (total - start_total) / (now - start)
+
+
+class MetricsRegistry:
+    """进程内的指标集合，render() 输出 Prometheus 文本格式
+
+    计数和耗时分布在发生时记录；队列深度、速率、文件大小这类当前值由 add_collector 注册的回调
+    在抓取时生成，回调返回 Family 列表。每个进程单独统计，多 worker 部署时每次抓取只看到其中一个 worker。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = METRICS_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> List[Family]:
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        families = []
+        for metric in metrics:
+            families.extend(metric.collect())
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                print(f"采集监控指标出错: {e}")
+        return families
+
+    def render(self) -> str:
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append(f"# HELP {name} {_escape(help)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample in samples:
+                # 耗时分布的采样带后缀：(后缀, 标签, 值)
+                suffix, labels, value = sample if len(sample) == 3 else ("", *sample)
+                lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def gauge(name: str, help: str, samples: List[Tuple[Dict[str, str], float]]) -> Family:
+    return (name, "gauge", help, samples)
+
+
+def counter(name: str, help: str, samples: List[Tuple[Dict[str, str], float]]) -> Family:
+    return (name, "counter", help, samples)
+
+
+def file_sizes(paths: Iterable[str]) -> Family:
+    """数据库等文件的大小，SQLite 的 -wal 文件一起统计，不存在的文件跳过"""
+    samples = []
+    for path in paths:
+        for name in (path, path + "-wal"):
+            try:
+                samples.append(({"file": os.path.basename(name)}, os.stat(name).st_size))
+            except OSError:
+                continue
+    return gauge("iot_db_size_bytes", "Size of database files on disk", samples)
+
+
+# 进程内默认的指标集合
+registry = MetricsRegistry()
+
+http_request_seconds = registry.histogram(
+    "iot_http_request_duration_seconds", "HTTP request latency by route, until the response body is sent",
+    ("method", "route")
+)
+http_requests_total = registry.counter(
+    "iot_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+http_requests_in_progress = registry.gauge(
+    "iot_http_requests_in_progress", "HTTP requests being handled, including open streams"
+)
+sql_query_seconds = registry.histogram(
+    "iot_sql_query_duration_seconds", "SQL statement execute time (excluding row fetching)",
+    ("db", "engine", "operation")
+)
+sql_errors_total = registry.counter(
+    "iot_sql_errors_total", "SQL statements that raised an error", ("db", "engine")
+)
+
+
+def _operation(statement: str) -> str:
+    """SQL 语句的第一个关键字，如 SELECT、INSERT，作为标签值"""
+    word = statement.lstrip()[:16].split(None, 1)
+    if not word or not word[0].isalpha():
+        return "OTHER"
+    return word[0].upper()
+
+
+def instrument_engine(engine: Engine, db: str, role: str):
+    """在引擎上注册 before/after_cursor_execute，按库、引擎、语句类型记录每条 SQL 的执行耗时
+
+    只计 cursor.execute 本身：SQLite 的 SELECT 在 execute 时算出第一行，之后逐行读取的时间不在里面，
+    排序、聚合类查询基本都在 execute 里完成，简单的范围扫描大部分时间在读取结果时。
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        sql_query_seconds.observe(elapsed, (db, role, _operation(statement)))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        sql_errors_total.inc(labels=(db, role))
+        conn = context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+
+
+# 长连接推送的响应类型
+_LONG_LIVED_TYPES = (b"multipart/x-mixed-replace", b"text/event-stream")
+
+
+def _is_long_lived(message) -> bool:
+    for name, value in message.get("headers", ()):
+        if name.lower() == b"content-type":
+            return value.startswith(_LONG_LIVED_TYPES)
+    return False
+
+
+class MetricsMiddleware:
+    """记录每个请求的耗时和状态码的 ASGI 中间件，按路由模板（如 /data/latest/{device_id}）统计
+
+    耗时到响应体发送完为止，流式接口（实时推送、视频流）记录的是连接持续的时间；
+    没有匹配到路由的请求（404）统一记为 <unmatched>，避免路径作为标签无限增长。
+    profiler 打开时，请求处理期间采样调用栈，慢请求的采样写到文件（见 SlowRequestProfiler），长连接推送除外。
+    """
+
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = [500]
+
+        profiler = self.profiler
+        token = profiler.begin() if profiler is not None and profiler.enabled else None
+
+        async def send_wrapper(message):
+            nonlocal token
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                # 视频流、SSE 这类长连接一直开着，不算慢请求，不再采样
+                if token is not None and _is_long_lived(message):
+                    profiler.end(token)
+                    token = None
+            await send(message)
+
+        http_requests_in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_progress.dec()
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "<unmatched>"
+            http_request_seconds.observe(elapsed, (method, route))
+            http_requests_total.inc(labels=(method, route, str(status[0])))
+            if token is not None:
+                samples = profiler.end(token)
+                if samples and elapsed * 1000 >= profiler.slow_ms:
+                    await asyncio.to_thread(profiler.dump, f"{method} {route}", elapsed, samples)
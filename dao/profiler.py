@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+
+class SlowRequestProfiler:
+    """慢请求的采样分析，默认关闭
+
+    打开后，只要有请求在处理，后台线程每隔 interval_ms 毫秒采一次本进程所有线程的调用栈，
+    计入每个正在处理的请求；请求耗时超过 slow_ms 时，把它处理期间采到的调用栈按 folded 格式
+    （"线程;函数;函数... 次数"，每行一个栈）写到 output_dir，可以直接用 flamegraph.pl 或 speedscope 打开。
+    事件循环里多个请求交替执行，采样分不出属于哪个请求，同一时间段的慢请求得到的是同样的整个进程的调用栈。
+    """
+
+    def __init__(self, output_dir: str, slow_ms: float, interval_ms: float, max_files: int, enabled: bool = False):
+        self.output_dir = output_dir
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000.0
+        self.max_files = max_files
+        self.enabled = enabled
+        self._active: Dict[int, Counter] = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._samples = 0
+        self._dumps = 0
+
+    def configure(self, enabled: Optional[bool] = None, slow_ms: Optional[float] = None):
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        if enabled is not None:
+            self.enabled = enabled
+            # 关闭后采样线程处理完当前的请求就退出
+            self._wake.set()
+
+    def begin(self) -> int:
+        """请求开始时调用，返回的 token 交给 end()"""
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._active[token] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return token
+
+    def end(self, token: int) -> Counter:
+        """请求结束时调用，返回这个请求处理期间采到的 {调用栈: 次数}"""
+        with self._lock:
+            return self._active.pop(token, None) or Counter()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                idle = not self._active
+                if idle and not self.enabled:
+                    self._thread = None
+                    return
+            if idle:
+                self._wake.clear()
+                self._wake.wait(1.0)
+                continue
+
+            stacks = self._sample(me)
+            with self._lock:
+                self._samples += 1
+                for samples in self._active.values():
+                    samples.update(stacks)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _sample(skip: int) -> List[str]:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            calls = []
+            while frame is not None:
+                code = frame.f_code
+                calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            calls.append(names.get(ident, str(ident)))
+            stacks.append(";".join(reversed(calls)))
+        return stacks
+
+    def dump(self, label: str, elapsed: float, samples: Counter) -> str:
+        """把一个慢请求的采样写到文件，超过 max_files 个文件时删除最旧的"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_")[:80]
+        path = os.path.join(
+            self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms-{name}.folded"
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        with self._lock:
+            self._dumps += 1
+
+        files = sorted(
+            (entry for entry in os.scandir(self.output_dir) if entry.name.endswith(".folded")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+        return path
+
+    def list_dumps(self, limit: int = 20) -> List[str]:
+        """最近写出的采样文件名，新的在前"""
+        try:
+            files = [entry for entry in os.scandir(self.output_dir) if entry.name.endswith(".folded")]
+        except FileNotFoundError:
+            return []
+        files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [entry.name for entry in files[:limit]]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "slow_ms": self.slow_ms,
+                "interval_ms": self.interval * 1000,
+                "output_dir": self.output_dir,
+                "active_requests": len(self._active),
+                "samples": self._samples,
+                "dumps": self._dumps
+            }
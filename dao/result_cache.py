@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from dao.iot_data_info import beijing_tz, to_beijing_naive
+
+
+class CacheEntry:
+    """编码好的响应体，创建后不再修改"""
+
+    __slots__ = ("body", "media_type", "etag", "device_id", "start", "end", "expires")
+
+    def __init__(self, body: bytes, media_type: str, device_id: str,
+                 start: Optional[datetime], end: Optional[datetime], expires: Optional[float]):
+        self.body = body
+        self.media_type = media_type
+        self.etag = make_etag(body)
+        self.device_id = device_id
+        self.start = start
+        self.end = end
+        self.expires = expires
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 可以是 "*" 或逗号分隔的多个 ETag，弱校验（W/ 前缀）也算匹配"""
+    if not if_none_match:
+        return False
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value == "*" or value.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class QueryResultCache:
+    """查询结果缓存，按编码后的字节数做 LRU 淘汰
+
+    注册为写入/删除回调：某个设备写入新数据时，只淘汰这个设备时间范围与新数据重叠的结果，
+    已经完全过去的时间窗口不受影响，可以一直缓存。结束时间为空或还没到的窗口另外加一个短的过期时间，
+    覆盖不经过本进程的写入（如单独运行的 server_mqtt.py）。只在当前进程内有效。
+    """
+
+    def __init__(self, max_bytes: int, live_ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.live_ttl_seconds = live_ttl_seconds
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._device_keys: Dict[str, set] = {}
+        # 每个设备的版本号，写入或删除时加一；查询开始前记下，结果回来时版本变了就不缓存
+        self._generations: Dict[str, int] = {}
+        # clear() 时加一，相当于所有设备的版本号同时变化
+        self._epoch = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._not_modified = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def generation(self, device_id: str) -> Tuple[int, int]:
+        with self._lock:
+            return self._epoch, self._generations.get(device_id, 0)
+
+    def get(self, key: Hashable) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def put(self, key: Hashable, device_id: str, start: Optional[datetime], end: Optional[datetime],
+            body: bytes, media_type: str, generation: Tuple[int, int]) -> CacheEntry:
+        """缓存一个结果并返回它；设备在查询期间有写入，或者结果超过整个缓存大小时只返回不缓存"""
+        start = to_beijing_naive(start) if start else None
+        end = to_beijing_naive(end) if end else None
+        expires = None
+        if end is None or end >= datetime.now(beijing_tz).replace(tzinfo=None):
+            expires = time.monotonic() + self.live_ttl_seconds
+        entry = CacheEntry(body, media_type, device_id, start, end, expires)
+        if len(body) > self.max_bytes:
+            return entry
+
+        with self._lock:
+            if (self._epoch, self._generations.get(device_id, 0)) != generation:
+                return entry
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._device_keys.setdefault(device_id, set()).add(key)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+        return entry
+
+    def record_not_modified(self):
+        with self._lock:
+            self._not_modified += 1
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+        keys = self._device_keys[entry.device_id]
+        keys.discard(key)
+        if not keys:
+            del self._device_keys[entry.device_id]
+
+    def on_ingest(self, rows: List[Dict]):
+        """写入回调：按设备淘汰时间范围与新数据重叠的结果"""
+        spans: Dict[str, List[datetime]] = {}
+        for row in rows:
+            ts = to_beijing_naive(row["timestamp"])
+            span = spans.get(row["device_id"])
+            if span is None:
+                spans[row["device_id"]] = [ts, ts]
+            elif ts < span[0]:
+                span[0] = ts
+            elif ts > span[1]:
+                span[1] = ts
+
+        with self._lock:
+            for device_id, (low, high) in spans.items():
+                self._generations[device_id] = self._generations.get(device_id, 0) + 1
+                for key in list(self._device_keys.get(device_id, ())):
+                    entry = self._entries[key]
+                    if (entry.start is None or entry.start <= high) and (entry.end is None or entry.end >= low):
+                        self._remove(key)
+                        self._invalidations += 1
+
+    def on_delete(self, device_id: str, device_removed: bool):
+        """删除回调：这个设备的结果全部淘汰"""
+        with self._lock:
+            self._generations[device_id] = self._generations.get(device_id, 0) + 1
+            for key in list(self._device_keys.get(device_id, ())):
+                self._remove(key)
+                self._invalidations += 1
+
+    def clear(self):
+        """清空缓存，正在进行的查询结果也不再缓存"""
+        with self._lock:
+            self._epoch += 1
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._device_keys.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else None,
+                "miss_ratio": self._misses / lookups if lookups else None,
+                "not_modified": self._not_modified,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations
+            }
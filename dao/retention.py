@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from dao.iot_data_info import SensorDataDAO, beijing_tz, TIERS, resolve_policy
+
+
+class RetentionWorker:
+    """后台数据清理
+
+    按保留策略分批删除过期数据，每批一个短事务（开启分区时过期的分区整表删除），然后执行 incremental_vacuum
+    回收空间。每一轮都会记录删除条数、回收的字节数和持有写锁的时间。
+    """
+
+    def __init__(self, dao: SensorDataDAO, policies: Dict, interval_seconds: int = 3600, vacuum_pages: int = 2000):
+        self.dao = dao
+        self.policies = policies
+        self.interval_seconds = interval_seconds
+        self.vacuum_pages = vacuum_pages
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._run_lock = threading.Lock()
+        self._last_report: Optional[Dict] = None
+        self._total_deleted = 0
+        self._total_bytes_reclaimed = 0
+        self._passes = 0
+
+    def start(self):
+        """启动后台清理线程，没有配置保留策略时不启动"""
+        if not self.policies or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"数据清理出错: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def run_once(self) -> Dict:
+        """执行一轮清理并返回报告"""
+        with self._run_lock:
+            started = time.perf_counter()
+            now = datetime.now(beijing_tz)
+            deleted = {tier: 0 for tier in TIERS}
+            lock_ms = []
+            devices = self.dao.get_device_list()
+
+            # 所有设备的原始数据都已过期的分区整表删除，剩下的再按设备分批删除
+            raw_keeps = [resolve_policy(self.policies, device_id).get("raw") for device_id in devices]
+            dropped = []
+            if devices and None not in raw_keeps:
+                drop = self.dao.drop_partitions_before(now - timedelta(seconds=max(raw_keeps)))
+                deleted["raw"] += drop["rows"]
+                lock_ms += drop["lock_ms"]
+                dropped = drop["partitions"]
+
+            for device_id in devices:
+                for tier, keep in resolve_policy(self.policies, device_id).items():
+                    if keep is None:
+                        continue
+                    cutoff = now - timedelta(seconds=keep)
+                    if TIERS[tier] is None:
+                        count, batches = self.dao.delete_sensor_data_before(device_id, cutoff)
+                    else:
+                        count, batches = self.dao.delete_rollups_before(TIERS[tier], device_id, cutoff)
+                    deleted[tier] += count
+                    lock_ms += batches
+
+            vacuum = self.dao.incremental_vacuum(self.vacuum_pages)
+            lock_ms.append(vacuum["lock_ms"])
+
+            report = {
+                "finished_at": datetime.now(beijing_tz).isoformat(),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                "deleted": deleted,
+                "dropped_partitions": dropped,
+                "delete_transactions": len(lock_ms) - 1,
+                "max_lock_ms": round(max(lock_ms), 3),
+                "total_lock_ms": round(sum(lock_ms), 3),
+                "vacuum": vacuum
+            }
+            self._last_report = report
+            self._passes += 1
+            self._total_deleted += sum(deleted.values())
+            self._total_bytes_reclaimed += vacuum["bytes_reclaimed"]
+            if vacuum["auto_vacuum"] != "INCREMENTAL":
+                print("数据库未开启 auto_vacuum=INCREMENTAL，删除的数据不会释放磁盘空间，请执行一次 tools/compact_db.py")
+            return report
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": bool(self.policies),
+            "running": self._thread is not None and self._thread.is_alive(),
+            "interval_seconds": self.interval_seconds,
+            "passes": self._passes,
+            "total_deleted": self._total_deleted,
+            "total_bytes_reclaimed": self._total_bytes_reclaimed,
+            "last_report": self._last_report
+        }
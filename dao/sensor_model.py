@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 不依赖数据库的定义，导入时不会打开 iot_data.db（共享订阅的消费进程只导入这里）
+from typing import Dict
+
+import pytz
+from pydantic import BaseModel
+
+# 数据库里保存的都是北京时间
+beijing_tz = pytz.timezone('Asia/Shanghai')
+
+
+# 数据模型
+class SensorDataModel(BaseModel):
+    device_id: str
+    data: Dict
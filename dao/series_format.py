@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from typing import Dict, List
+
+from fastapi.responses import JSONResponse
+
+# 以下编码库都是可选的：没有 orjson 时退回标准库 json，没有 msgpack / pyarrow 时对应格式不可用
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# 按列返回的格式：(名称, Content-Type)
+SERIES_FORMATS = {
+    "columnar": "application/json",
+    "msgpack": "application/x-msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+# 北京时间没有夏令时，wall 时间（北京时间按 UTC 计算）减去 8 小时就是真正的 Unix 时间
+BEIJING_OFFSET_MS = 8 * 3600 * 1000
+
+
+def dumps(obj) -> bytes:
+    """编码为 UTF-8 JSON，优先用 orjson
+
+    orjson 不支持超过 64 位的整数，设备上报的 JSON 里可能有，这时退回标准库
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """用 dumps 编码的 JSONResponse，用法相同"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def format_available(fmt: str) -> bool:
+    if fmt == "msgpack":
+        return msgpack is not None
+    if fmt == "arrow":
+        return pyarrow is not None
+    return fmt in SERIES_FORMATS
+
+
+def to_columns(scan: Dict) -> Dict:
+    """把 TimeSeriesStore.scan 的结果转换为返回给客户端的列：时间为 Unix 毫秒，值按键各一列"""
+    return {
+        "timestamps": [ts // 1000 - BEIJING_OFFSET_MS for ts in scan["timestamps"]],
+        "values": scan["values"]
+    }
+
+
+def encode_columns(columns: Dict, fmt: str) -> bytes:
+    """按 fmt 编码 to_columns 的结果
+
+    columnar / msgpack 的结构都是 {"status", "data": {"timestamps", "values"}}；
+    arrow 是一张表，timestamp 列之后每个键一列
+    """
+    if fmt == "columnar":
+        return dumps({"status": "success", "data": columns})
+    if fmt == "msgpack":
+        return msgpack.packb({"status": "success", "data": columns}, use_bin_type=True)
+    if fmt == "arrow":
+        return _encode_arrow(columns)
+    raise ValueError(f"unsupported format: {fmt}")
+
+
+def _arrow_column(values: List):
+    """类型一致的列由 pyarrow 推断类型，数字和字符串混在一起时整列按 JSON 文本保存"""
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return pyarrow.array([None if value is None else dumps(value).decode("utf-8") for value in values],
+                             type=pyarrow.string())
+
+
+def _encode_arrow(columns: Dict) -> bytes:
+    arrays = [pyarrow.array(columns["timestamps"], type=pyarrow.timestamp("ms", tz="Asia/Shanghai"))]
+    names = ["timestamp"]
+    for key, values in columns["values"].items():
+        arrays.append(_arrow_column(values))
+        names.append(key)
+    table = pyarrow.Table.from_arrays(arrays, names=names)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+from typing import Dict, Optional, Tuple
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from dao.metrics import instrument_engine
+from config import SQLITE_PROFILE, SQLITE_PROFILES
+
+
+# 只对写连接生效的 PRAGMA，其余的读写连接都会设置
+WRITER_ONLY_PRAGMAS = ("journal_mode", "synchronous", "auto_vacuum")
+
+
+def _apply_pragmas(engine: Engine, pragmas: Dict, read_only: bool):
+    """在每个新建的连接上执行 PRAGMA"""
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                if read_only and name in WRITER_ONLY_PRAGMAS:
+                    continue
+                cursor.execute(f"PRAGMA {name}={value}")
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+
+
+def create_sqlite_engines(db_path: str, profile: Optional[str] = None) -> Tuple[Engine, Engine]:
+    """按存储配置创建 SQLite 引擎
+
+    Args:
+        db_path: 数据库文件路径
+        profile: config.SQLITE_PROFILES 中的配置名，默认使用 config.SQLITE_PROFILE
+
+    Returns:
+        (写引擎, 读引擎)。default 配置下两者是同一个引擎；
+        tuned 配置下写引擎只有一个连接，读引擎是只读连接池
+    """
+    settings = SQLITE_PROFILES[profile or SQLITE_PROFILE]
+    pragmas = settings["pragmas"]
+    db = os.path.basename(db_path)
+
+    if not settings["single_writer"]:
+        engine = create_engine(
+            f"sqlite:///{db_path}",
+            poolclass=QueuePool,
+            pool_size=settings["read_pool_size"],
+            max_overflow=10,
+            pool_timeout=30,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            connect_args={"check_same_thread": False}
+        )
+        _apply_pragmas(engine, pragmas, read_only=False)
+        instrument_engine(engine, db, "default")
+        return engine, engine
+
+    # 单个写连接，多个线程写入时排队使用
+    write_engine = create_engine(
+        f"sqlite:///{db_path}",
+        poolclass=QueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=60,
+        connect_args={"check_same_thread": False}
+    )
+    _apply_pragmas(write_engine, pragmas, read_only=False)
+    instrument_engine(write_engine, db, "write")
+
+    # 只读连接池，WAL 模式下读不会阻塞写；流式查询会长时间占用连接，允许临时多开
+    read_engine = create_engine(
+        f"sqlite:///file:{db_path}?mode=ro&uri=true",
+        poolclass=QueuePool,
+        pool_size=settings["read_pool_size"],
+        max_overflow=10,
+        pool_timeout=30,
+        connect_args={"check_same_thread": False}
+    )
+    _apply_pragmas(read_engine, pragmas, read_only=True)
+    instrument_engine(read_engine, db, "read")
+    return write_engine, read_engine
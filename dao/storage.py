@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import math
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select
+
+from dao.iot_data_info import SensorDataDAO, AGGREGATE_FUNCS, is_number, to_beijing_naive, _json_path
+
+# 时间统一换算成"北京时间按 UTC 计算"的微秒数（见 to_wall_epoch），分桶时与 SQL 的结果一致
+WALL_EPOCH = datetime(1970, 1, 1)
+
+
+def to_wall_us(dt: datetime) -> int:
+    delta = to_beijing_naive(dt) - WALL_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_wall_us(us: int) -> datetime:
+    """to_wall_us 的逆运算，返回不带时区的北京时间"""
+    return WALL_EPOCH + timedelta(microseconds=us)
+
+
+class TimeSeriesStore(ABC):
+    """传感器数据存储接口
+
+    scan 按列返回一个设备在 [start_time, end_time) 内指定键的数据：
+    {"timestamps": [wall 微秒, 升序], "values": {键: [值，该行没有这个键时为 None]}}。
+    aggregate / downsample 的默认实现在 scan 的结果上计算，返回格式与
+    SensorDataDAO.aggregate_sensor_data / downsample_sensor_data 相同。
+
+    只有按键读取的路径（聚合、降采样、按列返回的查询）经过这个接口；按行的查询、分页和流式导出
+    需要行 ID 和完整的 JSON，仍然由 SensorDataDAO 直接读 sensor_data 表，写入也始终先写 sensor_data，
+    其他存储（如 ColumnarStore）通过写入/删除回调维护副本。
+    """
+
+    name = ""
+
+    @abstractmethod
+    def write(self, rows: List[Dict]):
+        """写入数据行（timestamp、device_id、data_json），可以直接注册为写入回调"""
+
+    @abstractmethod
+    def scan(
+        self,
+        device_id: str,
+        keys: List[str],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+    ) -> Dict:
+        """按列读取一个设备的数据，格式见类的说明"""
+
+    @abstractmethod
+    def on_delete(self, device_id: str, device_removed: bool):
+        """删除回调，见 add_delete_listener"""
+
+    def flush(self):
+        """把内存里缓存的数据落盘，服务退出前调用"""
+        pass
+
+    @abstractmethod
+    def stats(self) -> Dict:
+        """占用的空间和写入统计"""
+
+    def aggregate(
+        self,
+        device_id: str,
+        keys: List[str],
+        bucket_seconds: int,
+        funcs: List[str],
+        start_wall: Optional[int] = None,
+        end_wall: Optional[int] = None
+    ) -> Dict:
+        """按时间桶聚合数值型的键，start_wall / end_wall 为已经对齐到桶边界的 wall 秒数"""
+        for name in funcs:
+            if name not in AGGREGATE_FUNCS:
+                raise ValueError(f"unsupported aggregate function: {name}")
+        columns = self.scan(
+            device_id, keys,
+            None if start_wall is None else from_wall_us(start_wall * 1000000),
+            None if end_wall is None else from_wall_us(end_wall * 1000000)
+        )
+
+        # 和 SQL 一样，只要桶里有这个设备的数据就输出这个桶
+        bucket_us = bucket_seconds * 1000000
+        groups = []
+        index = []
+        for ts in columns["timestamps"]:
+            group = ts // bucket_us
+            if not groups or groups[-1] != group:
+                groups.append(group)
+            index.append(len(groups) - 1)
+
+        series = {}
+        for key in keys:
+            numbers = [[] for _ in groups]
+            for i, value in zip(index, columns["values"][key]):
+                if is_number(value):
+                    numbers[i].append(value)
+            result = {}
+            for name in funcs:
+                if name == "count":
+                    result[name] = [len(values) for values in numbers]
+                elif name == "sum":
+                    result[name] = [sum(values) if values else None for values in numbers]
+                elif name == "avg":
+                    result[name] = [sum(values) / len(values) if values else None for values in numbers]
+                elif name == "first":
+                    result[name] = [values[0] if values else None for values in numbers]
+                elif name == "last":
+                    result[name] = [values[-1] if values else None for values in numbers]
+                else:
+                    pick = min if name == "min" else max
+                    result[name] = [pick(values) if values else None for values in numbers]
+            series[key] = result
+        return {
+            "bucket_seconds": bucket_seconds,
+            "timestamps": [from_wall_us(group * bucket_us).isoformat() for group in groups],
+            "series": series,
+            "source": self.name
+        }
+
+    def downsample(
+        self,
+        device_id: str,
+        keys: List[str],
+        max_points: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+    ) -> Dict:
+        """M4 降采样：每个桶保留首、尾、最小、最大四个点，桶的计算方式与 SQL 实现相同"""
+        columns = self.scan(
+            device_id, keys, start_time, None if end_time is None else end_time + timedelta(microseconds=1)
+        )
+        timestamps = columns["timestamps"]
+        if not timestamps:
+            return {"bucket_seconds": None, "series": {key: {"timestamps": [], "values": []} for key in keys}}
+        start_us = timestamps[0] if start_time is None else to_wall_us(start_time)
+        end_us = timestamps[-1] if end_time is None else to_wall_us(end_time)
+
+        span = max(1, end_us // 1000000 - start_us // 1000000)
+        bucket_seconds = max(1, math.ceil(span / max(1, max_points // 4 - 1)))
+        bucket_us = bucket_seconds * 1000000
+
+        # 每个桶的首、尾行（不管有没有这个键）
+        bounds = set()
+        previous = None
+        for i, ts in enumerate(timestamps):
+            group = ts // bucket_us
+            if group != previous:
+                bounds.add(i)
+                if i:
+                    bounds.add(i - 1)
+                previous = group
+        bounds.add(len(timestamps) - 1)
+
+        series = {}
+        for key in keys:
+            values = columns["values"][key]
+            extremes = {}
+            for i, value in enumerate(values):
+                if not is_number(value):
+                    continue
+                group = timestamps[i] // bucket_us
+                current = extremes.get(group)
+                if current is None:
+                    extremes[group] = [i, i]
+                else:
+                    if value < values[current[0]]:
+                        current[0] = i
+                    if value > values[current[1]]:
+                        current[1] = i
+            picked = {i for i in bounds if is_number(values[i])}
+            for low, high in extremes.values():
+                picked.update((low, high))
+            ordered = sorted(picked)
+            series[key] = {
+                "timestamps": [from_wall_us(timestamps[i]).isoformat() for i in ordered],
+                "values": [values[i] for i in ordered]
+            }
+        return {"bucket_seconds": bucket_seconds, "series": series}
+
+
+class SQLiteStore(TimeSeriesStore):
+    """默认的存储：sensor_data 表，每行一个 JSON，按键读取时用 json_extract 取值"""
+
+    name = "sqlite"
+
+    def __init__(self, dao: Optional[SensorDataDAO] = None):
+        self.dao = dao or SensorDataDAO()
+
+    def write(self, rows: List[Dict]):
+        return self.dao.save_sensor_data_batch(rows)
+
+    def scan(self, device_id, keys, start_time=None, end_time=None) -> Dict:
+        timestamps = []
+        values = {key: [] for key in keys}
+        with self.dao.get_read_db() as db:
+            t = self.dao.sensor_data_source(db, start_time, end_time).c
+            columns = [t.timestamp]
+            for key in keys:
+                path = _json_path(key)
+                # json_extract 对对象和数组返回 JSON 文本，需要按类型再解析一次
+                columns.append(func.json_extract(t.data_json, path))
+                columns.append(func.json_type(t.data_json, path))
+            query = select(*columns).where(t.device_id == device_id)
+            if start_time is not None:
+                query = query.where(t.timestamp >= to_beijing_naive(start_time))
+            if end_time is not None:
+                query = query.where(t.timestamp < to_beijing_naive(end_time))
+            query = query.order_by(t.timestamp, t.id)
+
+            for row in db.execute(query):
+                timestamps.append(to_wall_us(row[0]))
+                for i, key in enumerate(keys):
+                    value, value_type = row[1 + 2 * i], row[2 + 2 * i]
+                    if value_type in ("object", "array"):
+                        value = json.loads(value)
+                    elif value_type in ("true", "false"):
+                        value = value_type == "true"
+                    values[key].append(value)
+        return {"timestamps": timestamps, "values": values}
+
+    def on_delete(self, device_id, device_removed):
+        # 删除由 SensorDataDAO 直接完成
+        pass
+
+    def stats(self) -> Dict:
+        with self.dao.get_read_db() as db:
+            conn = db.connection()
+            page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+            page_count = conn.exec_driver_sql("PRAGMA page_count").scalar()
+            freelist = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        return {"engine": self.name, "bytes": (page_count - freelist) * page_size}
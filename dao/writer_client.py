@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from dao.iot_data_info import notify_ingest, notify_delete
+from dao.series_format import orjson
+
+# 帧格式：4 字节大端长度 + 1 字节编码标记 + 内容。
+# orjson 解码时会把超过 64 位的整数变成浮点数，这种内容改用标准库编码，标记为 j
+_HEADER = struct.Struct(">I")
+
+
+def encode_frame(obj) -> bytes:
+    payload = None
+    if orjson is not None:
+        try:
+            payload = b"o" + orjson.dumps(obj)
+        except TypeError:
+            pass
+    if payload is None:
+        payload = b"j" + json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return _HEADER.pack(len(payload)) + payload
+
+
+def decode_frame(payload: bytes):
+    if payload[:1] == b"o":
+        return orjson.loads(payload[1:])
+    return json.loads(payload[1:])
+
+
+def encode_rows(rows: List[Dict]) -> List[Dict]:
+    """时间转换为带时区的 ISO 8601 字符串，没有时间的行由写库进程补上"""
+    return [
+        {
+            "timestamp": row["timestamp"].isoformat() if row.get("timestamp") else None,
+            "device_id": row["device_id"],
+            "data_json": row["data_json"]
+        }
+        for row in rows
+    ]
+
+
+def decode_rows(rows: List[Dict]) -> List[Dict]:
+    for row in rows:
+        if row["timestamp"]:
+            row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+    return rows
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("writer closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket):
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return decode_frame(_recv_exact(sock, size))
+
+
+async def read_frame(reader):
+    """asyncio 版本，连接关闭时返回 None"""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        return decode_frame(await reader.readexactly(_HEADER.unpack(header)[0]))
+    except EOFError:
+        return None
+
+
+class WriterClient:
+    """HTTP worker 到写库进程（writer_server.py）的连接
+
+    提供和 SensorDataDAO 相同的 save_sensor_data_batch / delete_device_data，可以直接交给
+    IngestWriter 和 AsyncSensorDataDAO 使用。请求在调用线程里同步收发，写入共用一个连接，同时只有一个请求；
+    其他操作各自使用单独的连接。
+
+    start() 之后另开一个连接接收写库进程的广播，在本进程触发写入/删除回调；
+    断线重连后调用 on_resync，由调用方重新加载断线期间可能错过更新的缓存。
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0, control_timeout: float = 600.0):
+        self.path = path
+        self.timeout = timeout
+        self.control_timeout = control_timeout
+        self._sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._subscriber: Optional[socket.socket] = None
+        self._stopping = threading.Event()
+        self._reconnects = 0
+        self._events = 0
+
+    def _connect(self, timeout: Optional[float] = None) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout or self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def call(self, op: str, **kwargs):
+        """发送一个请求并等待回复，写库进程返回错误时抛出 RuntimeError
+
+        写入走共用的连接；删除设备、数据清理、统计这些可能很慢的操作每次单独建一个连接，
+        超时为 control_timeout，不会让本 worker 的写入排在它们后面。
+        """
+        frame = encode_frame({"op": op, **kwargs})
+        if op != "write":
+            with self._connect(self.control_timeout) as sock:
+                sock.sendall(frame)
+                reply = recv_frame(sock)
+            return self._result(op, reply)
+
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._sock = self._connect()
+                try:
+                    self._sock.sendall(frame)
+                except OSError:
+                    # 旧连接已经失效（写库进程重启过），请求没有发出去，换新连接重发
+                    self._sock.close()
+                    self._sock = self._connect()
+                    self._sock.sendall(frame)
+                reply = recv_frame(self._sock)
+            except OSError:
+                # 连接断了（如写库进程重启），下次调用时重新连接
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                raise
+        return self._result(op, reply)
+
+    @staticmethod
+    def _result(op: str, reply: Dict):
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error") or f"writer failed to run {op}")
+        return reply.get("result")
+
+    def save_sensor_data_batch(self, rows: List[Dict]) -> bool:
+        if not rows:
+            return True
+        try:
+            self.call("write", rows=encode_rows(rows))
+            return True
+        except (OSError, RuntimeError) as e:
+            print(f"转发数据到写库进程失败: {e}")
+            return False
+
+    def delete_device_data(self, device_id: str) -> bool:
+        try:
+            self.call("delete_device", device_id=device_id)
+            return True
+        except (OSError, RuntimeError) as e:
+            print(f"转发删除请求到写库进程失败: {e}")
+            return False
+
+    def start(self, on_resync: Optional[Callable[[], None]] = None):
+        """启动广播接收线程，第一次连上之后才返回，最多等待 timeout 秒"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        connected = threading.Event()
+        self._thread = threading.Thread(
+            target=self._subscribe, args=(on_resync, connected), name="writer-subscriber", daemon=True
+        )
+        self._thread.start()
+        if not connected.wait(self.timeout):
+            print(f"连接写库进程 {self.path} 超时，稍后继续重试")
+
+    def close(self):
+        self._stopping.set()
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        if self._subscriber is not None:
+            try:
+                self._subscriber.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def _subscribe(self, on_resync, connected: threading.Event):
+        delay = 0.1
+        while not self._stopping.is_set():
+            try:
+                sock = self._connect()
+                sock.sendall(encode_frame({"op": "subscribe"}))
+                # 广播之间可能隔很久，不设超时
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+                continue
+
+            self._subscriber = sock
+            if connected.is_set():
+                self._reconnects += 1
+                if on_resync is not None:
+                    try:
+                        on_resync()
+                    except Exception as e:
+                        print(f"重新加载缓存出错: {e}")
+            connected.set()
+            delay = 0.1
+            try:
+                while True:
+                    event = recv_frame(sock)
+                    self._events += 1
+                    if event["event"] == "ingest":
+                        notify_ingest(decode_rows(event["rows"]))
+                    elif event["event"] == "delete":
+                        notify_delete(event["device_id"], event["device_removed"])
+            except (OSError, ValueError) as e:
+                if not self._stopping.is_set():
+                    print(f"写库进程广播连接中断，正在重连: {e}")
+            finally:
+                sock.close()
+                self._subscriber = None
+
+    def stats(self) -> Dict:
+        return {
+            "socket": self.path,
+            "subscribed": self._subscriber is not None,
+            "reconnects": self._reconnects,
+            "events": self._events
+        }
@@ -2,20 +2,25 @@
 # -*- coding: utf-8 -*-
 
 from fastapi import APIRouter, HTTPException
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import Optional
 from dao.agent_info import AgentDAO, AgentCreate, beijing_tz
 from dao.iot_data_info import SensorDataDAO
+from dao.async_dao import AsyncAgentDAO, AsyncSensorDataDAO, db_executor
 
 # 创建路由器
 agent_router = APIRouter(prefix="/agent", tags=["Agent Management"])
 
 agent_dao = AgentDAO()
+async_agent_dao = AsyncAgentDAO(agent_dao)
+sensor_dao = SensorDataDAO()
+async_sensor_dao = AsyncSensorDataDAO(sensor_dao)
 
 @agent_router.post("/create_agent")
 async def create_agent(agent_data: AgentCreate):
     """添加一个新的Agent"""
     try:
-        agent = agent_dao.create_agent(name=agent_data.name, freq=agent_data.freq, describe=agent_data.describe)
+        agent = await async_agent_dao.create_agent(name=agent_data.name, freq=agent_data.freq, describe=agent_data.describe)
         return agent
     except HTTPException as he:
         raise he
@@ -26,7 +31,7 @@ async def create_agent(agent_data: AgentCreate):
 async def delete_agent(agent_name: str):
     """删除指定的Agent"""
     try:
-        success = agent_dao.delete_agent(agent_name)
+        success = await async_agent_dao.delete_agent(agent_name)
         if success:
             return {"message": "Agent deleted successfully"}
     except HTTPException as he:
@@ -38,7 +43,7 @@ async def delete_agent(agent_name: str):
 async def get_agent(agent_name: str):
     """获取指定Agent的详细信息"""
     try:
-        agent = agent_dao.get_agent(agent_name)
+        agent = await async_agent_dao.get_agent(agent_name)
         if not agent:
             raise HTTPException(status_code=404, detail="Agent not found")
         return agent
@@ -51,7 +56,7 @@ async def get_agent(agent_name: str):
 async def get_all_agents():
     """获取所有Agent的信息列表"""
     try:
-        agents = agent_dao.get_all_agents()
+        agents = await async_agent_dao.get_all_agents()
         return agents
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -60,7 +65,7 @@ async def get_all_agents():
 async def update_agent(agent_id: int, agent_data: AgentCreate):
     """更新指定Agent的信息"""
     try:
-        agent = agent_dao.update_agent(agent_id, agent_data)
+        agent = await async_agent_dao.update_agent(agent_id, agent_data)
         return agent
     except HTTPException as he:
         raise he
@@ -68,27 +73,34 @@ async def update_agent(agent_id: int, agent_data: AgentCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def agent_health(agent: dict, last_seen: Optional[datetime], now: datetime) -> dict:
+    """根据最近一次上报时间判断 agent 是否健康
+
+    freq 为上报间隔（秒），最近一个间隔内有数据即为健康；
+    missed_intervals 为从最近一次上报到现在错过的上报次数
+    """
+    freq = max(agent["freq"], 1)
+    if last_seen is None:
+        return {"status": "unhealthy", "freq": agent["freq"], "last_seen": None, "age_seconds": None, "missed_intervals": None}
+    age = max((now - last_seen).total_seconds(), 0.0)
+    return {
+        "status": "healthy" if age <= freq else "unhealthy",
+        "freq": agent["freq"],
+        "last_seen": last_seen.isoformat(),
+        "age_seconds": round(age, 3),
+        "missed_intervals": int(age // freq)
+    }
+
+
 def get_agent_status():
-    """获取所有的 agent 的健康状态"""
-    agent_status = {}
+    """获取所有的 agent 的健康状态
+
+    只查两次库：一次读全部 agent，一次从设备目录读全部设备的最近上报时间
+    """
     agents = agent_dao.get_all_agents()
-    for each in agents:
-        each_name = agents[each]["name"]
-        
-        agent = agent_dao.get_agent(each_name)
-        
-        if agent is None:
-            agent_status[each_name] = {"status": "healthy"}
-        else:
-            start_time = datetime.now(beijing_tz)
-            start_time = start_time - timedelta(seconds=agent["freq"])
-            sensor_data = SensorDataDAO()
-            info = sensor_data.query_sensor_data(device_id=each_name, start_time=start_time, limit=1)
-            if len(info) > 0:
-                agent_status[each_name] = {"status": "healthy"}
-            else:
-                agent_status[each_name] = {"status": "unhealthy"}
-    return agent_status       
+    last_seen = sensor_dao.get_last_seen()
+    now = datetime.now(beijing_tz).replace(tzinfo=None)
+    return {name: agent_health(agent, last_seen.get(name), now) for name, agent in agents.items()}
     
 
 @agent_router.get("/health_check/{agent_name}")
@@ -96,21 +108,13 @@ async def health_check(agent_name:str):
     """Agent服务的健康检查"""
     
     if agent_name =="*":
-        agent_status_info = get_agent_status()
+        agent_status_info = await db_executor.run_read(get_agent_status)
         return {"status": "success", "info": agent_status_info}
         
-    else:
-        agent = agent_dao.get_agent(agent_name)
-        
-        if agent is None:
-            return {"status": "failed", "error_info": f"未找到对应的 agent:{agent_name}"}
-        else:
-            start_time = datetime.now(beijing_tz)
-            start_time = start_time - timedelta(seconds=agent["freq"])
-            sensor_data = SensorDataDAO()
-            info = sensor_data.query_sensor_data(device_id=agent_name, start_time=start_time, limit=1)
-            if len(info) > 0:
-                return {"status": "success", "info": [{agent_name: {"status": "healthy"}}]}
-        
-    return {"status": "success", "info": [{agent_name: {"status": "unhealthy"}}]}
+    agent = await async_agent_dao.get_agent(agent_name)
+    if agent is None:
+        return {"status": "failed", "error_info": f"未找到对应的 agent:{agent_name}"}
 
+    last_seen = await async_sensor_dao.get_last_seen([agent_name])
+    now = datetime.now(beijing_tz).replace(tzinfo=None)
+    return {"status": "success", "info": [{agent_name: agent_health(agent, last_seen.get(agent_name), now)}]}
@@ -2,11 +2,39 @@
 # -*- coding: utf-8 -*-
 
 from fastapi import APIRouter, HTTPException
-from datetime import datetime
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from datetime import datetime, timedelta
+from fastapi import FastAPI, Request, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
+from typing import List, Optional
 import os
-from dao.iot_data_info import SensorDataDAO, SensorDataModel
+import base64
+import queue
+import asyncio
+import codecs
+import json
+import re
+from dao.iot_data_info import SensorDataDAO, SensorDataModel, parse_timestamp, parse_bucket, AGGREGATE_FUNCS
+from dao.iot_data_info import add_ingest_listener, add_delete_listener, set_read_store, set_retention_policies
+from dao.ingest_writer import IngestWriter
+from dao.async_dao import AsyncSensorDataDAO, db_executor
+from dao.retention import RetentionWorker
+from dao.latest_cache import LatestValueCache
+from dao.live_hub import LiveHub, LIVE_POLICIES
+from dao.storage import SQLiteStore
+from dao.columnar_store import ColumnarStore
+from dao.series_format import FastJSONResponse, SERIES_FORMATS, dumps, format_available, to_columns, encode_columns
+from dao.result_cache import QueryResultCache, etag_matches
+from dao.writer_client import WriterClient
+from dao.metrics import registry, WindowRate, gauge, counter, file_sizes
+from config import INGEST_QUEUE_MAXSIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_MS, INGEST_ACK_MODE
+from config import BULK_INSERT_CHUNK_SIZE, BULK_MAX_ERRORS
+from config import STREAM_CHUNK_ROWS, MAX_PAGE_SIZE, MAX_DOWNSAMPLE_POINTS
+from config import RESULT_CACHE_MAX_BYTES, RESULT_CACHE_LIVE_TTL_SECONDS
+from config import HTTP_WORKERS, WRITER_SOCKET, WRITER_TIMEOUT_SECONDS, WRITER_CONTROL_TIMEOUT_SECONDS
+from config import IOT_DATA_DB, AGENT_DB
+from config import RETENTION_POLICIES, RETENTION_INTERVAL_SECONDS, RETENTION_VACUUM_PAGES
+from config import LIVE_BUFFER_SIZE, LIVE_DEFAULT_POLICY, LIVE_HEARTBEAT_SECONDS
+from config import STORAGE_ENGINE, COLUMNAR_DIR, COLUMNAR_PARTITION_SECONDS, COLUMNAR_BLOCK_ROWS, COLUMNAR_FLUSH_SECONDS
 
 
 # 创建路由器
@@ -14,6 +42,93 @@ data_router = APIRouter(prefix="/data", tags=["Agent Management"])
 
 dao = SensorDataDAO()
 
+# 多 worker 部署时写入和删除转发给写库进程 writer_server.py，查询仍然在本进程里用只读连接执行
+writer_client = WriterClient(
+    WRITER_SOCKET, WRITER_TIMEOUT_SECONDS, WRITER_CONTROL_TIMEOUT_SECONDS
+) if HTTP_WORKERS > 1 else None
+async_dao = AsyncSensorDataDAO(dao, writer=writer_client)
+
+# 后台批量写库
+ingest_writer = IngestWriter(
+    writer_client or dao,
+    batch_size=INGEST_BATCH_SIZE,
+    flush_interval_ms=INGEST_FLUSH_INTERVAL_MS,
+    max_queue_size=INGEST_QUEUE_MAXSIZE
+)
+
+# 后台按保留策略清理过期数据，聚合查询也按保留策略跳过已经过期的预聚合表
+set_retention_policies(RETENTION_POLICIES)
+retention_worker = RetentionWorker(
+    dao,
+    RETENTION_POLICIES,
+    interval_seconds=RETENTION_INTERVAL_SECONDS,
+    vacuum_pages=RETENTION_VACUUM_PAGES
+)
+
+# 每个设备最近一条数据的内存缓存，所有写入路径提交后都会更新（启动时在 server.py 里预热）
+latest_cache = LatestValueCache()
+add_ingest_listener(latest_cache.update)
+add_delete_listener(latest_cache.on_delete)
+
+# 新数据实时推送给订阅者（事件循环在 server.py 启动时绑定）
+live_hub = LiveHub(buffer_size=LIVE_BUFFER_SIZE, default_policy=LIVE_DEFAULT_POLICY)
+add_ingest_listener(live_hub.publish)
+
+# 聚合和降采样读取的存储，列式副本跟随写入/删除回调更新（退出时在 server.py 里落盘）
+# 列式副本的文件只能由一个进程维护，多 worker 部署时不使用
+if STORAGE_ENGINE == "columnar" and writer_client is not None:
+    print("多 worker 部署不支持列式存储，改为直接查询 sensor_data")
+if STORAGE_ENGINE == "columnar" and writer_client is None:
+    store = ColumnarStore(
+        COLUMNAR_DIR,
+        dao,
+        partition_seconds=COLUMNAR_PARTITION_SECONDS,
+        block_rows=COLUMNAR_BLOCK_ROWS,
+        flush_seconds=COLUMNAR_FLUSH_SECONDS
+    )
+    add_ingest_listener(store.write)
+    add_delete_listener(store.on_delete)
+    set_read_store(store)
+else:
+    store = SQLiteStore(dao)
+
+# 查询结果缓存，在存储的回调之后注册，失效时新数据已经可以读到
+result_cache = QueryResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_LIVE_TTL_SECONDS)
+add_ingest_listener(result_cache.on_ingest)
+add_delete_listener(result_cache.on_delete)
+
+
+# 监控指标（GET /metrics）：所有写入路径提交的条数和速率，多 worker 部署时每个 worker 都收到写库进程的广播，统计的是全部写入
+ingest_rows_total = registry.counter("iot_ingest_rows_total", "Rows committed to sensor_data")
+add_ingest_listener(lambda rows: ingest_rows_total.inc(len(rows)))
+ingest_rate = WindowRate()
+
+
+def collect_metrics():
+    ingest = ingest_writer.stats()
+    cache = result_cache.stats()
+    return [
+        gauge("iot_ingest_rows_per_second", "Rows committed per second over the rate window",
+              [({}, ingest_rate.update(ingest_rows_total.value()))]),
+        gauge("iot_ingest_queue_depth", "Rows waiting in the ingest queue", [({}, ingest["queue_depth"])]),
+        counter("iot_ingest_failed_rows_total", "Rows from the ingest queue that failed to save",
+                [({}, ingest["failed_rows"])]),
+        gauge("iot_live_subscribers", "Live push subscribers (SSE and WebSocket)",
+              [({}, live_hub.stats()["subscribers"])]),
+        counter("iot_result_cache_lookups_total", "Query result cache lookups",
+                [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])]),
+        file_sizes((IOT_DATA_DB, AGENT_DB))
+    ]
+
+
+registry.add_collector(collect_metrics)
+
+
+def resync_caches():
+    """与写库进程的广播连接断开重连后调用，断线期间的写入/删除没有收到，重新加载缓存"""
+    result_cache.clear()
+    latest_cache.warm(dao)
+
 
 @data_router.post("/iot_data")
 async def receive_data(request: Request):
@@ -28,9 +143,16 @@ async def receive_data(request: Request):
         device_id = raw_data.pop("device_id")
         sensor_data = SensorDataModel(device_id=device_id, data=raw_data)
         
-        # 保存到数据库
-        if not dao.save_sensor_data(sensor_data):
-            raise HTTPException(status_code=500, detail="Failed to save data")
+        # 放进写库队列，由后台线程批量写入
+        try:
+            future = ingest_writer.submit(sensor_data.device_id, sensor_data.data)
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Ingest queue is full")
+        
+        # commit 模式下等待写库完成再返回
+        if INGEST_ACK_MODE == "commit":
+            if not await asyncio.wrap_future(future):
+                raise HTTPException(status_code=500, detail="Failed to save data")
         
         return JSONResponse(content={"status": "success"}, status_code=200)
     
@@ -40,19 +162,498 @@ async def receive_data(request: Request):
         print(f"处理数据时出错: {e}")
         raise HTTPException(status_code=400, detail="Invalid data")
 
+async def _iter_text(request: Request):
+    """按块读取请求体并解码为文本，多字节字符跨块也能正确处理"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    async for chunk in request.stream():
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+async def _iter_ndjson(first: str, chunks):
+    """逐行解析 NDJSON，产出 (记录, 错误信息)"""
+    buffer = first
+    done = False
+    while True:
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line), None
+                except ValueError as e:
+                    yield None, f"invalid json: {e}"
+        if done:
+            break
+        try:
+            buffer += await chunks.__anext__()
+        except StopAsyncIteration:
+            buffer += "\n"
+            done = True
+
+# 扫描 JSON 数组时需要关注的字符：字符串外和字符串内
+_ARRAY_TOKENS = re.compile(r'["\[\]{},]')
+_STRING_TOKENS = re.compile(r'["\\]')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def _parse_element(decoder: json.JSONDecoder, element: str):
+    """解析数组里的一个元素，元素后面还有其他内容（如缺少逗号）也算错误"""
+    try:
+        record, end = decoder.raw_decode(element)
+    except ValueError as e:
+        return None, f"invalid json: {e}"
+    if end != len(element):
+        return None, f"invalid json: extra data at char {end} (missing comma?)"
+    return record, None
+
+def _resync(decoder: json.JSONDecoder, text: str, pos: int) -> Optional[int]:
+    """在括号没有闭合的元素里找下一个元素的开始位置，找不到时返回 None
+
+    字符串也可能没有闭合，所以不跟踪引号：依次尝试 pos 之后的每个逗号，
+    逗号后面是和这个元素同类型的值（以同样的字符开头）、能完整解析且后面紧跟逗号或 ] 时从这里继续。
+    """
+    pos = _WHITESPACE.match(text, pos).end()
+    opening = text[pos:pos + 1]
+    while True:
+        pos = text.find(",", pos + 1)
+        if pos < 0:
+            return None
+        begin = _WHITESPACE.match(text, pos + 1).end()
+        if text[begin:begin + 1] != opening:
+            continue
+        try:
+            _, end = decoder.raw_decode(text, begin)
+        except ValueError:
+            continue
+        end = _WHITESPACE.match(text, end).end()
+        if end < len(text) and text[end] in ",]":
+            return pos + 1
+
+async def _iter_json_array(first: str, chunks):
+    """增量解析 JSON 数组，不需要把整个请求体读进内存，产出 (记录, 错误信息)
+
+    先按括号和字符串找到每个顶层元素的范围（到下一个顶层的逗号或结尾的 ]），再用 raw_decode 解析这一段。
+    元素之间必须正好一个逗号；某个元素格式错误只记一条错误，从下一个顶层元素继续解析。
+    括号或引号没有闭合的元素要到请求体结束才能发现，这时从它后面能找到的下一个元素重新解析剩下的内容。
+    """
+    decoder = json.JSONDecoder()
+    buffer = first.lstrip()[1:]
+    done = False
+    start = 0               # 当前元素在 buffer 里的起始位置
+    pos = 0                 # 已经扫描到的位置
+    depth = 0
+    in_string = False
+    count = 0               # 已经遇到的元素个数（含格式错误的）
+    while True:
+        if pos == start:
+            # 大部分元素格式正确，先直接解析，后面紧跟逗号或 ] 时不需要逐个字符扫描
+            begin = _WHITESPACE.match(buffer, start).end()
+            try:
+                record, end = decoder.raw_decode(buffer, begin)
+            except ValueError:
+                pass
+            else:
+                end = _WHITESPACE.match(buffer, end).end()
+                if end < len(buffer) and buffer[end] in ",]":
+                    count += 1
+                    yield record, None
+                    if buffer[end] == "]":
+                        return
+                    start = pos = end + 1
+                    continue
+
+        delimiter = None
+        while True:
+            match = (_STRING_TOKENS if in_string else _ARRAY_TOKENS).search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            ch = match.group()
+            pos = match.end()
+            if in_string:
+                if ch == '"':
+                    in_string = False
+                elif pos < len(buffer):
+                    pos += 1        # 跳过转义的字符
+                else:
+                    pos -= 1        # 反斜杠在缓冲区末尾，读到更多数据后再处理
+                    break
+            elif ch == '"':
+                in_string = True
+            elif ch in "[{":
+                depth += 1
+            elif depth > 0 and ch in "]}":
+                depth -= 1
+            elif depth == 0 and ch in ",]":
+                delimiter = ch
+                break
+
+        if delimiter is not None:
+            element = buffer[start:pos - 1].strip()
+            if element:
+                count += 1
+                yield _parse_element(decoder, element)
+            elif delimiter == "," or count:
+                # "[,"、",,"、",]" 都是多余的逗号
+                count += 1
+                yield None, "invalid json: expected a value between commas"
+            if delimiter == "]":
+                return
+            start = pos
+            continue
+
+        if done:
+            if not buffer[start:].strip():
+                return
+            count += 1
+            yield None, "invalid json: unterminated element or missing ']'"
+            # 括号没有闭合的元素会一直扫描到请求体末尾，从它后面能找到的下一个元素重新开始解析
+            restart = _resync(decoder, buffer, start)
+            if restart is None:
+                return
+            start = pos = restart
+            depth = 0
+            in_string = False
+            continue
+        try:
+            text = await chunks.__anext__()
+        except StopAsyncIteration:
+            done = True
+            continue
+        # 只保留当前元素，避免缓冲区越来越大
+        buffer = buffer[start:] + text
+        pos -= start
+        start = 0
+
+async def _iter_bulk_records(request: Request):
+    """根据 Content-Type 或首个字符判断是 JSON 数组还是 NDJSON"""
+    chunks = _iter_text(request)
+    first = ""
+    async for text in chunks:
+        first += text
+        if first.strip():
+            break
+    if not first.strip():
+        return
+
+    content_type = request.headers.get("content-type", "")
+    is_ndjson = "ndjson" in content_type or "jsonl" in content_type
+    if not is_ndjson and first.lstrip().startswith("["):
+        records = _iter_json_array(first, chunks)
+    else:
+        records = _iter_ndjson(first, chunks)
+    async for item in records:
+        yield item
+
+@data_router.post("/iot_data_bulk")
+async def receive_data_bulk(request: Request):
+    """批量上传数据，支持 JSON 数组和 NDJSON
+
+    每条记录格式为 {device_id, timestamp?, ...}，timestamp 可以是 ISO 8601 字符串
+    或秒/毫秒级时间戳，不传则使用服务器时间。数据按块在一个事务里写入，
+    返回每条失败记录的序号和原因。
+    """
+    received = 0
+    inserted = 0
+    error_count = 0
+    errors = []
+    chunk = []
+    chunk_index = []
+
+    def add_error(index, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < BULK_MAX_ERRORS:
+            errors.append({"index": index, "error": message})
+
+    async def flush():
+        nonlocal inserted
+        if await async_dao.save_sensor_data_batch(chunk):
+            inserted += len(chunk)
+        else:
+            for index in chunk_index:
+                add_error(index, "failed to save data")
+        chunk.clear()
+        chunk_index.clear()
+
+    try:
+        async for record, error in _iter_bulk_records(request):
+            index = received
+            received += 1
+            if error is not None:
+                add_error(index, error)
+                continue
+            if not isinstance(record, dict):
+                add_error(index, "record must be a json object")
+                continue
+            device_id = record.pop("device_id", None)
+            if not device_id or not isinstance(device_id, str):
+                add_error(index, "device_id is required")
+                continue
+
+            timestamp = record.pop("timestamp", None)
+            if timestamp is not None:
+                try:
+                    timestamp = parse_timestamp(timestamp)
+                except ValueError as e:
+                    add_error(index, str(e))
+                    continue
+
+            chunk.append({"timestamp": timestamp, "device_id": device_id, "data_json": record})
+            chunk_index.append(index)
+            if len(chunk) >= BULK_INSERT_CHUNK_SIZE:
+                await flush()
+
+        if chunk:
+            await flush()
+    except Exception as e:
+        print(f"批量处理数据时出错: {e}")
+        raise HTTPException(status_code=400, detail="Invalid data")
+
+    return JSONResponse(
+        content={
+            "status": "success" if error_count == 0 else "partial",
+            "received": received,
+            "inserted": inserted,
+            "failed": error_count,
+            "errors": errors
+        },
+        status_code=200
+    )
+
+@data_router.get("/ingest_stats")
+async def get_ingest_stats():
+    """写库队列的统计信息"""
+    return JSONResponse(content={"status": "success", "ack_mode": INGEST_ACK_MODE, "stats": ingest_writer.stats()}, status_code=200)
+
+@data_router.get("/retention_stats")
+async def get_retention_stats():
+    """数据清理的统计信息，包括最近一轮删除的条数、回收的字节数和持有写锁的时间"""
+    if writer_client is not None:
+        stats = (await asyncio.to_thread(writer_client.call, "stats"))["retention"]
+    else:
+        stats = retention_worker.stats()
+    return JSONResponse(content={"status": "success", "stats": stats}, status_code=200)
+
+@data_router.get("/writer_stats")
+async def get_writer_stats():
+    """多 worker 部署时写库进程的统计信息，以及本 worker 的广播连接状态"""
+    if writer_client is None:
+        raise HTTPException(status_code=404, detail="Writer process is not enabled")
+    try:
+        stats = await asyncio.to_thread(writer_client.call, "stats")
+    except Exception as e:
+        print(f"获取写库进程统计出错: {e}")
+        raise HTTPException(status_code=503, detail="Writer process is unavailable")
+    return JSONResponse(
+        content={"status": "success", "worker": {"pid": os.getpid(), **writer_client.stats()}, "writer": stats},
+        status_code=200
+    )
+
+@data_router.get("/storage_stats")
+async def get_storage_stats():
+    """当前存储引擎占用的空间和写入统计"""
+    stats = await asyncio.to_thread(store.stats)
+    return JSONResponse(content={"status": "success", "stats": stats}, status_code=200)
+
+@data_router.get("/cache_stats")
+async def get_cache_stats():
+    """查询结果缓存的命中率、占用和失效次数"""
+    return JSONResponse(content={"status": "success", "stats": result_cache.stats()}, status_code=200)
+
+@data_router.post("/retention_run")
+async def run_retention():
+    """立即执行一轮数据清理"""
+    if not RETENTION_POLICIES:
+        raise HTTPException(status_code=400, detail="No retention policy configured")
+    try:
+        if writer_client is not None:
+            report = await asyncio.to_thread(writer_client.call, "retention_run")
+        else:
+            report = await asyncio.to_thread(retention_worker.run_once)
+        return JSONResponse(content={"status": "success", "report": report}, status_code=200)
+    except Exception as e:
+        print(f"数据清理出错: {e}")
+        raise HTTPException(status_code=500, detail="Failed to run retention")
+
 @data_router.get("/get_iot_device_list")
 async def get_device_list():
     """获取设备列表"""
     try:
-        devices = dao.get_device_list()
+        devices = await async_dao.get_device_list()
         return JSONResponse(content={"status": "success", "devices": devices}, status_code=200)
     except Exception as e:
         print(f"获取设备列表时出错: {e}")
         raise HTTPException(status_code=500, detail="Failed to get device list")
 
+@data_router.get("/device_catalog")
+async def get_device_catalog(device_id: Optional[str] = None):
+    """设备目录：每个设备的首次/最近上报时间、数据条数，以及上报过的键和值类型"""
+    try:
+        devices = await async_dao.get_device_catalog(device_id)
+        return JSONResponse(content={"status": "success", "devices": devices}, status_code=200)
+    except Exception as e:
+        print(f"获取设备目录时出错: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get device catalog")
+
+@data_router.get("/latest")
+async def get_latest(device_id: Optional[List[str]] = Query(None)):
+    """设备最近一条数据（内存缓存），可以传多个 device_id，不传时返回全部设备"""
+    return JSONResponse(content={"status": "success", "data": latest_cache.get_many(device_id)}, status_code=200)
+
+@data_router.get("/latest/{device_id}")
+async def get_device_latest(device_id: str):
+    """单个设备最近一条数据（内存缓存）"""
+    latest = latest_cache.get(device_id)
+    if latest is None:
+        raise HTTPException(status_code=404, detail="No data for this device")
+    return JSONResponse(content={"status": "success", "data": latest}, status_code=200)
+
+@data_router.get("/subscribe")
+async def subscribe_sse(request: Request, device_id: Optional[List[str]] = Query(None), policy: Optional[str] = None):
+    """以 SSE 推送新数据，可以传多个 device_id，不传时推送全部设备
+
+    policy 为消费跟不上时的处理方式：drop_oldest 丢弃最旧的消息，coalesce 每个设备只保留最新一条
+    """
+    if policy is not None and policy not in LIVE_POLICIES:
+        raise HTTPException(status_code=400, detail=f"policy must be one of {list(LIVE_POLICIES)}")
+    subscriber = live_hub.subscribe(set(device_id or ()), policy)
+
+    async def events():
+        try:
+            yield ": connected\n\n"
+            while True:
+                batch = await subscriber.get_batch(LIVE_HEARTBEAT_SECONDS)
+                if batch:
+                    yield "".join(f"data: {message}\n\n" for message in batch)
+                elif await request.is_disconnected():
+                    break
+                else:
+                    yield ": heartbeat\n\n"
+        finally:
+            live_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@data_router.websocket("/ws")
+async def subscribe_ws(websocket: WebSocket, device_id: Optional[List[str]] = Query(None), policy: Optional[str] = None):
+    """以 WebSocket 推送新数据，参数与 /data/subscribe 相同，每条消息是一条数据的 JSON"""
+    if policy is not None and policy not in LIVE_POLICIES:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscriber = live_hub.subscribe(set(device_id or ()), policy)
+
+    async def send_loop():
+        while True:
+            for message in await subscriber.get_batch():
+                await websocket.send_text(message)
+
+    sender = asyncio.create_task(send_loop())
+    try:
+        # 客户端发来的消息忽略，只用来感知连接断开
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        live_hub.unsubscribe(subscriber)
+
+@data_router.get("/live_stats")
+async def get_live_stats():
+    """实时推送的统计信息，包括每个订阅者缓存的、已发送的和丢弃的消息数"""
+    return JSONResponse(content={"status": "success", "stats": live_hub.stats()}, status_code=200)
+
+def _encode_cursor(cursor) -> Optional[str]:
+    """把 (timestamp, id) 编码成客户端使用的分页游标"""
+    if cursor is None:
+        return None
+    timestamp, record_id = cursor
+    raw = f"{timestamp.isoformat()}|{record_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        timestamp, record_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _stream_json(rows):
+    """流式输出与普通查询相同结构的 JSON，按块拼接，不在内存中保留整个结果"""
+    yield b'{"status":"success","data":['
+    first = True
+    chunk = []
+    for row in rows:
+        chunk.append(dumps(row))
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            yield (b"" if first else b",") + b",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b"" if first else b",") + b",".join(chunk)
+    yield b"]}"
+
+def _stream_ndjson(rows):
+    """流式输出 NDJSON，每行一条记录"""
+    chunk = []
+    for row in rows:
+        chunk.append(dumps(row))
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+def _query_columns(device_id, keys, start_dt, end_dt, fmt):
+    """按列读取并编码，在读线程里执行，编码也不占用事件循环；没有数据时返回 None"""
+    # query_sensor_data 的 end_time 包含端点，scan 不包含
+    columns = store.scan(device_id, keys, start_dt, end_dt + timedelta(microseconds=1) if end_dt else None)
+    if not columns["timestamps"]:
+        return None
+    return encode_columns(to_columns(columns), fmt)
+
+def _query_rows(device_id, start_dt, end_dt):
+    """按行读取并编码，没有数据时返回 None"""
+    data = dao.query_sensor_data(device_id=device_id, start_time=start_dt, end_time=end_dt, limit=None)
+    if not data:
+        return None
+    return dumps({"status": "success", "data": data})
+
+def _etag_response(request: Request, entry):
+    """返回缓存的结果，客户端带着相同的 ETag 来时只返回 304"""
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        result_cache.record_not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type=entry.media_type, headers=headers)
+
 @data_router.post("/query_iot_data")
 async def get_device_info(request: Request):
-    """获取设备信息"""
+    """获取设备信息
+
+    可选参数：
+        format: 按列返回，时间升序
+            "columnar": {"data": {"timestamps": [Unix 毫秒], "values": {键: [值]}}}，没有这个键的行为 null
+            "msgpack": 与 columnar 结构相同的 MessagePack
+            "arrow": Arrow IPC 流，timestamp 列之后每个键一列
+        keys: 与 format 一起使用，只返回这些键，默认为设备的全部键
+        stream: "json" 或 "ndjson"，流式返回全部结果
+        page_size / cursor: 按 (timestamp, id) 分页，返回 next_cursor
+
+    普通查询和 format 查询的结果会缓存（见 QueryResultCache），响应带 ETag，
+    请求头 If-None-Match 与之相同时返回 304
+    """
     try:
         
         json_info = await request.json()
@@ -67,20 +668,138 @@ async def get_device_info(request: Request):
         start_dt = datetime.fromisoformat(start_time) if start_time else None
         end_dt = datetime.fromisoformat(end_time) if end_time else None
 
+        # 按列返回，不为每行构造字典，也不重复键名
+        fmt = json_info.get("format")
+        if fmt:
+            if fmt not in SERIES_FORMATS:
+                raise HTTPException(status_code=400, detail=f"format must be one of {list(SERIES_FORMATS)}")
+            if not format_available(fmt):
+                raise HTTPException(status_code=501, detail=f"format {fmt} is not available on this server")
+            keys = json_info.get("keys")
+            if keys and (not isinstance(keys, list) or not all(isinstance(key, str) for key in keys)):
+                raise HTTPException(status_code=400, detail="keys must be a list of strings")
+            cache_key = ("query", device_id, start_dt, end_dt, fmt, tuple(keys) if keys else None)
+            entry = result_cache.get(cache_key)
+            if entry is None:
+                generation = result_cache.generation(device_id)
+                keys = keys or await async_dao.get_device_json_keys(device_id)
+                body = await db_executor.run_read(_query_columns, device_id, keys, start_dt, end_dt, fmt) if keys else None
+                if body is None:
+                    raise HTTPException(status_code=404, detail="Device not found")
+                entry = result_cache.put(cache_key, device_id, start_dt, end_dt, body, SERIES_FORMATS[fmt], generation)
+            return _etag_response(request, entry)
+
+        # 流式返回，StreamingResponse 会在线程池中迭代同步生成器
+        stream = json_info.get("stream")
+        if stream:
+            if stream not in ("json", "ndjson"):
+                raise HTTPException(status_code=400, detail="stream must be json or ndjson")
+            rows = dao.iter_sensor_data(
+                device_id=device_id,
+                start_time=start_dt,
+                end_time=end_dt,
+                batch_size=STREAM_CHUNK_ROWS
+            )
+            if stream == "ndjson":
+                return StreamingResponse(_stream_ndjson(rows), media_type="application/x-ndjson")
+            return StreamingResponse(_stream_json(rows), media_type="application/json")
+
+        # 分页返回
+        page_size = json_info.get("page_size")
+        if page_size is not None:
+            page_size = int(page_size)
+            if page_size <= 0 or page_size > MAX_PAGE_SIZE:
+                raise HTTPException(status_code=400, detail=f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+            cursor = json_info.get("cursor")
+            data, next_cursor = await async_dao.query_sensor_data_page(
+                device_id=device_id,
+                start_time=start_dt,
+                end_time=end_dt,
+                page_size=page_size,
+                cursor=_decode_cursor(cursor) if cursor else None
+            )
+            return FastJSONResponse(
+                content={"status": "success", "data": data, "next_cursor": _encode_cursor(next_cursor)},
+                status_code=200
+            )
+
         # 获取数据
-        data = dao.query_sensor_data(
-            device_id=device_id,
-            start_time=start_dt,
-            end_time=end_dt,
-            limit=None
-        )
-        if not data:
-            raise HTTPException(status_code=404, detail="Device not found")
-        return JSONResponse(content={"status": "success", "data": data}, status_code=200)
+        cache_key = ("query", device_id, start_dt, end_dt, None, None)
+        entry = result_cache.get(cache_key)
+        if entry is None:
+            generation = result_cache.generation(device_id)
+            body = await db_executor.run_read(_query_rows, device_id, start_dt, end_dt)
+            if body is None:
+                raise HTTPException(status_code=404, detail="Device not found")
+            entry = result_cache.put(cache_key, device_id, start_dt, end_dt, body, "application/json", generation)
+        return _etag_response(request, entry)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"获取设备信息时出错: {e}")
         raise HTTPException(status_code=500, detail="Failed to get device info")
 
+@data_router.post("/aggregate_iot_data")
+async def aggregate_device_data(request: Request):
+    """按时间桶聚合设备数据
+
+    参数：
+        device_id: 设备ID
+        start_time / end_time: 时间范围（可选）
+        keys: 需要聚合的键，默认为设备的全部键
+        bucket: 时间粒度，如 "1m"、"1h"、"1d"
+        funcs: 聚合函数，可选 min/max/avg/sum/count/first/last，默认 min/max/avg/last
+        max_points: 指定后忽略 bucket，按 M4 方式降采样，每个键最多返回这么多个点
+    """
+    try:
+        json_info = await request.json()
+
+        device_id = json_info.get("device_id")
+        if not device_id:
+            raise HTTPException(status_code=400, detail="device_id is required")
+
+        start_time = json_info.get("start_time", None)
+        end_time = json_info.get("end_time", None)
+        start_dt = datetime.fromisoformat(start_time) if start_time else None
+        end_dt = datetime.fromisoformat(end_time) if end_time else None
+
+        keys = json_info.get("keys") or await async_dao.get_device_json_keys(device_id)
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            raise HTTPException(status_code=400, detail="keys must be a list of strings")
+
+        max_points = json_info.get("max_points")
+        if max_points is not None:
+            max_points = int(max_points)
+            if max_points < 4 or max_points > MAX_DOWNSAMPLE_POINTS:
+                raise HTTPException(status_code=400, detail=f"max_points must be between 4 and {MAX_DOWNSAMPLE_POINTS}")
+            result = await async_dao.downsample_sensor_data(
+                device_id, keys, max_points,
+                start_time=start_dt,
+                end_time=end_dt
+            )
+            return FastJSONResponse(content={"status": "success", "mode": "m4", **result}, status_code=200)
+
+        try:
+            bucket_seconds = parse_bucket(json_info.get("bucket", "1h"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        funcs = json_info.get("funcs") or ["min", "max", "avg", "last"]
+        invalid = [name for name in funcs if name not in AGGREGATE_FUNCS]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"unsupported aggregate functions: {invalid}")
+
+        result = await async_dao.aggregate_sensor_data(
+            device_id, keys, bucket_seconds, funcs,
+            start_time=start_dt,
+            end_time=end_dt
+        )
+        return FastJSONResponse(content={"status": "success", "mode": "bucket", **result}, status_code=200)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"聚合设备数据时出错: {e}")
+        raise HTTPException(status_code=500, detail="Failed to aggregate device data")
+
 @data_router.get("/menu")
 async def view_data():
     """数据查看页面"""
@@ -99,7 +818,7 @@ async def delete_device_id(request: Request):
         # 构建数据对象
         device_id = raw_data.pop("device_id")
         
-        if dao.delete_device_data(device_id):
+        if await async_dao.delete_device_data(device_id):
             return JSONResponse(content={"status": "success"}, status_code=200)
         else:
             raise HTTPException(status_code=500, detail="Failed to delete device data")
@@ -122,9 +841,14 @@ async def get_device_id_key(request: Request):
         # 构建数据对象
         device_id = raw_data.pop("device_id")
         
-        key_list = dao.get_device_json_keys(device_id)
-    
-        return JSONResponse(content={"status": "success", "key_list": key_list}, status_code=200)
+        cache_key = ("keys", device_id)
+        entry = result_cache.get(cache_key)
+        if entry is None:
+            generation = result_cache.generation(device_id)
+            key_list = await async_dao.get_device_json_keys(device_id)
+            body = dumps({"status": "success", "key_list": key_list})
+            entry = result_cache.put(cache_key, device_id, None, None, body, "application/json", generation)
+        return _etag_response(request, entry)
     
     except HTTPException:
         raise
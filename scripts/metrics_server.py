@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse, Response
+from typing import Optional
+from dao.metrics import registry, CONTENT_TYPE
+from dao.profiler import SlowRequestProfiler
+from config import PROFILER_ENABLED, PROFILER_SLOW_MS, PROFILER_INTERVAL_MS, PROFILER_DIR, PROFILER_MAX_FILES
+
+# 创建路由器，server.py、server_mqtt.py、cam_server.py 都挂载这个路由，并添加 MetricsMiddleware：
+#   app.add_middleware(MetricsMiddleware, profiler=profiler)
+metrics_router = APIRouter(tags=["Metrics"])
+
+# 慢请求采样分析，默认关闭
+profiler = SlowRequestProfiler(
+    PROFILER_DIR,
+    slow_ms=PROFILER_SLOW_MS,
+    interval_ms=PROFILER_INTERVAL_MS,
+    max_files=PROFILER_MAX_FILES,
+    enabled=PROFILER_ENABLED
+)
+
+
+@metrics_router.get("/metrics")
+async def get_metrics():
+    """Prometheus 文本格式的监控指标"""
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+@metrics_router.get("/metrics/profiler")
+async def get_profiler():
+    """慢请求采样分析的状态和最近写出的采样文件"""
+    return JSONResponse(
+        content={"status": "success", "profiler": profiler.stats(), "files": profiler.list_dumps()},
+        status_code=200
+    )
+
+@metrics_router.post("/metrics/profiler")
+async def configure_profiler(enabled: Optional[bool] = None, slow_ms: Optional[float] = None):
+    """打开或关闭慢请求采样分析，slow_ms 为写出采样的耗时阈值（毫秒）"""
+    if slow_ms is not None and slow_ms < 0:
+        raise HTTPException(status_code=400, detail="slow_ms must not be negative")
+    profiler.configure(enabled=enabled, slow_ms=slow_ms)
+    return JSONResponse(content={"status": "success", "profiler": profiler.stats()}, status_code=200)
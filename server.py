@@ -5,8 +5,13 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import os
+import asyncio
 from scripts.agent_server import agent_router
-from scripts.iot_data_server import data_router
+from scripts.iot_data_server import data_router, dao, ingest_writer, retention_worker, latest_cache, live_hub, store
+from scripts.iot_data_server import writer_client, resync_caches
+from scripts.metrics_server import metrics_router, profiler
+from dao.metrics import MetricsMiddleware
+from dao.async_dao import db_executor
 
 # FastAPI 应用
 app = FastAPI()
@@ -21,6 +26,32 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 app.include_router(agent_router)
 app.include_router(data_router)
+app.include_router(metrics_router)
+
+# 每个请求的耗时和状态码（GET /metrics），打开采样分析时记录慢请求的调用栈
+app.add_middleware(MetricsMiddleware, profiler=profiler)
+
+
+@app.on_event("startup")
+async def startup_event():
+    live_hub.attach(asyncio.get_running_loop())
+    if writer_client is not None:
+        # 先订阅写库进程的广播再预热缓存，中间的写入不会漏掉；数据清理由写库进程执行
+        await asyncio.to_thread(writer_client.start, resync_caches)
+    else:
+        retention_worker.start()
+    latest_cache.warm(dao)
+    ingest_writer.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    retention_worker.stop()
+    # 退出前把队列里的数据写完
+    ingest_writer.stop()
+    if writer_client is not None:
+        writer_client.close()
+    store.flush()
+    db_executor.shutdown()
 
     
 if __name__ == "__main__":
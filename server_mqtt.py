@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import asyncio
+import argparse
 import json
+import multiprocessing
+import queue
+import threading
+import time
 from datetime import datetime
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 import os
-from dao.iot_data_info import SensorDataDAO, SensorDataModel
+from dao.sensor_model import SensorDataModel, beijing_tz
+from dao.ingest_writer import IngestWriter
+from config import MQTT_QOS, MQTT_QUEUE_MAXSIZE, MQTT_BATCH_SIZE, MQTT_FLUSH_INTERVAL_MS
+from config import MQTT_OVERFLOW_POLICY, MQTT_BLOCK_TIMEOUT_SECONDS
+from config import MQTT_WORKERS, MQTT_SHARE_GROUP, MQTT_WORKER_BATCH_SIZE, MQTT_WORKER_FLUSH_MS
 import paho.mqtt.client as mqtt
 import ssl
 
-# 数据库访问层
-dao = SensorDataDAO()
+if TYPE_CHECKING:
+    from dao.iot_data_info import SensorDataDAO
+
+# 数据库访问层，第一次用到时才导入和创建：导入 dao.iot_data_info 就会打开数据库、建表和迁移，
+# 共享订阅的消费进程用 spawn 启动，会重新导入本模块，但不访问数据库
+_dao: Optional["SensorDataDAO"] = None
+_dao_lock = threading.Lock()
+
+def get_dao() -> "SensorDataDAO":
+    global _dao
+    with _dao_lock:
+        if _dao is None:
+            from dao.iot_data_info import SensorDataDAO
+            _dao = SensorDataDAO()
+        return _dao
 
 # MQTT 配置
 MQTT_BROKER = "broker.emqx.io"          # 公共测试服务器，生产环境请自建
@@ -23,45 +44,119 @@ MQTT_TOPIC_COMMAND = "iot/command"      # 服务端下发命令的主题
 os.makedirs("static", exist_ok=True)
 
 class MQTTServer:
-    def __init__(self):
-        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    """MQTT 数据接收
+
+    网络线程只负责解析消息并放进写库队列，由 IngestWriter 的后台线程批量写库。
+    QoS>0 的消息在写库完成后才确认（manual_ack），未确认的消息占用 broker 的
+    发送窗口，写库跟不上时 broker 会自动放慢推送。
+    """
+
+    def __init__(self, writer: Optional[IngestWriter] = None, overflow_policy: str = MQTT_OVERFLOW_POLICY):
+        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, manual_ack=True)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
+        self.writer = writer or IngestWriter(
+            get_dao(),
+            batch_size=MQTT_BATCH_SIZE,
+            flush_interval_ms=MQTT_FLUSH_INTERVAL_MS,
+            max_queue_size=MQTT_QUEUE_MAXSIZE
+        )
+        self.overflow_policy = overflow_policy
+        self._accepting = False
+
+        # 统计信息
+        self._lock = threading.Lock()
+        self.received = 0
+        self.persisted = 0
+        self.failed = 0
+        self.dropped = 0
+        self.invalid = 0
 
     def on_connect(self, client, userdata, flags, rc, properties):
         print(f"Connected with result code {rc}")
-        client.subscribe(MQTT_TOPIC_DATA)  # 订阅设备数据主题
+        client.subscribe(MQTT_TOPIC_DATA, qos=MQTT_QOS)  # 订阅设备数据主题
         client.subscribe(f"{MQTT_TOPIC_COMMAND}/+")  # 订阅所有命令响应
 
     def on_message(self, client, userdata, msg):
+        if msg.topic.startswith(MQTT_TOPIC_DATA):
+            if not self._accepting:
+                # 正在停止：不处理也不确认，broker 会重新投递
+                return
+            self._count("received")
         try:
             topic = msg.topic
             payload = msg.payload.decode()
             data = json.loads(payload)
 
             if topic.startswith(MQTT_TOPIC_DATA):
-                # 处理设备上报数据
-                self.handle_sensor_data(data)
+                # 处理设备上报数据，写库完成后再确认
+                self.handle_sensor_data(data, msg)
+                return
             elif topic.startswith(MQTT_TOPIC_COMMAND):
                 # 处理设备响应（可选）
                 print(f"Received command response: {data}")
 
         except Exception as e:
             print(f"Error processing message: {e}")
+            if msg.topic.startswith(MQTT_TOPIC_DATA):
+                self._count("invalid")
+        self.ack(msg)
 
-    def handle_sensor_data(self, data):
-        """处理传感器数据并存入数据库"""
-        if "device_id" not in data:
+    def handle_sensor_data(self, data, msg=None):
+        """把传感器数据放进写库队列，msg 为对应的 MQTT 消息，写库完成后确认"""
+        if not isinstance(data, dict) or "device_id" not in data:
             print("Missing device_id in payload")
+            self._count("invalid")
+            self.ack(msg)
             return
 
         device_id = data.pop("device_id")
         sensor_data = SensorDataModel(device_id=device_id, data=data)
-        
-        if not dao.save_sensor_data(sensor_data):
-            print("Failed to save sensor data")
-        else:
-            print(f"Data saved for device {device_id}")
+
+        try:
+            if self.overflow_policy == "block":
+                future = self.writer.submit(
+                    sensor_data.device_id, sensor_data.data, block=True, timeout=MQTT_BLOCK_TIMEOUT_SECONDS
+                )
+            else:
+                future = self.writer.submit(sensor_data.device_id, sensor_data.data)
+        except queue.Full:
+            # 丢弃的消息也要确认，否则会一直占用 broker 的发送窗口
+            self._count("dropped")
+            self.ack(msg)
+            return
+        future.add_done_callback(lambda f: self._on_persisted(f, msg))
+
+    def _on_persisted(self, future, msg):
+        """写库线程里回调：统计结果并确认消息"""
+        self._count("persisted" if future.result() else "failed")
+        self.ack(msg)
+
+    def ack(self, msg):
+        """确认 QoS>0 的消息，QoS 0 的消息不需要确认"""
+        if msg is not None and msg.qos > 0:
+            self.client.ack(msg.mid, msg.qos)
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def message_counts(self) -> Dict:
+        """收到、写入、写库失败、丢弃、格式错误的数据消息数"""
+        with self._lock:
+            return {
+                "received": self.received,
+                "persisted": self.persisted,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "invalid": self.invalid
+            }
+
+    def queue_depth(self) -> int:
+        return self.writer.stats()["queue_depth"]
+
+    def stats(self):
+        return {"overflow_policy": self.overflow_policy, "counters": self.message_counts(), "writer": self.writer.stats()}
 
     def publish_command(self, device_id, command):
         """向特定设备发送命令"""
@@ -73,34 +168,370 @@ class MQTTServer:
         # self.client.tls_set(ca_certs=None, cert_reqs=ssl.CERT_REQUIRED)
         # self.client.username_pw_set("username", "password")
         
+        self.writer.start()
+        self._accepting = True
         self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
         self.client.loop_start()
 
     def stop(self):
-        self.client.loop_stop()
+        # 先停止接收新的数据消息，再把队列里的数据写完，写库回调里的确认由还在运行的网络线程发出；
+        # 确认和断开请求按顺序发送，断开后再停止网络线程
+        self._accepting = False
+        self.client.unsubscribe(MQTT_TOPIC_DATA)
+        self.writer.stop()
         self.client.disconnect()
+        self.client.loop_stop()
+
+class ConsumerWorker:
+    """共享订阅模式下的一个消费进程
+
+    解析消息后攒成小批放进跨进程队列，由主进程的 SharedWriter 统一写库（SQLite 同一时间只能有一个写事务）；
+    写库完成后主进程通过 ack_queue 把 (mid, qos) 送回来，再确认对应的 QoS>0 消息。
+    """
+
+    def __init__(self, worker_id: int, row_queue, ack_queue, counters, overflow_policy: str = MQTT_OVERFLOW_POLICY):
+        self.worker_id = worker_id
+        self.row_queue = row_queue
+        self.ack_queue = ack_queue
+        self.counters = counters        # 共享的 [received, dropped, invalid]，只有本进程写
+        self.overflow_policy = overflow_policy
+        self.client = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._acked = threading.Condition(self._lock)
+        self._unacked = 0               # 已经发给主进程、还没收到确认的 QoS>0 消息数
+        self._accepting = True
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.received = 0
+        self.dropped = 0
+        self.invalid = 0
+
+    def handle_message(self, msg):
+        """解析一条数据消息，放进待发送的批次"""
+        if not self._accepting:
+            # 正在停止：不处理也不确认，broker 会重新投递
+            return
+        self.received += 1
+        try:
+            data = json.loads(msg.payload)
+            device_id = data.pop("device_id")
+            sensor_data = SensorDataModel(device_id=device_id, data=data)
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            self.invalid += 1
+            self.ack([(msg.mid, msg.qos)])
+            return
+
+        row = {"timestamp": datetime.now(beijing_tz), "device_id": sensor_data.device_id, "data_json": sensor_data.data}
+        batch = None
+        with self._lock:
+            self._pending.append((msg.mid, msg.qos, row))
+            if len(self._pending) >= MQTT_WORKER_BATCH_SIZE:
+                batch, self._pending = self._pending, []
+        if batch:
+            self._forward(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._forward(batch)
+        self.counters[:] = [self.received, self.dropped, self.invalid]
+
+    def _forward(self, batch):
+        try:
+            if self.overflow_policy == "block":
+                self.row_queue.put((self.worker_id, batch), timeout=MQTT_BLOCK_TIMEOUT_SECONDS)
+            else:
+                self.row_queue.put_nowait((self.worker_id, batch))
+        except queue.Full:
+            # 丢弃的消息也要确认，否则会一直占用 broker 的发送窗口
+            self.dropped += len(batch)
+            self.ack([(mid, qos) for mid, qos, _ in batch])
+            return
+        with self._lock:
+            self._unacked += sum(1 for _, qos, _ in batch if qos > 0)
+
+    def ack(self, acks):
+        if self.client is None:
+            return
+        for mid, qos in acks:
+            if qos > 0:
+                self.client.ack(mid, qos)
+
+    def _flush_loop(self):
+        while not self._stop.wait(MQTT_WORKER_FLUSH_MS / 1000.0):
+            self.flush()
+
+    def _ack_loop(self):
+        while not self._stop.is_set():
+            try:
+                acks = self.ack_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.ack(acks)
+            with self._lock:
+                self._unacked -= len(acks)
+                self._acked.notify_all()
+
+    def start(self, client=None):
+        """启动定时发送和确认线程，client 为用来确认消息的 MQTT 客户端"""
+        self.client = client
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._flush_loop, name="mqtt-worker-flush", daemon=True),
+            threading.Thread(target=self._ack_loop, name="mqtt-worker-ack", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self, timeout: float = 20.0):
+        """停止接收消息，把剩余的消息发给主进程，最多等 timeout 秒收到主进程的确认后再停止后台线程"""
+        self._accepting = False
+        self.flush()
+        with self._lock:
+            self._acked.wait_for(lambda: self._unacked <= 0, timeout)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def run(self, broker: str, port: int, stop_event):
+        """连接 broker 并订阅共享主题，直到 stop_event 被设置"""
+        client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"iot-consumer-{os.getpid()}",
+            protocol=mqtt.MQTTv5,
+            manual_ack=True
+        )
+        client.on_connect = lambda c, userdata, flags, rc, properties: c.subscribe(
+            f"$share/{MQTT_SHARE_GROUP}/{MQTT_TOPIC_DATA}", qos=MQTT_QOS
+        )
+        client.on_message = lambda c, userdata, msg: self.handle_message(msg)
+        self.start(client)
+        client.connect(broker, port, 60)
+        client.loop_start()
+        try:
+            stop_event.wait()
+        finally:
+            # 确认要在网络线程停止前发出，见 MQTTServer.stop
+            client.unsubscribe(f"$share/{MQTT_SHARE_GROUP}/{MQTT_TOPIC_DATA}")
+            self.close()
+            client.disconnect()
+            client.loop_stop()
+
+
+def consumer_process(worker_id, row_queue, ack_queue, counters, stop_event, broker, port):
+    """消费进程入口"""
+    ConsumerWorker(worker_id, row_queue, ack_queue, counters).run(broker, port, stop_event)
+
+
+class SharedWriter:
+    """主进程里的统一写库线程
+
+    从跨进程队列读取各消费进程发来的批次，合并后在一个事务里写入，
+    再按进程把需要确认的 (mid, qos) 送回去。
+    """
+
+    def __init__(self, row_queue, ack_queues: List):
+        self.row_queue = row_queue
+        self.ack_queues = ack_queues
+        self.dao = get_dao()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.persisted = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="mqtt-shared-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30.0):
+        """队列里剩余的批次写完后退出"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                items = [self.row_queue.get(timeout=0.5)]
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            count = len(items[0][1])
+            deadline = time.monotonic() + MQTT_FLUSH_INTERVAL_MS / 1000.0
+            while count < MQTT_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.row_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                items.append(item)
+                count += len(item[1])
+            self._flush(items)
+
+    def _flush(self, items):
+        rows = [row for _, batch in items for _, _, row in batch]
+        try:
+            ok = self.dao.save_sensor_data_batch(rows)
+        except Exception as e:
+            print(f"批量写库出错: {e}")
+            ok = False
+        with self._lock:
+            self.flushes += 1
+            if ok:
+                self.persisted += len(rows)
+            else:
+                self.failed += len(rows)
+
+        acks: Dict[int, list] = {}
+        for worker_id, batch in items:
+            acks.setdefault(worker_id, []).extend((mid, qos) for mid, qos, _ in batch if qos > 0)
+        for worker_id, worker_acks in acks.items():
+            if worker_acks:
+                self.ack_queues[worker_id].put(worker_acks)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"persisted": self.persisted, "failed": self.failed, "flushes": self.flushes,
+                    "queue_depth": self.row_queue.qsize()}
+
+
+class SharedSubscriptionServer:
+    """共享订阅模式：启动多个消费进程分摊 MQTT 消息，主进程统一写库"""
+
+    def __init__(self, workers: int = MQTT_WORKERS, broker: str = MQTT_BROKER, port: int = MQTT_PORT):
+        self.workers = workers
+        self.broker = broker
+        self.port = port
+        # 消费进程不访问数据库，用 spawn 避免继承主进程的 SQLite 连接
+        self._ctx = multiprocessing.get_context("spawn")
+        self.row_queue = self._ctx.Queue(maxsize=max(1, MQTT_QUEUE_MAXSIZE // MQTT_WORKER_BATCH_SIZE))
+        self.ack_queues = [self._ctx.Queue() for _ in range(workers)]
+        self.counters = [self._ctx.Array("q", 3, lock=False) for _ in range(workers)]
+        self.stop_event = self._ctx.Event()
+        self.writer = SharedWriter(self.row_queue, self.ack_queues)
+        self._processes = []
+
+    def start(self):
+        self.writer.start()
+        self.stop_event.clear()
+        self._processes = [
+            self._ctx.Process(
+                target=consumer_process,
+                args=(i, self.row_queue, self.ack_queues[i], self.counters[i], self.stop_event, self.broker, self.port),
+                name=f"mqtt-consumer-{i}",
+                daemon=True
+            )
+            for i in range(self.workers)
+        ]
+        for process in self._processes:
+            process.start()
+
+    def stop(self):
+        # 先让消费进程把剩余的消息发过来，再等写库线程写完
+        self.stop_event.set()
+        for process in self._processes:
+            process.join(30)
+        self.writer.stop()
+
+    def message_counts(self) -> Dict:
+        """与 MQTTServer.message_counts 相同，收到/丢弃/格式错误为各消费进程之和"""
+        writer = self.writer.stats()
+        totals = {"received": 0, "persisted": writer["persisted"], "failed": writer["failed"], "dropped": 0, "invalid": 0}
+        for c in self.counters:
+            totals["received"] += c[0]
+            totals["dropped"] += c[1]
+            totals["invalid"] += c[2]
+        return totals
+
+    def queue_depth(self) -> int:
+        """跨进程队列里的批次数"""
+        return self.row_queue.qsize()
+
+    def stats(self):
+        workers = [
+            {"received": c[0], "dropped": c[1], "invalid": c[2], "alive": p.is_alive()}
+            for c, p in zip(self.counters, self._processes)
+        ]
+        return {"workers": workers, "writer": self.writer.stats()}
+
+
+def create_mqtt_server(workers: int = MQTT_WORKERS):
+    """workers 大于 1 时使用共享订阅"""
+    return MQTTServer() if workers <= 1 else SharedSubscriptionServer(workers)
+
 
 # 保留原有的HTTP接口（可选）
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI
+from dao.metrics import registry, WindowRate, gauge, counter, file_sizes, MetricsMiddleware
+from scripts.metrics_server import metrics_router, profiler
+from config import IOT_DATA_DB
 app = FastAPI()
-mqtt_server = MQTTServer()
+app.include_router(metrics_router)
+app.add_middleware(MetricsMiddleware, profiler=profiler)
+# 启动时才创建，导入本模块（包括消费进程重新导入）时不连接数据库、不创建进程间队列
+mqtt_server = None
+
+# 每种结果各自计算每秒消息数
+message_rates: Dict[str, WindowRate] = {}
+
+def collect_metrics():
+    """MQTT 消息数和每秒速率、写库队列深度、数据库文件大小（GET /metrics）"""
+    if mqtt_server is None:
+        return [file_sizes((IOT_DATA_DB,))]
+    counts = mqtt_server.message_counts()
+    rates = [
+        ({"result": name}, message_rates.setdefault(name, WindowRate()).update(value))
+        for name, value in counts.items()
+    ]
+    return [
+        counter("iot_mqtt_messages_total", "MQTT data messages by result",
+                [({"result": name}, value) for name, value in counts.items()]),
+        gauge("iot_mqtt_messages_per_second", "MQTT data messages per second over the rate window", rates),
+        gauge("iot_mqtt_queue_depth", "Items waiting in the MQTT write queue", [({}, mqtt_server.queue_depth())]),
+        file_sizes((IOT_DATA_DB,))
+    ]
+
+registry.add_collector(collect_metrics)
 
 @app.on_event("startup")
 async def startup_event():
+    global mqtt_server
+    mqtt_server = create_mqtt_server()
     mqtt_server.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    mqtt_server.stop()
+    if mqtt_server is not None:
+        mqtt_server.stop()
+
+@app.get("/mqtt_stats")
+async def mqtt_stats():
+    """收到、写入、丢弃的消息数和写库队列的统计"""
+    return {"status": "success", "stats": mqtt_server.stats()}
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MQTT 数据接收服务")
+    parser.add_argument("--workers", type=int, default=MQTT_WORKERS, help="消费进程数，大于 1 时使用共享订阅")
+    args = parser.parse_args()
+
     # 启动MQTT服务
-    server = MQTTServer()
+    server = create_mqtt_server(args.workers)
     server.start()
     
     try:
         # 保持主线程运行
         while True:
-            asyncio.sleep(1)
+            time.sleep(1)
     except KeyboardInterrupt:
         server.stop()
\ No newline at end of file
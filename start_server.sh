@@ -4,6 +4,20 @@ cd  /root/Code/iot_server
 
 source ~/venv/bin/activate
 
-uvicorn server:app --host 0.0.0.0 --port 12345 --workers 1
+# HTTP worker 数（config.HTTP_WORKERS），大于 1 时先启动写库进程，各 worker 的写入都经 Unix socket 交给它
+export IOT_HTTP_WORKERS=${IOT_HTTP_WORKERS:-1}
 
+if [ "$IOT_HTTP_WORKERS" -gt 1 ]; then
+    socket=$(python -c "import config; print(config.WRITER_SOCKET)")
+    python writer_server.py &
+    writer_pid=$!
+    # uvicorn 退出后再停止写库进程，让它把队列里的数据写完
+    trap 'kill -TERM $writer_pid 2>/dev/null; wait $writer_pid' EXIT
+    # 等写库进程建好表、开始监听后再启动 worker
+    for i in $(seq 100); do
+        [ -S "$socket" ] && break
+        sleep 0.1
+    done
+fi
 
+uvicorn server:app --host 0.0.0.0 --port 12345 --workers $IOT_HTTP_WORKERS
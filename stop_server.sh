@@ -2,13 +2,29 @@
 
 # 删除启动的算法服务
 
+# 等待进程退出，最多 60 秒
+wait_exit() {
+    for i in $(seq 120); do
+        kill -0 $1 2>/dev/null || return 0
+        sleep 0.5
+    done
+    echo "进程 $1 60 秒内没有退出"
+    return 1
+}
 
 pid=$(ps -ef | grep "/root/venv/bin/python3 /root/venv/bin/uvicorn server:app" | grep -v grep | awk 'NR==1{print $2}')
 
-# 如果找到 PID，则终止该进程
+# 如果找到 PID，则用 SIGTERM 终止：uvicorn 主进程会停止各个 worker，worker 执行 shutdown 把写库队列里的数据写完
 if [ -n "$pid" ]; then
-    kill -9 $pid
-    echo "已终止 Python 进程 (PID: $pid)"
+    kill -TERM $pid
+    wait_exit $pid && echo "已终止 Python 进程 (PID: $pid)"
 else
     echo "未找到运行的 Python 进程"
-fi
\ No newline at end of file
+fi
+
+# 多 worker 部署时的写库进程，在 worker 之后停止，用 SIGTERM 让它把队列里的数据写完再退出
+writer_pid=$(ps -ef | grep "python writer_server.py" | grep -v grep | awk 'NR==1{print $2}')
+if [ -n "$writer_pid" ]; then
+    kill -TERM $writer_pid
+    wait_exit $writer_pid && echo "已终止写库进程 (PID: $writer_pid)"
+fi
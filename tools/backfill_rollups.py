@@ -0,0 +1,17 @@
+import argparse
+import os
+import sys
+
+# 在项目根目录下运行：python tools/backfill_rollups.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dao.iot_data_info import SensorDataDAO
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="根据 sensor_data 中已有的数据重建分钟/小时/天预聚合表")
+    parser.add_argument("--device", default=None, help="只重建指定设备，默认全部设备")
+    args = parser.parse_args()
+
+    count = SensorDataDAO().rebuild_rollups(args.device)
+    print(f"完成，共重建 {count} 个设备")
@@ -0,0 +1,106 @@
+import argparse
+import json
+import time
+
+import requests
+
+
+def load_records(path, count, devices):
+    """读取 NDJSON 文件作为测试数据，缺少 device_id 的记录按序号分配一个测试设备"""
+    records = []
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    record = {"value": record}
+                record.setdefault("device_id", f"bench-{len(records) % devices}")
+                records.append(record)
+    # 文件里的数据不够时循环补齐
+    base = records or [{"temperature": 25.0, "humidity": 60.0}]
+    i = 0
+    while len(records) < count:
+        record = dict(base[i % len(base)])
+        record["device_id"] = f"bench-{len(records) % devices}"
+        records.append(record)
+        i += 1
+    return records[:count]
+
+
+def check_record_errors(url):
+    """格式错误的记录只应该作为单条错误返回，不影响同一批里的其他记录"""
+    body = (
+        '[{"device_id": "bench-check", "temperature": 1},'
+        ' {"device_id": "bench-check", "timestamp": 1e20, "temperature": 2},'
+        ' {"device_id": "bench-check", "timestamp": -1e20, "temperature": 3},'
+        ' {"device_id": "bench-check", "timestamp": NaN, "temperature": 4},'
+        ' {"device_id": "bench-check", "timestamp": "not a time"},'
+        ' {"temperature": 5},,'
+        ' {"device_id": "bench-check", "temperature": 6}]'
+    )
+    r = requests.post(f"{url}/data/iot_data_bulk", data=body.encode("utf-8"),
+                      headers={"Content-Type": "application/json"})
+    r.raise_for_status()
+    result = r.json()
+    failed = sorted(error["index"] for error in result["errors"])
+    assert result["received"] == 8 and result["inserted"] == 2, result
+    assert failed == [1, 2, 3, 4, 5, 6], result
+    print(f"check   : {result['received']} 条, 写入 {result['inserted']} 条, 单条错误 {failed}")
+
+
+def bench_single(url, records):
+    session = requests.Session()
+    start = time.perf_counter()
+    for record in records:
+        session.post(f"{url}/data/iot_data", json=record).raise_for_status()
+    return time.perf_counter() - start
+
+
+def bench_array(url, records, batch):
+    session = requests.Session()
+    start = time.perf_counter()
+    for i in range(0, len(records), batch):
+        r = session.post(f"{url}/data/iot_data_bulk", json=records[i:i + batch])
+        r.raise_for_status()
+    return time.perf_counter() - start
+
+
+def bench_ndjson(url, records, batch):
+    session = requests.Session()
+    start = time.perf_counter()
+    for i in range(0, len(records), batch):
+        body = "\n".join(json.dumps(record) for record in records[i:i + batch])
+        r = session.post(
+            f"{url}/data/iot_data_bulk",
+            data=body.encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        r.raise_for_status()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比逐条上传和批量上传的吞吐")
+    parser.add_argument("--url", default="http://127.0.0.1:12345")
+    parser.add_argument("--file", default=None, help="NDJSON 测试数据，例如 requests.jsonl")
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--single-count", type=int, default=500, help="逐条上传测试的条数")
+    args = parser.parse_args()
+
+    check_record_errors(args.url)
+    records = load_records(args.file, args.count, args.devices)
+
+    single = records[:args.single_count]
+    cost = bench_single(args.url, single)
+    print(f"single  : {len(single)} 条, {cost:.2f}s, {len(single) / cost:.0f} 条/秒")
+
+    cost = bench_array(args.url, records, args.batch)
+    print(f"array   : {len(records)} 条, {cost:.2f}s, {len(records) / cost:.0f} 条/秒")
+
+    cost = bench_ndjson(args.url, records, args.batch)
+    print(f"ndjson  : {len(records)} 条, {cost:.2f}s, {len(records) / cost:.0f} 条/秒")
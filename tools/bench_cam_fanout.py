@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+# 在子进程里启动 cam_server，客户端在本进程里，内存统计的是服务端进程
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def wait_ready(port):
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("cam_server 没有启动")
+
+
+async def open_stream(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+    return reader, writer
+
+
+async def viewer(port, path, latencies, stop):
+    """正常的客户端：读取每一帧，按帧里带的发送时间计算延迟"""
+    reader, writer = await open_stream(port, path)
+    try:
+        while not stop.is_set():
+            # 响应是 chunked 编码，服务端每次 yield 的一帧就是一个 chunk
+            size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            body = chunk.index(b"\r\n\r\n") + 4
+            sent = struct.unpack("d", chunk[body:body + 8])[0]
+            latencies.append((time.time() - sent) * 1000)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def stalled_viewer(port, path):
+    """卡住的客户端：连上之后不再读取"""
+    return await open_stream(port, path)
+
+
+async def upload(port, path, frame_size, fps, seconds):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    padding = os.urandom(frame_size - 8)
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frame = struct.pack("d", time.time()) + padding
+        writer.write(
+            f"POST {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/octet-stream\r\n"
+            f"Content-Length: {len(frame)}\r\n\r\n".encode() + frame
+        )
+        await writer.drain()
+        headers = await reader.readuntil(b"\r\n\r\n")
+        length = int(headers.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+        await reader.readexactly(length)
+        count += 1
+        await asyncio.sleep(1 / fps)
+    writer.close()
+    return count
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float("nan")
+
+
+async def run(args, port, pid):
+    await wait_ready(port)
+    base_rss = rss_mb(pid)
+    stop = asyncio.Event()
+    latencies = []
+    viewers = [asyncio.create_task(viewer(port, args.stream_path, latencies, stop)) for _ in range(args.viewers)]
+    stalled = [await stalled_viewer(port, args.stream_path) for _ in range(args.stalled)]
+    await asyncio.sleep(0.5)
+
+    peak = base_rss
+    upload_task = asyncio.create_task(upload(port, args.upload_path, args.frame_size, args.fps, args.seconds))
+    while not upload_task.done():
+        peak = max(peak, rss_mb(pid))
+        await asyncio.sleep(0.2)
+    frames = upload_task.result()
+    await asyncio.sleep(0.5)
+    stop.set()
+    for task in viewers:
+        task.cancel()
+    for _, writer in stalled:
+        writer.close()
+
+    expected = frames * args.viewers
+    print(f"{args.viewers} 个客户端 + {args.stalled} 个卡住的客户端，上传 {frames} 帧（{args.frame_size // 1024}KB, {args.fps}fps）")
+    print(f"收到 {len(latencies)}/{expected} 帧，延迟 p50={percentile(latencies, 0.5):.1f}ms "
+          f"p99={percentile(latencies, 0.99):.1f}ms")
+    print(f"服务端内存 {base_rss:.1f}MB -> 峰值 {peak:.1f}MB（+{peak - base_rss:.1f}MB）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="cam_server 多客户端观看时的内存和帧延迟")
+    parser.add_argument("--viewers", type=int, default=100)
+    parser.add_argument("--stalled", type=int, default=10, help="连上后不读取的客户端数")
+    parser.add_argument("--frame-size", type=int, default=50 * 1024)
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--upload-path", default="/upload_frame")
+    parser.add_argument("--stream-path", default="/stream")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "cam_server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT
+    )
+    try:
+        asyncio.run(run(args, port, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,106 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# 在临时目录里建库，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_bench_"))
+os.makedirs("data", exist_ok=True)
+
+from dao.iot_data_info import SensorDataDAO, beijing_tz, engine
+from dao.storage import SQLiteStore
+from dao.columnar_store import ColumnarStore
+
+
+def seed(dao, devices, rows_per_device):
+    """每个设备每 10 秒一条，温度、电压缓慢变化，湿度为整数，偶尔带一个状态字符串"""
+    start = datetime.now(beijing_tz) - timedelta(seconds=10 * rows_per_device)
+    for d in range(devices):
+        temperature, voltage = 25.0, 3.3
+        batch = []
+        for i in range(rows_per_device):
+            temperature += random.uniform(-0.1, 0.1)
+            voltage += random.uniform(-0.001, 0.001)
+            data = {
+                "temperature": round(temperature, 2),
+                "humidity": random.randint(40, 60),
+                "voltage": round(voltage, 3)
+            }
+            if i % 100 == 0:
+                data["status"] = "ok"
+            batch.append({"timestamp": start + timedelta(seconds=10 * i), "device_id": f"dev-{d}", "data_json": data})
+            if len(batch) >= 10000:
+                dao.save_sensor_data_batch(batch)
+                batch = []
+        dao.save_sensor_data_batch(batch)
+
+
+def sqlite_bytes():
+    """sensor_data 表和它的索引占用的空间"""
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(
+            "SELECT sum(pgsize) FROM dbstat WHERE name = 'sensor_data' OR name LIKE 'idx_sensor_data_%'"
+        ).scalar()
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比 sensor_data 表和列式存储的空间占用与扫描速度")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=50000, help="每个设备的数据条数")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    dao = SensorDataDAO()
+    seed(dao, args.devices, args.rows)
+
+    sqlite_store = SQLiteStore(dao)
+    columnar = ColumnarStore(os.path.join("data", "columnar"), dao)
+    start = time.perf_counter()
+    for d in range(args.devices):
+        columnar.catch_up(f"dev-{d}")
+    columnar.flush()
+    build_ms = (time.perf_counter() - start) * 1000
+
+    total = args.devices * args.rows
+    sqlite_size = sqlite_bytes()
+    columnar_size = columnar.stats()["bytes"]
+    print(f"{args.devices} 个设备 x {args.rows} 条 = {total} 条，4 个键")
+    print(f"sensor_data + 索引: {sqlite_size / 1024 / 1024:.1f}MB（{sqlite_size / total:.1f} 字节/条）")
+    print(f"列式存储: {columnar_size / 1024 / 1024:.1f}MB（{columnar_size / total:.1f} 字节/条），"
+          f"小 {sqlite_size / columnar_size:.1f} 倍，从 sensor_data 生成用时 {build_ms:.0f}ms")
+
+    device = "dev-0"
+    cases = [
+        ("扫描 1 个键", lambda store: store.scan(device, ["temperature"])),
+        ("扫描 3 个键", lambda store: store.scan(device, ["temperature", "humidity", "voltage"])),
+        ("扫描最近 1 小时", lambda store: store.scan(
+            device, ["temperature"], datetime.now(beijing_tz) - timedelta(hours=1))),
+    ]
+    for name, case in cases:
+        sqlite_ms, expected = timed(lambda: case(sqlite_store), args.repeat)
+        columnar_ms, result = timed(lambda: case(columnar), args.repeat)
+        same = result == expected
+        print(f"{name}（{len(result['timestamps'])} 行）: sqlite {sqlite_ms:.1f}ms，列式 {columnar_ms:.1f}ms，"
+              f"快 {sqlite_ms / columnar_ms:.1f} 倍，结果一致: {same}")
+
+    # 90 秒不是预聚合粒度的整数倍，sqlite 走原始数据的 SQL 聚合
+    funcs = ["min", "max", "avg", "count"]
+    sqlite_ms, _ = timed(lambda: dao.aggregate_sensor_data(device, ["temperature"], 90, funcs), args.repeat)
+    columnar_ms, _ = timed(lambda: columnar.aggregate(device, ["temperature"], 90, funcs), args.repeat)
+    print(f"按 90 秒聚合 1 个键: sqlite {sqlite_ms:.1f}ms，列式 {columnar_ms:.1f}ms，快 {sqlite_ms / columnar_ms:.1f} 倍")
@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timedelta
+
+# 在临时目录里建库，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_bench_"))
+os.makedirs("data", exist_ok=True)
+warnings.filterwarnings("ignore")
+
+import httpx
+
+from dao.iot_data_info import beijing_tz
+from scripts.iot_data_server import dao, ingest_writer
+from server import app
+
+
+def seed_history(device_id, rows):
+    """写入一段历史数据，给慢查询用"""
+    start = datetime.now(beijing_tz) - timedelta(seconds=rows * 5)
+    batch = []
+    for i in range(rows):
+        batch.append({
+            "timestamp": start + timedelta(seconds=i * 5),
+            "device_id": device_id,
+            "data_json": {"temperature": 20 + i % 10, "humidity": 50 + i % 20}
+        })
+        if len(batch) >= 10000:
+            dao.save_sensor_data_batch(batch)
+            batch = []
+    dao.save_sensor_data_batch(batch)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def ingest_loop(client, count, latencies):
+    for i in range(count):
+        start = time.perf_counter()
+        r = await client.post("/data/iot_data", json={"device_id": "bench-live", "value": i})
+        r.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def heavy_query_loop(client, stop):
+    count = 0
+    while not stop.is_set():
+        r = await client.post("/data/query_iot_data", json={"device_id": "bench-history"})
+        r.raise_for_status()
+        count += 1
+    return count
+
+
+async def run(args):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        latencies = []
+        await ingest_loop(client, args.requests, latencies)
+        print(f"仅写入        : p50={percentile(latencies, 0.5):.2f}ms p99={percentile(latencies, 0.99):.2f}ms")
+
+        latencies = []
+        stop = asyncio.Event()
+        queries = [asyncio.create_task(heavy_query_loop(client, stop)) for _ in range(args.queries)]
+        await ingest_loop(client, args.requests, latencies)
+        stop.set()
+        done = await asyncio.gather(*queries)
+        print(f"写入 + 慢查询 : p50={percentile(latencies, 0.5):.2f}ms p99={percentile(latencies, 0.99):.2f}ms"
+              f"（期间完成 {sum(done)} 次历史查询）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="慢查询进行时写入接口的延迟")
+    parser.add_argument("--history", type=int, default=200000, help="历史数据条数")
+    parser.add_argument("--requests", type=int, default=300, help="写入请求数")
+    parser.add_argument("--queries", type=int, default=2, help="并发的历史查询数")
+    args = parser.parse_args()
+
+    seed_history("bench-history", args.history)
+    ingest_writer.start()
+    try:
+        asyncio.run(run(args))
+    finally:
+        ingest_writer.stop()
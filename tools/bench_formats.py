@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# 只测编码，直接在内存里生成 query_sensor_data 和 scan 的返回结果；导入 dao 时会建库，放在临时目录里
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_bench_"))
+os.makedirs("data", exist_ok=True)
+
+from dao.storage import to_wall_us
+from dao import series_format
+from dao.series_format import to_columns, encode_columns, format_available
+
+
+def make_rows(count):
+    """每 10 秒一条，与 bench_columnar 的数据相同"""
+    start = datetime(2024, 1, 1)
+    temperature, voltage = 25.0, 3.3
+    timestamps = []
+    data = []
+    for i in range(count):
+        temperature += random.uniform(-0.1, 0.1)
+        voltage += random.uniform(-0.001, 0.001)
+        item = {"temperature": round(temperature, 2), "humidity": random.randint(40, 60), "voltage": round(voltage, 3)}
+        if i % 100 == 0:
+            item["status"] = "ok"
+        timestamps.append(start + timedelta(seconds=10 * i))
+        data.append(item)
+    return timestamps, data
+
+
+def row_form(timestamps, data):
+    """query_sensor_data 的返回结构"""
+    return [
+        {"id": i + 1, "timestamp": ts.isoformat(), "device_id": "dev-0", "data": item}
+        for i, (ts, item) in enumerate(zip(timestamps, data))
+    ]
+
+
+def scan_form(timestamps, data, keys):
+    """TimeSeriesStore.scan 的返回结构"""
+    return {
+        "timestamps": [to_wall_us(ts) for ts in timestamps],
+        "values": {key: [item.get(key) for item in data] for key in keys}
+    }
+
+
+def stdlib_json(content):
+    # 与 fastapi.responses.JSONResponse.render 相同
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比 /data/query_iot_data 各种返回格式的编码耗时和大小")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    keys = ["humidity", "status", "temperature", "voltage"]
+    timestamps, data = make_rows(args.rows)
+    print(f"{args.rows} 条，{len(keys)} 个键；orjson: {series_format.orjson is not None}，"
+          f"msgpack: {series_format.msgpack is not None}，pyarrow: {series_format.pyarrow is not None}")
+
+    # 构造返回结构的耗时：按行要为每条构造字典、格式化时间
+    rows_ms, rows = timed(lambda: row_form(timestamps, data), args.repeat)
+    scan = scan_form(timestamps, data, keys)
+    columns_ms, columns = timed(lambda: to_columns(scan), args.repeat)
+    print(f"构造按行结果 {rows_ms:.0f}ms，scan 结果转为按列 {columns_ms:.0f}ms")
+
+    cases = [
+        ("按行 JSON（json）", rows_ms, lambda: stdlib_json({"status": "success", "data": rows})),
+    ]
+    if series_format.orjson is not None:
+        cases.append(("按行 JSON（orjson）", rows_ms, lambda: series_format.dumps({"status": "success", "data": rows})))
+    cases.append(("按列 JSON（json）", columns_ms, lambda: stdlib_json({"status": "success", "data": columns})))
+    for fmt in ("columnar", "msgpack", "arrow"):
+        if format_available(fmt):
+            cases.append((f"format={fmt}", columns_ms, lambda fmt=fmt: encode_columns(columns, fmt)))
+        else:
+            print(f"format={fmt}: 未安装依赖，跳过")
+
+    baseline = None
+    for name, build_ms, case in cases:
+        encode_ms, body = timed(case, args.repeat)
+        total_ms = build_ms + encode_ms
+        baseline = baseline or total_ms
+        gzip_size = len(zlib.compress(body, 6))
+        print(f"{name}: 编码 {encode_ms:.0f}ms，含构造 {total_ms:.0f}ms（快 {baseline / total_ms:.1f} 倍），"
+              f"{len(body) / 1024 / 1024:.1f}MB，压缩后 {gzip_size / 1024 / 1024:.1f}MB")
@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# 在临时目录里建库，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_bench_"))
+os.makedirs("data", exist_ok=True)
+
+from sqlalchemy import insert
+
+from dao.agent_info import Agent, engine as agent_engine
+from dao.iot_data_info import SensorDataDAO, beijing_tz
+from scripts.agent_server import agent_dao, get_agent_status
+
+
+def seed(agents, rows_per_agent):
+    """每个 agent 一个同名设备，约 1/10 的设备最近没有上报"""
+    now = datetime.now(beijing_tz)
+    with agent_engine.begin() as conn:
+        conn.execute(insert(Agent.__table__), [
+            {"name": f"agent-{i}", "freq": 60, "create_time": now, "describe": None}
+            for i in range(agents)
+        ])
+
+    dao = SensorDataDAO()
+    batch = []
+    for i in range(agents):
+        # 不健康的设备最后一次上报在 10 分钟之前
+        latest = now - timedelta(minutes=10) if i % 10 == 0 else now
+        for j in range(rows_per_agent):
+            batch.append({
+                "timestamp": latest - timedelta(seconds=30 * j),
+                "device_id": f"agent-{i}",
+                "data_json": {"value": j}
+            })
+        if len(batch) >= 10000:
+            dao.save_sensor_data_batch(batch)
+            batch = []
+    dao.save_sensor_data_batch(batch)
+
+
+def get_agent_status_per_agent():
+    """原来的实现：先读全部 agent，再对每个 agent 查一次 agent 表、一次传感器数据（2N+1 次查询）"""
+    agent_status = {}
+    agents = agent_dao.get_all_agents()
+    for name in agents:
+        agent = agent_dao.get_agent(name)
+        start_time = datetime.now(beijing_tz) - timedelta(seconds=agent["freq"])
+        last_seen = SensorDataDAO().get_latest_timestamp(name, start_time=start_time)
+        agent_status[name] = {"status": "healthy" if last_seen is not None else "unhealthy"}
+    return agent_status
+
+
+def timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比逐个 agent 查询和集合查询的健康检查耗时")
+    parser.add_argument("--agents", type=int, default=10000)
+    parser.add_argument("--rows", type=int, default=5, help="每个设备的数据条数")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    seed(args.agents, args.rows)
+
+    old_ms, old = timed(get_agent_status_per_agent, 1)
+    new_ms, new = timed(get_agent_status, args.repeat)
+
+    mismatched = [name for name in old if old[name]["status"] != new[name]["status"]]
+    unhealthy = sum(1 for info in new.values() if info["status"] != "healthy")
+    print(f"{args.agents} 个 agent（{unhealthy} 个不健康）")
+    print(f"逐个查询 (2N+1): {old_ms:.1f}ms")
+    print(f"集合查询 (2 次): {new_ms:.1f}ms，快 {old_ms / new_ms:.0f} 倍，结果不一致 {len(mismatched)} 个")
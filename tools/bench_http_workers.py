@@ -0,0 +1,178 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# 每种 worker 数在单独的临时目录里启动服务，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEED_SECONDS = 86400
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/data/get_iot_device_list")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("服务启动超时")
+
+
+def start_service(workers, port):
+    """启动 uvicorn（workers > 1 时先启动写库进程），返回 (进程列表, 工作目录)"""
+    workdir = tempfile.mkdtemp(prefix="iot_bench_")
+    os.makedirs(os.path.join(workdir, "data"))
+    env = dict(os.environ, PYTHONPATH=ROOT, IOT_HTTP_WORKERS=str(workers))
+    processes = []
+    if workers > 1:
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "writer_server.py")],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+        socket_path = os.path.join(workdir, "data", "writer.sock")
+        deadline = time.monotonic() + 30
+        while not os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.1)
+    processes.append(subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", ROOT,
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    ))
+    wait_ready(port)
+    return processes, workdir
+
+
+def stop_service(processes):
+    # 先停 uvicorn，再停写库进程
+    for process in reversed(processes):
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def seed(port, devices, rows_per_device):
+    """通过批量上传接口写入过去一天的数据，供查询压测使用"""
+    start = datetime.now() - timedelta(seconds=SEED_SECONDS)
+    step = SEED_SECONDS / rows_per_device
+    for d in range(devices):
+        body = "\n".join(
+            json.dumps({"device_id": f"dev-{d}", "timestamp": (start + timedelta(seconds=i * step)).isoformat(),
+                        "temperature": 20 + i % 15, "humidity": 50})
+            for i in range(rows_per_device)
+        )
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("POST", "/data/iot_data_bulk", body=body, headers={"Content-Type": "application/x-ndjson"})
+        conn.getresponse().read()
+
+
+def make_request(mode, devices, rnd):
+    device_id = f"dev-{rnd.randrange(devices)}"
+    if mode == "ingest":
+        return "/data/iot_data", {"device_id": device_id, "temperature": rnd.randint(10, 30), "humidity": 50}
+    # 每次查询的窗口都不同，不命中结果缓存
+    start = datetime.now() - timedelta(seconds=SEED_SECONDS - rnd.randrange(SEED_SECONDS // 2))
+    return "/data/query_iot_data", {
+        "device_id": device_id, "format": "columnar",
+        "start_time": start.isoformat(), "end_time": (start + timedelta(hours=1)).isoformat()
+    }
+
+
+def load_process(port, mode, devices, threads, seconds, results):
+    """一个压测进程，每个线程一个长连接，循环发请求直到时间结束"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def worker(seed_value):
+        rnd = random.Random(seed_value)
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        failed = 0
+        while time.monotonic() < deadline:
+            path, payload = make_request(mode, devices, rnd)
+            start = time.perf_counter()
+            try:
+                conn.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    pool = [threading.Thread(target=worker, args=(os.getpid() * 1000 + i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((latencies, errors[0]))
+
+
+def run_load(port, mode, devices, clients, seconds):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes_count = max(1, min(clients, os.cpu_count() or 1))
+    threads = max(1, clients // processes_count)
+    processes = [
+        ctx.Process(target=load_process, args=(port, mode, devices, threads, seconds, results))
+        for _ in range(processes_count)
+    ]
+    for process in processes:
+        process.start()
+    latencies, errors = [], 0
+    for _ in processes:
+        part, failed = results.get()
+        latencies += part
+        errors += failed
+    for process in processes:
+        process.join()
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000 if latencies else 0
+    return len(latencies) / seconds, pick(0.5), pick(0.99), errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP worker 数对写入和查询吞吐的影响（多 worker 时经写库进程写入）")
+    parser.add_argument("--workers", default="1,2,4", help="逗号分隔的 worker 数")
+    parser.add_argument("--clients", type=int, default=32, help="并发连接数")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=8640, help="查询压测前每个设备写入的条数（过去一天）")
+    parser.add_argument("--port", type=int, default=12380)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} 个 CPU，{args.clients} 个并发连接，每项 {args.seconds:.0f} 秒")
+    for workers in (int(n) for n in args.workers.split(",")):
+        processes, workdir = start_service(workers, args.port)
+        try:
+            seed(args.port, args.devices, args.rows)
+            for mode in ("ingest", "query"):
+                rate, p50, p99, errors = run_load(args.port, mode, args.devices, args.clients, args.seconds)
+                print(f"{workers} 个 worker，{'写入' if mode == 'ingest' else '查询'}: {rate:,.0f} 次/秒，"
+                      f"p50 {p50:.1f}ms，p99 {p99:.1f}ms，失败 {errors}")
+        finally:
+            stop_service(processes)
@@ -0,0 +1,150 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+# 在临时目录里建库，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_bench_"))
+os.makedirs("data", exist_ok=True)
+
+import paho.mqtt.client as mqtt
+
+from server_mqtt import ConsumerWorker, SharedSubscriptionServer, SharedWriter, MQTT_TOPIC_DATA
+
+# 本地替身 broker 每次交给一个消费进程的消息数，相当于一次 socket 读取
+DELIVERY_CHUNK = 200
+
+
+class AckCounter:
+    """替身 broker 模式下代替 MQTT 客户端，只统计确认数"""
+
+    def __init__(self, acked):
+        self.acked = acked
+
+    def ack(self, mid, qos):
+        self.acked.value += 1
+
+
+def standin_consumer(worker_id, inbox, row_queue, ack_queue, counters, acked):
+    """消费进程：从替身 broker 的收件箱读消息，走和真实消费进程相同的处理路径"""
+    worker = ConsumerWorker(worker_id, row_queue, ack_queue, counters)
+    worker.start(AckCounter(acked))
+    while True:
+        chunk = inbox.get()
+        if chunk is None:
+            break
+        for mid, payload in chunk:
+            msg = mqtt.MQTTMessage(mid=mid, topic=MQTT_TOPIC_DATA.encode())
+            msg.payload = payload
+            msg.qos = 1
+            worker.handle_message(msg)
+    # 等主进程写完库、把确认送回来
+    worker.close(timeout=30)
+
+
+def make_payloads(total, devices):
+    return [
+        (i + 1, json.dumps({"device_id": f"dev-{i % devices}", "temperature": 20 + i % 15, "humidity": 50}).encode())
+        for i in range(total)
+    ]
+
+
+def wait_persisted(writer, total, counters=None, timeout=300):
+    """等待全部写库，返回 (消费进程全部收到的耗时, 全部写库的耗时)，从调用时开始计时"""
+    start = time.perf_counter()
+    received_at = None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if received_at is None and counters is not None and sum(c[0] for c in counters) >= total:
+            received_at = time.perf_counter() - start
+        stats = writer.stats()
+        if stats["persisted"] + stats["failed"] >= total:
+            elapsed = time.perf_counter() - start
+            return received_at or elapsed, elapsed
+        time.sleep(0.01)
+    raise RuntimeError("写库超时")
+
+
+def run_standin(workers, payloads):
+    """替身 broker：像共享订阅一样把消息轮流分给各个消费进程"""
+    ctx = multiprocessing.get_context("spawn")
+    row_queue = ctx.Queue(maxsize=1000)
+    ack_queues = [ctx.Queue() for _ in range(workers)]
+    inboxes = [ctx.Queue() for _ in range(workers)]
+    counters = [ctx.Array("q", 3, lock=False) for _ in range(workers)]
+    acked = [ctx.Value("q", 0, lock=False) for _ in range(workers)]
+    writer = SharedWriter(row_queue, ack_queues)
+    writer.start()
+    processes = [
+        ctx.Process(target=standin_consumer, args=(i, inboxes[i], row_queue, ack_queues[i], counters[i], acked[i]))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # 进程启动时间不计入
+    for inbox in inboxes:
+        inbox.put([])
+    time.sleep(1.0)
+
+    for n, i in enumerate(range(0, len(payloads), DELIVERY_CHUNK)):
+        inboxes[n % workers].put(payloads[i:i + DELIVERY_CHUNK])
+    for inbox in inboxes:
+        inbox.put(None)
+    received, elapsed = wait_persisted(writer, len(payloads), counters)
+
+    for process in processes:
+        process.join(60)
+    writer.stop()
+    stats = writer.stats()
+    return received, elapsed, stats, sum(value.value for value in acked)
+
+
+def run_broker(workers, payloads, host, port):
+    """连接真实的 MQTT v5 broker（如本地 mosquitto）"""
+    server = SharedSubscriptionServer(workers, broker=host, port=port)
+    server.start()
+    time.sleep(2.0)
+
+    publisher = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+    publisher.max_inflight_messages_set(1000)
+    publisher.connect(host, port, 60)
+    publisher.loop_start()
+    start = time.perf_counter()
+    for _, payload in payloads:
+        publisher.publish(MQTT_TOPIC_DATA, payload, qos=1)
+    published = time.perf_counter() - start
+    received, elapsed = wait_persisted(server.writer, len(payloads), server.counters)
+    received, elapsed = published + received, published + elapsed
+    publisher.loop_stop()
+    publisher.disconnect()
+    server.stop()
+    return received, elapsed, server.writer.stats(), None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="共享订阅消费进程数对 MQTT 写入吞吐的影响")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--workers", default="1,2,4", help="逗号分隔的消费进程数")
+    parser.add_argument("--broker", default=None, help="host:port，使用真实 broker；默认使用本地替身 broker")
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.messages, args.devices)
+    mode = f"broker {args.broker}" if args.broker else "本地替身 broker"
+    print(f"{args.messages} 条消息，{args.devices} 个设备，{mode}")
+    for workers in (int(n) for n in args.workers.split(",")):
+        if args.broker:
+            host, port = args.broker.rsplit(":", 1)
+            received, elapsed, stats, acked = run_broker(workers, payloads, host, int(port))
+        else:
+            received, elapsed, stats, acked = run_standin(workers, payloads)
+        line = (f"{workers} 个消费进程: 接收 {args.messages / received:,.0f} 条/秒，"
+                f"写库 {stats['persisted'] / elapsed:,.0f} 条/秒，写入 {stats['persisted']} 条，{stats['flushes']} 次提交")
+        if acked is not None:
+            line += f"，确认 {acked} 条"
+        print(line)
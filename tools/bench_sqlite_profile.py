@@ -0,0 +1,123 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# 在临时目录里建库，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_bench_"))
+os.makedirs("data", exist_ok=True)
+
+from sqlalchemy import insert, select
+
+from config import SQLITE_PROFILES
+from dao.iot_data_info import Base, SensorData, beijing_tz
+from dao.sqlite_engine import create_sqlite_engines
+
+
+def make_rows(count, device_id="bench", start=None):
+    start = start or datetime.now(beijing_tz) - timedelta(seconds=count * 5)
+    return [
+        {
+            "timestamp": start + timedelta(seconds=i * 5),
+            "device_id": device_id,
+            "data_json": {"temperature": 20 + i % 10, "humidity": 50 + i % 20}
+        }
+        for i in range(count)
+    ]
+
+
+def bench_single_commits(engine, count):
+    """每条数据一个事务，对应原来逐条写库的方式"""
+    rows = make_rows(count, "single")
+    start = time.perf_counter()
+    for row in rows:
+        with engine.begin() as conn:
+            conn.execute(insert(SensorData.__table__), row)
+    return count / (time.perf_counter() - start)
+
+
+def bench_batch_commits(engine, count, batch):
+    rows = make_rows(count, "batch")
+    start = time.perf_counter()
+    for i in range(0, count, batch):
+        with engine.begin() as conn:
+            conn.execute(insert(SensorData.__table__), rows[i:i + batch])
+    return count / (time.perf_counter() - start)
+
+
+def bench_query_under_write(write_engine, read_engine, queries):
+    """后台线程持续逐条写入时，范围查询的延迟"""
+    stop = threading.Event()
+    written = [0]
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            with write_engine.begin() as conn:
+                conn.execute(insert(SensorData.__table__), {
+                    "timestamp": datetime.now(beijing_tz),
+                    "device_id": "live",
+                    "data_json": {"value": i}
+                })
+            i += 1
+        written[0] = i
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    latencies = []
+    end = datetime.now(beijing_tz)
+    begin = end - timedelta(days=1)
+    try:
+        for _ in range(queries):
+            start = time.perf_counter()
+            with read_engine.connect() as conn:
+                conn.execute(
+                    select(SensorData.__table__)
+                    .where(SensorData.device_id == "history")
+                    .where(SensorData.timestamp >= begin)
+                    .where(SensorData.timestamp <= end)
+                    .order_by(SensorData.timestamp.desc())
+                ).fetchall()
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        stop.set()
+        thread.join()
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], written[0]
+
+
+def run_profile(name, args):
+    path = os.path.join(tempfile.mkdtemp(prefix=f"profile_{name}_"), "iot_data.db")
+    write_engine, read_engine = create_sqlite_engines(path, name)
+    Base.metadata.create_all(bind=write_engine)
+
+    with write_engine.begin() as conn:
+        conn.execute(insert(SensorData.__table__), make_rows(args.history, "history"))
+
+    single = bench_single_commits(write_engine, args.single)
+    batch = bench_batch_commits(write_engine, args.rows, args.batch)
+    p50, p99, written = bench_query_under_write(write_engine, read_engine, args.queries)
+    print(f"[{name}] 逐条提交 {single:.0f} 条/秒, 批量提交 {batch:.0f} 条/秒, "
+          f"写入期间查询 p50={p50:.1f}ms p99={p99:.1f}ms（期间写入 {written} 条）")
+
+    write_engine.dispose()
+    read_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比不同 SQLite 存储配置的写入和查询性能")
+    parser.add_argument("--profiles", nargs="+", default=list(SQLITE_PROFILES))
+    parser.add_argument("--history", type=int, default=50000, help="预置的历史数据条数")
+    parser.add_argument("--single", type=int, default=1000, help="逐条提交的条数")
+    parser.add_argument("--rows", type=int, default=50000, help="批量提交的条数")
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    for name in args.profiles:
+        run_profile(name, args)
@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# 在临时目录里建库，不影响 ./data 下的正式数据
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="iot_plan_"))
+os.makedirs("data", exist_ok=True)
+
+from dao.iot_data_info import SensorDataDAO, engine, beijing_tz
+
+
+INDEX_NAME = "idx_sensor_data_device_ts"
+
+
+def seed(dao, devices=20, rows=500):
+    now = datetime.now(beijing_tz)
+    batch = []
+    for d in range(devices):
+        for i in range(rows):
+            batch.append({
+                "timestamp": now - timedelta(seconds=i * 5),
+                "device_id": f"device-{d}",
+                "data_json": {"value": i}
+            })
+    dao.save_sensor_data_batch(batch)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+
+
+def check(name, plan, covering=False):
+    """检查执行计划走了复合索引，并且没有额外排序"""
+    text = " | ".join(plan)
+    expected = f"USING COVERING INDEX {INDEX_NAME}" if covering else INDEX_NAME
+    ok = expected in text and "TEMP B-TREE" not in text
+    print(f"[{'OK' if ok else 'FAIL'}] {name}: {text}")
+    return ok
+
+
+if __name__ == "__main__":
+    dao = SensorDataDAO()
+    seed(dao)
+    now = datetime.now(beijing_tz)
+
+    results = [
+        check("时间范围查询", dao.explain_sensor_data_query(
+            device_id="device-1", start_time=now - timedelta(hours=1), end_time=now)),
+        check("最新 N 条", dao.explain_sensor_data_query(device_id="device-1", limit=10)),
+        check("起始时间 + 最新 1 条", dao.explain_sensor_data_query(
+            device_id="device-1", start_time=now - timedelta(minutes=5), limit=1)),
+        check("最近一条的时间", dao.explain_latest_timestamp("device-1"), covering=True),
+    ]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,33 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+# 在项目根目录下运行：python tools/compact_db.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import IOT_DATA_DB
+
+
+def file_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="开启 auto_vacuum=INCREMENTAL 并执行一次完整的 VACUUM")
+    parser.add_argument("--db", default=IOT_DATA_DB)
+    args = parser.parse_args()
+
+    # VACUUM 期间会独占数据库，建议在服务停止时执行
+    conn = sqlite3.connect(args.db, timeout=60, isolation_level=None)
+    before = file_size(args.db)
+    start = time.perf_counter()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    conn.close()
+    after = file_size(args.db)
+    print(f"auto_vacuum={mode}，耗时 {time.perf_counter() - start:.1f}s，"
+          f"文件大小 {before / 1024 / 1024:.1f}MB -> {after / 1024 / 1024:.1f}MB")
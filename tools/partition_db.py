@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import time
+
+# 在项目根目录下运行：python tools/partition_db.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把 sensor_data 里的数据按时间迁移到分区表")
+    parser.add_argument("--db", default=config.IOT_DATA_DB)
+    parser.add_argument("--period", choices=("month", "day"), default=config.PARTITION_PERIOD or "month")
+    parser.add_argument("--batch", type=int, default=10000, help="每个事务迁移的条数")
+    args = parser.parse_args()
+
+    # dao 在导入时按 config 打开数据库
+    config.IOT_DATA_DB = args.db
+    from sqlalchemy import delete, insert, select
+    from dao.iot_data_info import SensorData, engine, partition_name, create_partition, list_partitions
+
+    if config.PARTITION_PERIOD != args.period:
+        # 服务还在往 sensor_data 写入时，迁移会一直追着新数据跑
+        print(f"提示：config.PARTITION_PERIOD 为 {config.PARTITION_PERIOD!r}，"
+              f"请先改为 {args.period!r} 并重启服务，让新数据直接写入分区表")
+
+    # 每批在一个事务里复制到分区表并从 sensor_data 删除，任何时刻每条数据只在一张表里，迁移时服务可以继续查询
+    table = SensorData.__table__
+    moved = 0
+    start = time.perf_counter()
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select(table).order_by(table.c.id).limit(args.batch)).all()
+            if not rows:
+                break
+            groups = {}
+            for row in rows:
+                groups.setdefault(partition_name(row.timestamp, args.period), []).append(dict(row._mapping))
+            for name, part_rows in groups.items():
+                conn.execute(insert(create_partition(conn, name)), part_rows)
+            conn.execute(delete(table).where(table.c.id <= rows[-1].id))
+        moved += len(rows)
+        print(f"已迁移 {moved} 条，{time.perf_counter() - start:.1f}s")
+
+    with engine.connect() as conn:
+        for name in list_partitions(conn):
+            count = conn.exec_driver_sql(f"SELECT count(*) FROM {name}").scalar()
+            print(f"{name}: {count} 条")
+    print(f"共迁移 {moved} 条，耗时 {time.perf_counter() - start:.1f}s；"
+          f"sensor_data 释放的空间可以用 tools/compact_db.py 回收")
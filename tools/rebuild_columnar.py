@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+import time
+
+# 在项目根目录下运行：python tools/rebuild_columnar.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import COLUMNAR_DIR, COLUMNAR_PARTITION_SECONDS, COLUMNAR_BLOCK_ROWS, COLUMNAR_FLUSH_SECONDS
+from dao.iot_data_info import SensorDataDAO
+from dao.columnar_store import ColumnarStore
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="从 sensor_data 重新生成列式存储（STORAGE_ENGINE=columnar），"
+                    "用于补录了更早的历史数据（批量补录、partition_db.py 迁移后）的设备。"
+                    "服务进程在内存里缓存了列式文件的块数和最晚时间，请先停止服务再运行"
+    )
+    parser.add_argument("--device", default=None, help="只重建指定设备，默认全部设备")
+    parser.add_argument("--dir", default=COLUMNAR_DIR)
+    args = parser.parse_args()
+
+    dao = SensorDataDAO()
+    store = ColumnarStore(
+        args.dir,
+        dao=dao,
+        partition_seconds=COLUMNAR_PARTITION_SECONDS,
+        block_rows=COLUMNAR_BLOCK_ROWS,
+        flush_seconds=COLUMNAR_FLUSH_SECONDS
+    )
+    devices = [args.device] if args.device else dao.get_device_list()
+
+    start = time.perf_counter()
+    total = 0
+    for device_id in devices:
+        count = store.rebuild_device(device_id)
+        total += count
+        print(f"{device_id}: {count} 条")
+    # 不足一个块的数据还在内存里
+    store.flush()
+    print(f"完成，共重建 {len(devices)} 个设备，{total} 条，耗时 {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import os
+import queue
+import signal
+from typing import Dict, List, Set
+
+from dao.iot_data_info import SensorDataDAO, add_ingest_listener, add_delete_listener
+from dao.ingest_writer import IngestWriter
+from dao.retention import RetentionWorker
+from dao.writer_client import encode_frame, encode_rows, decode_rows, read_frame
+from config import WRITER_SOCKET, WRITER_BATCH_SIZE, WRITER_FLUSH_INTERVAL_MS, WRITER_SUBSCRIBER_BUFFER_BYTES
+from config import INGEST_QUEUE_MAXSIZE
+from config import RETENTION_POLICIES, RETENTION_INTERVAL_SECONDS, RETENTION_VACUUM_PAGES
+
+
+class WriterServer:
+    """多 worker 部署时唯一写 iot_data.db 的进程
+
+    各 HTTP worker 通过 Unix socket 把攒好的数据批次发过来（见 WriterClient），这里再合并成更大的事务写库，
+    提交后回复；写入和删除提交后广播给所有订阅的 worker，由它们在各自进程里触发写入/删除回调。
+    数据清理也只在这个进程里运行。
+
+    请求：{"op": "write", "rows": [...]}、{"op": "delete_device", "device_id"}、{"op": "retention_run"}、
+    {"op": "stats"}，回复 {"ok", "result"} 或 {"ok": false, "error"}；
+    {"op": "subscribe"} 之后这个连接只接收广播：{"event": "ingest", "rows"}、{"event": "delete", "device_id", "device_removed"}
+    """
+
+    def __init__(self, path: str = WRITER_SOCKET, dao: SensorDataDAO = None):
+        self.path = path
+        self.dao = dao or SensorDataDAO()
+        self.ingest_writer = IngestWriter(
+            self.dao,
+            batch_size=WRITER_BATCH_SIZE,
+            flush_interval_ms=WRITER_FLUSH_INTERVAL_MS,
+            max_queue_size=INGEST_QUEUE_MAXSIZE
+        )
+        self.retention_worker = RetentionWorker(
+            self.dao,
+            RETENTION_POLICIES,
+            interval_seconds=RETENTION_INTERVAL_SECONDS,
+            vacuum_pages=RETENTION_VACUUM_PAGES
+        )
+        self._loop = None
+        self._subscribers: Set[asyncio.StreamWriter] = set()
+        self._handlers: Set[asyncio.Task] = set()
+        self._requests = 0
+        self._dropped_subscribers = 0
+
+    # 写入/删除回调在写库线程里执行，编码后交给事件循环发送
+    def _on_ingest(self, rows: List[Dict]):
+        if self._subscribers:
+            frame = encode_frame({"event": "ingest", "rows": encode_rows(rows)})
+            self._loop.call_soon_threadsafe(self._broadcast, frame)
+
+    def _on_delete(self, device_id: str, device_removed: bool):
+        if self._subscribers:
+            frame = encode_frame({"event": "delete", "device_id": device_id, "device_removed": device_removed})
+            self._loop.call_soon_threadsafe(self._broadcast, frame)
+
+    def _broadcast(self, frame: bytes):
+        for writer in list(self._subscribers):
+            # 读不过来的 worker 直接断开，它重连后会重新加载缓存，不让积压无限增长
+            if writer.transport.get_write_buffer_size() > WRITER_SUBSCRIBER_BUFFER_BYTES:
+                self._subscribers.discard(writer)
+                self._dropped_subscribers += 1
+                writer.close()
+                continue
+            writer.write(frame)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                if request.get("op") == "subscribe":
+                    self._subscribers.add(writer)
+                    # 订阅连接不再发请求，等对方断开
+                    await reader.read()
+                    break
+                self._requests += 1
+                try:
+                    reply = {"ok": True, "result": await self._dispatch(request)}
+                except Exception as e:
+                    print(f"写库进程处理 {request.get('op')} 出错: {e}")
+                    reply = {"ok": False, "error": str(e)}
+                writer.write(encode_frame(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # 连接断开，或者退出时被取消
+            pass
+        finally:
+            self._subscribers.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def _dispatch(self, request: Dict):
+        op = request.get("op")
+        if op == "write":
+            try:
+                future = self.ingest_writer.submit_rows(decode_rows(request["rows"]))
+            except queue.Full:
+                raise RuntimeError("writer queue is full")
+            if not await asyncio.wrap_future(future):
+                raise RuntimeError("failed to save data")
+            return None
+        if op == "delete_device":
+            if not await asyncio.to_thread(self.dao.delete_device_data, request["device_id"]):
+                raise RuntimeError("failed to delete device data")
+            return None
+        if op == "retention_run":
+            return await asyncio.to_thread(self.retention_worker.run_once)
+        if op == "stats":
+            return self.stats()
+        raise ValueError(f"unknown op: {op}")
+
+    def stats(self) -> Dict:
+        return {
+            "connections": len(self._handlers),
+            "subscribers": len(self._subscribers),
+            "dropped_subscribers": self._dropped_subscribers,
+            "requests": self._requests,
+            "ingest": self.ingest_writer.stats(),
+            "retention": self.retention_worker.stats()
+        }
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        add_ingest_listener(self._on_ingest)
+        add_delete_listener(self._on_delete)
+        self.ingest_writer.start()
+        self.retention_worker.start()
+
+        # 上次异常退出留下的 socket 文件
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        print(f"写库进程已启动: {self.path}")
+
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+
+        # 先停止接收新连接，把队列里的数据写完并回复之后再断开已有的连接
+        server.close()
+        self.retention_worker.stop()
+        await asyncio.to_thread(self.ingest_writer.stop)
+        handlers = list(self._handlers)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        print("写库进程已退出")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="多 worker 部署时的写库进程")
+    parser.add_argument("--socket", default=WRITER_SOCKET)
+    args = parser.parse_args()
+
+    asyncio.run(WriterServer(args.socket).serve())